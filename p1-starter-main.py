@@ -5,19 +5,128 @@
 # that data when using specific commands.
 #
 
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import functools
+import http
+import inspect
+import io
+import itertools
+import json
+import math
+import mmap
+import os
+import pathlib
+import queue
+import random
+import re
 import sqlite3
-import matplotlib.pyplot as plt
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+import urllib.parse
 
 #
-# print_stats
+# load_pyplot
 #
-# Given a connection to the CTA database, executes various
-# SQL queries to retrieve and output basic stats.
+# Imports matplotlib.pyplot the first time something is plotted. Importing it takes longer than everything else the
+# program does at startup, and most sessions never draw a plot. Python caches the module after the first import.
 #
-def print_stats(dbConn):
-    dbCursor = dbConn.cursor()
+def load_pyplot():
+    import matplotlib.pyplot as plt
+    return plt
 
-    print("General statistics:")
+#
+# load_chicago_map
+#
+# Reads the map of Chicago used as the background of station plots the first time it is needed.
+#
+chicagoMap = None
+
+def load_chicago_map():
+    global chicagoMap
+
+    if chicagoMap is None:
+        import matplotlib.image
+        chicagoMap = matplotlib.image.imread("chicago.png")
+
+    return chicagoMap
+
+#
+# Charts
+#
+# Every chart is drawn onto an explicit matplotlib Axes by one of the draw_* functions, so no labels, titles or lines
+# carry over from one chart to the next. show_chart draws onto a new pyplot figure, shows it and closes it again.
+# save_chart draws onto a plain Figure that pyplot never sees and writes it to a file with the Agg (or SVG) renderer, so
+# it works without a display and in worker processes.
+#
+def draw_yearly_chart(ax, stationName, x, y):
+    ax.set_xlabel("Year")
+    ax.tick_params(axis="x", labelsize=6)
+    ax.set_ylabel("Number of Riders")
+    ax.set_title("Yearly Ridership at " + stationName + " Station")
+    ax.plot(x, y)
+
+def draw_monthly_chart(ax, stationName, year, x, y):
+    ax.set_xlabel("Month")
+    ax.set_ylabel("Number of Riders")
+    ax.tick_params(axis="y", labelsize=8)
+    ax.set_title("Monthly Ridership at " + stationName + " Station (" + year + ")")
+    ax.plot(x, y)
+
+def draw_daily_chart(ax, year, x, series):
+    ax.set_xlabel("Day")
+    ax.set_ylabel("Number of Riders")
+    ax.set_title("Ridership Each Day of " + year)
+
+    for stationName, y in series:
+        ax.plot(x, y, label=stationName)
+
+    ax.legend()
+
+def draw_station_map(ax, title, names, x, y):
+    xydims = [-87.9277, -87.5569, 41.7012, 42.0868]  # area covered by the map:
+    ax.imshow(load_chicago_map(), extent=xydims)
+    ax.set_title(title)
+    ax.plot(x, y, 'o')
+
+    for i in range(len(names)):
+        ax.annotate(names[i], (x[i], y[i]))
+
+    ax.set_xlim([-87.9277, -87.5569])
+    ax.set_ylim([41.7012, 42.0868])
+
+def show_chart(draw, *args):
+    plt = load_pyplot()
+    plt.ioff()
+    figure, ax = plt.subplots()
+    draw(ax, *args)
+    plt.show()
+    plt.close(figure)
+
+def save_chart(path, draw, *args):
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    draw(figure.subplots(), *args)
+    figure.savefig(path)
+
+#
+# compute_stats
+#
+# Given a connection to the CTA database, executes various SQL queries to retrieve the basic stats and returns them as a
+# dictionary. When the ridership rollups are available, the ride entry count, date range and total ridership are read
+# from them instead of scanning the raw Ridership table, and with partitions they come from the partition manifest.
+#
+def compute_stats(dbConn):
+    dbCursor = dbConn.cursor()
+    stats = {}
 
     # Station count
     dbCursor.execute("""
@@ -26,7 +135,7 @@ def print_stats(dbConn):
                     """)
 
     row = dbCursor.fetchone()
-    print("  # of stations:", f"{row[0]:,}")
+    stats["stations"] = row[0]
 
     # Stop count
     dbCursor.execute("""
@@ -35,7 +144,34 @@ def print_stats(dbConn):
                     """)
 
     row = dbCursor.fetchone()
-    print("  # of stops:", f"{row[0]:,}")
+    stats["stops"] = row[0]
+
+    if partitionRouter is not None:
+        # Ride entry count, date range and total ridership from the partition manifest
+        stats.update(partitionRouter.stats())
+        return stats
+
+    if rollups_ready(dbConn):
+        # Ride entry count and total ridership
+        dbCursor.execute("""
+                        SELECT sum(Num_Entries), sum(Num_Riders)
+                        FROM RidershipYearly;
+                        """)
+
+        row = dbCursor.fetchone()
+        stats["entries"] = row[0] or 0
+        stats["riders"] = row[1]
+
+        # Date range
+        dbCursor.execute("""
+                        SELECT min(Ride_Date), max(Ride_Date)
+                        FROM RidershipDaily;
+                        """)
+
+        row = dbCursor.fetchone()
+        stats["first_date"] = row[0]
+        stats["last_date"] = row[1]
+        return stats
 
     # Ride entry count
     dbCursor.execute("""
@@ -44,7 +180,7 @@ def print_stats(dbConn):
                     """)
 
     row = dbCursor.fetchone()
-    print("  # of ride entries:", f"{row[0]:,}")
+    stats["entries"] = row[0]
 
     # Date range
     dbCursor.execute("""
@@ -54,6 +190,7 @@ def print_stats(dbConn):
                     """)
 
     row = dbCursor.fetchone()
+    stats["first_date"] = row[0]
 
     dbCursor.execute("""
                     SELECT date(Ride_Date)
@@ -61,8 +198,8 @@ def print_stats(dbConn):
                     ORDER BY date(Ride_Date) DESC LIMIT 1
                     """)
 
-    row2 = dbCursor.fetchone()
-    print("  date range:", row[0], "-", row2[0])
+    row = dbCursor.fetchone()
+    stats["last_date"] = row[0]
 
     # Total ridership
     dbCursor.execute("""
@@ -71,714 +208,4996 @@ def print_stats(dbConn):
                     """)
 
     row = dbCursor.fetchone()
-    print("  Total ridership:", f"{row[0]:,}")
+    stats["riders"] = row[0]
+    return stats
 
 #
-# commandOne
+# database_fingerprint
 #
-# Takes input from the user and then uses an SQL query to return all the station IDs and names that match the provided
-# input.
+# Identifies the current version of the database behind the connection: the size and modification time of the database
+# file and of its write-ahead log (if there is one), plus the schema version. Any committed change to the data changes
+# at least one of these. An empty write-ahead log is left out, since a database in WAL mode gets a new one every time it
+# is opened even when nothing changed. Returns the database file path and the fingerprint, or None for both if the
+# database is not a file.
 #
-def commandOne(dbConn):
+def database_fingerprint(dbConn):
     dbCursor = dbConn.cursor()
-    commandOneInput = input("Enter partial station name (wildcards _ and %):")
+    dbCursor.execute("PRAGMA database_list;")
 
-    dbCursor.execute("""
-                    SELECT Station_ID, Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}" 
-                    ORDER BY Station_Name;
-                    """.format(commandOneInput))
+    dbPath = None
 
-    result = dbCursor.fetchone()
+    for row in dbCursor.fetchall():
+        if row[1] == "main":
+            dbPath = row[2]
 
-    if result is None:
-        print("**No stations found...")
-        return
+    if not dbPath:
+        return None, None
 
-    while True:
-        print(result[0], ":", result[1])
-        result = dbCursor.fetchone()
+    fingerprint = []
 
-        if result is None:
-            return
+    for path in [dbPath, dbPath + "-wal"]:
+        if os.path.exists(path):
+            fileStats = os.stat(path)
+
+            if path != dbPath and fileStats.st_size == 0:
+                continue
+
+            fingerprint.append([os.path.basename(path), fileStats.st_size, fileStats.st_mtime_ns])
+
+    dbCursor.execute("PRAGMA schema_version;")
+    fingerprint.append(dbCursor.fetchone()[0])
+
+    return dbPath, fingerprint
 
 #
-# commandTwo
+# load_stats
 #
-# Takes in a station name provided by the user and then outputs the weekday, saturday, sunday/holiday, and total
-# ridership and percentages at that station.
+# Returns the general statistics for the database, reading them from the sidecar cache file next to the database
+# (<database>.stats.json) if it was written for the current fingerprint. Otherwise the stats are computed and the cache
+# is rewritten. A cache that cannot be read or written is simply ignored.
 #
-def commandTwo(dbConn):
-    dbCursor = dbConn.cursor()
-    commandTwoInput = input("Enter the name of the station you would like to analyze:")
+def load_stats(dbConn):
+    dbPath, fingerprint = database_fingerprint(dbConn)
 
-    dbCursor.execute("""
-                    SELECT sum(Num_Riders) 
-                    FROM Ridership 
-                    JOIN Stations 
-                    ON Ridership.Station_ID = Stations.Station_ID 
-                    WHERE Station_Name = "{}" AND Type_of_Day = 'W';
-                    """.format(commandTwoInput))
+    if dbPath is None:
+        return compute_stats(dbConn)
 
-    result = dbCursor.fetchone()
+    cachePath = dbPath + ".stats.json"
 
-    if result[0] is None:
-        print("**No data found...")
-        return
+    try:
+        with open(cachePath) as cacheFile:
+            cache = json.load(cacheFile)
 
-    weekdayRiders = result[0]
+        if cache["fingerprint"] == fingerprint:
+            return cache["stats"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
 
-    dbCursor.execute("""
-                    SELECT sum(Num_Riders) 
-                    FROM Ridership 
-                    JOIN Stations 
-                    ON Ridership.Station_ID = Stations.Station_ID 
-                    WHERE Station_Name = "{}" AND Type_of_Day = 'A';
-                    """.format(commandTwoInput))
+    stats = compute_stats(dbConn)
 
-    result = dbCursor.fetchone()
+    try:
+        with open(cachePath, "w") as cacheFile:
+            json.dump({"fingerprint": fingerprint, "stats": stats}, cacheFile)
+    except OSError:
+        pass
 
-    if result is None:
-        saturdayRiders = 0
-    else:
-        saturdayRiders = result[0]
+    return stats
 
-    dbCursor.execute("""
-                    SELECT sum(Num_Riders) 
-                    FROM Ridership 
-                    JOIN Stations 
-                    ON Ridership.Station_ID = Stations.Station_ID 
-                    WHERE Station_Name = "{}" AND Type_of_Day = 'U';
-                    """.format(commandTwoInput))
+#
+# print_stats
+#
+# Given a connection to the CTA database, retrieves the basic stats (from the stats cache when the data has not changed)
+# and outputs them.
+#
+def print_stats(dbConn):
+    stats = load_stats(dbConn)
 
-    result = dbCursor.fetchone()
+    print("General statistics:")
+    print("  # of stations:", f"{stats['stations']:,}")
+    print("  # of stops:", f"{stats['stops']:,}")
+    print("  # of ride entries:", f"{stats['entries']:,}")
+    print("  date range:", stats["first_date"], "-", stats["last_date"])
+    print("  Total ridership:", f"{stats['riders']:,}")
 
-    if result is None:
-        sundayRiders = 0
-    else:
-        sundayRiders = result[0]
+#
+# Ridership rollups
+#
+# Summary tables that pre-aggregate the Ridership table per station by day (RidershipDaily), by year, month and type of
+# day (RidershipMonthly), and by year and type of day (RidershipYearly). Each rollup is keyed by Station_ID plus the
+# same date strings the raw queries produce with date() and strftime(), and it keeps a count of the raw rows folded into
+# each group so that groups disappear again once their last row is deleted. Rollups are built once with a full scan and
+# then kept up to date by triggers on Ridership, so new rows are folded in as they land. A NULL Num_Riders counts as
+# nothing, like it does in sum(), and Num_Counted keeps the number of rows that are not NULL so that a group made only
+# of NULL rows reports NULL, again like sum(). The same triggers count every change to Ridership in the one-row
+# RidershipVersion table, which snapshots, partitions and the caches use to tell whether the data changed. The count
+# starts from a random value whenever the rollups are rebuilt, so a rebuilt database never repeats an earlier version.
+#
+ROLLUPS = [
+    ("RidershipDaily", ["Ride_Date"], ["date({0}.Ride_Date)"]),
+    ("RidershipMonthly", ["Year", "Month", "Type_of_Day"],
+     ["strftime('%Y', {0}.Ride_Date)", "strftime('%m', {0}.Ride_Date)", "{0}.Type_of_Day"]),
+    ("RidershipYearly", ["Year", "Type_of_Day"], ["strftime('%Y', {0}.Ride_Date)", "{0}.Type_of_Day"]),
+]
 
-    totalRiders = weekdayRiders + saturdayRiders + sundayRiders
-    weekdayPercentage = (weekdayRiders / totalRiders) * 100
-    saturdayPercentage = (saturdayRiders / totalRiders) * 100
-    sundayPercentage = (sundayRiders / totalRiders) * 100
+ROLLUP_TRIGGERS = ["Rollup_Insert", "Rollup_Delete", "Rollup_Update"]
 
-    print("Percentage of ridership for the {} station:".format(commandTwoInput))
-    print("  Weekday ridership:", f"{weekdayRiders:,}", f"({weekdayPercentage:.2f}%)")
-    print("  Saturday ridership:", f"{saturdayRiders:,}", f"({saturdayPercentage:.2f}%)")
-    print("  Sunday/holiday ridership:", f"{sundayRiders:,}", f"({sundayPercentage:.2f}%)")
-    print("  Total ridership:", f"{totalRiders:,}")
+#
+# rollup_add_sql / rollup_remove_sql
+#
+# Return the statements that fold a single Ridership row (NEW or OLD inside a trigger) into, or out of, a rollup table.
+#
+def rollup_add_sql(table, keyColumns, keyExpressions, alias):
+    columns = ", ".join(["Station_ID"] + keyColumns)
+    values = ", ".join(["{}.Station_ID".format(alias)] + [expression.format(alias) for expression in keyExpressions])
+
+    return """
+            INSERT INTO {0} ({1}, Num_Riders, Num_Entries, Num_Counted)
+            VALUES ({2}, {3}.Num_Riders, 1, {3}.Num_Riders IS NOT NULL)
+            ON CONFLICT ({1}) DO UPDATE
+            SET Num_Riders = CASE WHEN Num_Counted + excluded.Num_Counted = 0 THEN NULL
+                                  ELSE coalesce(Num_Riders, 0) + coalesce(excluded.Num_Riders, 0) END,
+                Num_Entries = Num_Entries + 1,
+                Num_Counted = Num_Counted + excluded.Num_Counted;
+            """.format(table, columns, values, alias)
+
+def rollup_remove_sql(table, keyColumns, keyExpressions, alias):
+    conditions = " AND ".join(["Station_ID = {}.Station_ID".format(alias)] +
+                              ["{} = {}".format(column, expression.format(alias))
+                               for column, expression in zip(keyColumns, keyExpressions)])
+
+    return """
+            UPDATE {0}
+            SET Num_Riders = CASE WHEN Num_Counted - ({1}.Num_Riders IS NOT NULL) = 0 THEN NULL
+                                  ELSE coalesce(Num_Riders, 0) - coalesce({1}.Num_Riders, 0) END,
+                Num_Entries = Num_Entries - 1,
+                Num_Counted = Num_Counted - ({1}.Num_Riders IS NOT NULL)
+            WHERE {2};
+            DELETE FROM {0}
+            WHERE {2} AND Num_Entries = 0;
+            """.format(table, alias, conditions)
 
 #
-# commandThree
+# create_rollup_triggers
 #
-# Outputs the total ridership and percentages of every station on weekdays in descending order by ridership.
+# Creates the triggers that fold every insert, delete and update on Ridership into the rollup tables. Run inside the
+# caller's transaction.
 #
-def commandThree(dbConn):
+def create_rollup_triggers(dbCursor):
+    addNew = "".join([rollup_add_sql(*rollup, "NEW") for rollup in ROLLUPS])
+    removeOld = "".join([rollup_remove_sql(*rollup, "OLD") for rollup in ROLLUPS])
+
+    countChange = "UPDATE RidershipVersion SET Version = Version + 1;"
+
+    dbCursor.execute("CREATE TRIGGER Rollup_Insert AFTER INSERT ON Ridership BEGIN {} {} END;"
+                     .format(countChange, addNew))
+    dbCursor.execute("CREATE TRIGGER Rollup_Delete AFTER DELETE ON Ridership BEGIN {} {} END;"
+                     .format(countChange, removeOld))
+    dbCursor.execute("CREATE TRIGGER Rollup_Update AFTER UPDATE ON Ridership BEGIN {} {} {} END;"
+                     .format(countChange, removeOld, addNew))
+
+#
+# rollups_ready
+#
+# Returns True if every rollup table, the RidershipVersion table and every maintenance trigger exist in the database.
+# They are all created in a single transaction, so if they are all present the rollups are complete. Rollup tables from
+# before Num_Counted was added do not count, so that they are rebuilt with it.
+#
+def rollups_ready(dbConn):
     dbCursor = dbConn.cursor()
-    print("Ridership on Weekdays for Each Station")
+    tables = [rollup[0] for rollup in ROLLUPS]
 
     dbCursor.execute("""
-                    SELECT sum(Num_Riders) 
-                    FROM Ridership 
-                    JOIN Stations 
-                    ON Ridership.Station_ID = Stations.Station_ID 
-                    WHERE Type_of_Day = 'W';
-                    """)
+                    SELECT count(*)
+                    FROM sqlite_master
+                    WHERE (type = 'table' AND name IN ({}) AND sql LIKE '%Num_Counted%')
+                    OR (type = 'table' AND name = 'RidershipVersion')
+                    OR (type = 'trigger' AND name IN ({}));
+                    """.format(", ".join("?" * len(tables)), ", ".join("?" * len(ROLLUP_TRIGGERS))),
+                     tables + ROLLUP_TRIGGERS)
 
-    result = dbCursor.fetchone()
-    totalWeekdayRidership = result[0]
+    row = dbCursor.fetchone()
+    return row[0] == len(tables) + 1 + len(ROLLUP_TRIGGERS)
+
+#
+# build_rollups
+#
+# Makes sure the rollup tables exist and are current. If any rollup table or trigger is missing (first run, or the
+# Ridership table was recreated and took the triggers with it), all of them are dropped and rebuilt from the raw table
+# in one transaction. If the database cannot be written to, temporary views with the same names and columns are created
+# instead, so the commands still work and simply aggregate the raw table on every call. RidershipVersion then becomes a
+# view of the entry count and total ridership, which is the closest a read-only session can get to a change count.
+#
+def build_rollups(dbConn):
+    if rollups_ready(dbConn):
+        return True
+
+    print("Building ridership rollups...")
+    dbCursor = dbConn.cursor()
+
+    try:
+        dbCursor.execute("BEGIN")
+
+        for trigger in ROLLUP_TRIGGERS:
+            dbCursor.execute("DROP TRIGGER IF EXISTS {};".format(trigger))
+
+        for table, keyColumns, keyExpressions in ROLLUPS:
+            columns = ", ".join(["Station_ID"] + keyColumns)
+            expressions = ", ".join(["Station_ID"] + [expression.format("Ridership") for expression in keyExpressions])
+
+            dbCursor.execute("DROP TABLE IF EXISTS {};".format(table))
+            dbCursor.execute("""
+                            CREATE TABLE {0} (
+                                {1},
+                                Num_Riders INTEGER,
+                                Num_Entries INTEGER NOT NULL,
+                                Num_Counted INTEGER NOT NULL,
+                                PRIMARY KEY ({1})
+                            ) WITHOUT ROWID;
+                            """.format(table, columns))
+            dbCursor.execute("""
+                            INSERT INTO {0} ({1}, Num_Riders, Num_Entries, Num_Counted)
+                            SELECT {2}, sum(Num_Riders), count(*), count(Num_Riders)
+                            FROM Ridership
+                            GROUP BY {2};
+                            """.format(table, columns, expressions))
+
+        dbCursor.execute("DROP TABLE IF EXISTS RidershipVersion;")
+        dbCursor.execute("""
+                        CREATE TABLE RidershipVersion (
+                            Version INTEGER NOT NULL
+                        );
+                        """)
+        dbCursor.execute("INSERT INTO RidershipVersion VALUES (?);", (random.getrandbits(48),))
+        create_rollup_triggers(dbCursor)
+        dbConn.commit()
+        return True
+    except sqlite3.OperationalError as error:
+        dbConn.rollback()
+        print("**Unable to build ridership rollups ({}), using the raw Ridership table...".format(error))
+
+    for table, keyColumns, keyExpressions in ROLLUPS:
+        columns = ", ".join(["Station_ID"] + keyColumns)
+        expressions = ", ".join(["Station_ID"] + [expression.format("Ridership") for expression in keyExpressions])
+
+        dbCursor.execute("""
+                        CREATE TEMP VIEW IF NOT EXISTS {0} ({1}, Num_Riders, Num_Entries, Num_Counted) AS
+                        SELECT {2}, sum(Num_Riders), count(*), count(Num_Riders)
+                        FROM Ridership
+                        GROUP BY {2};
+                        """.format(table, columns, expressions))
 
     dbCursor.execute("""
-                    SELECT Station_Name, sum(Num_Riders) 
-                    FROM Ridership 
-                    JOIN Stations 
-                    ON Ridership.Station_ID = Stations.Station_ID 
-                    WHERE Type_of_Day = 'W'
-                    GROUP BY Station_Name 
-                    ORDER BY sum(Num_Riders) DESC;
+                    CREATE TEMP VIEW IF NOT EXISTS RidershipVersion (Version) AS
+                    SELECT count(*) || ' entries, ' || coalesce(sum(Num_Riders), 0) || ' riders'
+                    FROM Ridership;
                     """)
 
-    result = dbCursor.fetchone()
+    return False
 
-    while True:
-        percentage = (result[1] / totalWeekdayRidership) * 100
-        print(result[0], ":", f"{result[1]:,}", f"({percentage:.2f}%)")
-        result = dbCursor.fetchone()
+#
+# year_range
+#
+# Returns the first day of the given year and of the year after it as 'YYYY-MM-DD' strings, so that a year filter can be
+# written as a range predicate on a date column instead of comparing strftime('%Y', ...) on every row. A year that is
+# not a number gives an empty range.
+#
+def year_range(year):
+    if not year.isdigit():
+        return "", ""
 
-        if result is None:
-            return
+    return "{:04d}-01-01".format(int(year)), "{:04d}-01-01".format(int(year) + 1)
 
 #
-# commandFour
+# Clustered storage layout
 #
-# Takes in a line color and direction as input from the user, and then outputs all the stops that are in the line color
-# and go in the specified direction, as well as outputting whether it is handicap accessible.
+# The original Ridership table is a rowid table in load order with a text Ride_Date, so every filter on a station, a
+# type of day or a date scans all of it. migrate_layout rewrites it as a WITHOUT ROWID table clustered on
+# (Station_ID, Day_Ordinal), where Day_Ordinal is the proleptic Gregorian day number (the same as Python's
+# date.toordinal()), with a covering index for the day type breakdowns. Date range lookups use the clustered key.
+# Ride_Date is kept as is so every existing query keeps working. Anything inserting into the clustered table must supply
+# Day_Ordinal.
 #
-def commandFour(dbConn):
-    dbCursor = dbConn.cursor()
-    lineColor = input("Enter a line color (e.g. Red or Yellow):")
-    lineColor = lineColor.lower()
-
-    if (lineColor != "red" and lineColor != "blue" and lineColor != "green" and lineColor != "brown" and
-        lineColor != "purple" and lineColor != "purple-express" and lineColor != "yellow" and lineColor != "pink" and
-        lineColor != "orange"):
-        print("**No such line...")
-        return
+ORDINAL_EXPRESSION = "CAST(julianday(date({0})) - 1721424.5 AS INTEGER)"
+
+CLUSTERED_RIDERSHIP_SCHEMA = """
+                    CREATE TABLE Ridership_Clustered (
+                        Station_ID INTEGER NOT NULL,
+                        Day_Ordinal INTEGER NOT NULL,
+                        Ride_Date TEXT,
+                        Type_of_Day TEXT,
+                        Num_Riders INTEGER,
+                        PRIMARY KEY (Station_ID, Day_Ordinal)
+                    ) WITHOUT ROWID;
+                    """
+
+CLUSTERED_RIDERSHIP_INDEXES = [
+    # commandTwo (one station, one type of day) and commandThree (every station, weekdays) read only this index
+    "CREATE INDEX Ridership_DayType ON Ridership (Type_of_Day, Station_ID, Num_Riders);",
+]
+
+# The queries behind commands 2, 3, 6, 7 and 8, timed before and after the migration
+LAYOUT_QUERIES = [
+    ("commandTwo", """
+                    SELECT sum(Num_Riders)
+                    FROM Ridership
+                    JOIN Stations
+                    ON Ridership.Station_ID = Stations.Station_ID
+                    WHERE Station_Name = :station AND Type_of_Day = 'W';
+                    """),
+    ("commandThree", """
+                    SELECT Station_Name, sum(Num_Riders)
+                    FROM Ridership
+                    JOIN Stations
+                    ON Ridership.Station_ID = Stations.Station_ID
+                    WHERE Type_of_Day = 'W'
+                    GROUP BY Station_Name
+                    ORDER BY sum(Num_Riders) DESC;
+                    """),
+    ("commandSix", """
+                    SELECT Year, sum(Num_Riders)
+                    FROM RidershipYearly
+                    WHERE Station_ID = :station_id
+                    GROUP BY Year
+                    ORDER BY Year;
+                    """),
+    ("commandSeven", """
+                    SELECT Month, sum(Num_Riders)
+                    FROM RidershipMonthly
+                    WHERE Station_ID = :station_id AND Year = :year
+                    GROUP BY Month
+                    ORDER BY Month;
+                    """),
+    ("commandEight", """
+                    SELECT Ride_Date, Num_Riders
+                    FROM RidershipDaily
+                    WHERE Station_ID = :station_id AND Ride_Date >= :start AND Ride_Date < :end
+                    ORDER BY Ride_Date;
+                    """),
+]
 
-    lineColor = lineColor.capitalize()
+#
+# layout_is_clustered
+#
+# Returns True if the Ridership table has already been migrated to the clustered layout.
+#
+def layout_is_clustered(dbConn):
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("PRAGMA table_info(Ridership);")
 
-    if lineColor == "Purple-express":
-        lineColor = "Purple-Express"
+    return "Day_Ordinal" in [row[1] for row in dbCursor.fetchall()]
 
-    direction = input("Enter a direction (N/S/W/E):")
-    direction = direction.upper()
+#
+# measure_layout
+#
+# Returns the database size in bytes and the best of three wall-clock times (in milliseconds) of each of the
+# LAYOUT_QUERIES for a sample station and year.
+#
+def measure_layout(dbConn, parameters):
+    dbCursor = dbConn.cursor()
 
-    if direction != "N" and direction != "S" and direction != "W" and direction != "E":
-        print("**That line does not run in the direction chosen...")
-        return
+    dbCursor.execute("PRAGMA page_count;")
+    pageCount = dbCursor.fetchone()[0]
+    dbCursor.execute("PRAGMA page_size;")
+    size = pageCount * dbCursor.fetchone()[0]
 
-    dbCursor.execute("""
-                    SELECT Stop_Name, Direction, ADA 
-                    FROM Stops 
-                    JOIN StopDetails 
-                    ON Stops.Stop_ID = StopDetails.Stop_ID 
-                    JOIN Lines 
-                    ON StopDetails.Line_ID = Lines.Line_ID 
-                    WHERE Color = "{}" AND Direction = "{}" 
-                    ORDER BY Stop_Name;
-                    """.format(lineColor, direction))
+    timings = {}
 
-    result = dbCursor.fetchone()
+    for name, sql in LAYOUT_QUERIES:
+        best = None
 
-    if result is None:
-        print("**That line does not run in the direction chosen...")
-        return
+        for attempt in range(3):
+            start = time.perf_counter()
+            dbCursor.execute(sql, parameters)
+            dbCursor.fetchall()
+            elapsed = (time.perf_counter() - start) * 1000
 
-    while True:
-        if result[2] == 1:
-            print(result[0], ": direction =", result[1], "(handicap accessible)")
-        else:
-            print(result[0], ": direction =", result[1], "(not handicap accessible)")
+            if best is None or elapsed < best:
+                best = elapsed
 
-        result = dbCursor.fetchone()
+        timings[name] = best
 
-        if result is None:
-            return
+    return size, timings
 
 #
-# commandFive
+# migrate_layout
 #
-# Outputs the number of stops of each line color and direction, both being grouped together. They are sorted in
-# ascending order by color and then direction, and it also outputs the percentages relative to the total number of
-# stops.
+# Rewrites the Ridership table into the clustered layout in a single transaction, recreates the rollup triggers that
+# were dropped along with the old table, then runs ANALYZE and VACUUM and prints a before/after size and timing report.
+# A database migrated by an earlier version loses the Ridership_Day index and the generated Year and Month columns that
+# layout had, since no query uses them.
 #
-def commandFive(dbConn):
+def migrate_layout(dbConn):
     dbCursor = dbConn.cursor()
-    print("Number of Stops For Each Color By Direction")
+
+    if layout_is_clustered(dbConn):
+        dbCursor.execute("PRAGMA table_xinfo(Ridership);")
+        unusedColumns = [row[1] for row in dbCursor.fetchall() if row[1] in ("Year", "Month")]
+
+        try:
+            dbCursor.execute("DROP INDEX IF EXISTS Ridership_Day;")
+
+            for column in unusedColumns:
+                dbCursor.execute("ALTER TABLE Ridership DROP COLUMN {};".format(column))
+
+            dbConn.commit()
+        except sqlite3.OperationalError as error:
+            dbConn.rollback()
+            print("**Unable to drop the unused parts of the clustered layout ({})...".format(error))
+
+        print("**Ridership already uses the clustered layout...")
+        return
+
+    build_rollups(dbConn)
 
     dbCursor.execute("""
-                    SELECT Count(*) 
-                    FROM Stops;
+                    SELECT Stations.Station_ID, Station_Name
+                    FROM Stations
+                    JOIN RidershipYearly
+                    ON Stations.Station_ID = RidershipYearly.Station_ID
+                    ORDER BY Num_Riders DESC LIMIT 1;
                     """)
 
-    result = dbCursor.fetchone()
-    totalStops = result[0]
+    row = dbCursor.fetchone()
+
+    if row is None:
+        print("**No ridership data to migrate...")
+        return
+
+    stationID, station = row
 
     dbCursor.execute("""
-                    SELECT Color, Direction, Count(*) 
-                    FROM Stops 
-                    JOIN StopDetails 
-                    ON Stops.Stop_ID = StopDetails.Stop_ID 
-                    JOIN Lines 
-                    ON StopDetails.Line_ID = Lines.Line_ID 
-                    GROUP BY Color, Direction 
-                    ORDER BY Color, Direction;
+                    SELECT max(Year)
+                    FROM RidershipYearly;
                     """)
 
-    result = dbCursor.fetchone()
+    year = dbCursor.fetchone()[0]
+    start, end = year_range(year)
+    parameters = {"station": station, "station_id": stationID, "year": year, "start": start, "end": end}
+
+    print("Migrating Ridership to the clustered layout...")
+    sizeBefore, timingsBefore = measure_layout(dbConn, parameters)
+
+    try:
+        dbCursor.execute("BEGIN")
+        dbCursor.execute(CLUSTERED_RIDERSHIP_SCHEMA)
+        dbCursor.execute("""
+                        INSERT INTO Ridership_Clustered (Station_ID, Day_Ordinal, Ride_Date, Type_of_Day, Num_Riders)
+                        SELECT Station_ID, {}, Ride_Date, Type_of_Day, Num_Riders
+                        FROM Ridership
+                        ORDER BY 1, 2;
+                        """.format(ORDINAL_EXPRESSION.format("Ride_Date")))
+        dbCursor.execute("DROP TABLE Ridership;")
+        dbCursor.execute("ALTER TABLE Ridership_Clustered RENAME TO Ridership;")
+
+        for sql in CLUSTERED_RIDERSHIP_INDEXES:
+            dbCursor.execute(sql)
+
+        create_rollup_triggers(dbCursor)
+        dbConn.commit()
+    except sqlite3.IntegrityError:
+        dbConn.rollback()
+        print("**Ridership has more than one row for the same station and day, cannot cluster it...")
+        return
+    except sqlite3.OperationalError as error:
+        dbConn.rollback()
+        print("**Unable to migrate Ridership ({})...".format(error))
+        return
 
-    while True:
-        percentage = (result[2] / totalStops) * 100
-        print(result[0], "going", result[1], ":", result[2], f"({percentage:.2f}%)")
+    dbCursor.execute("ANALYZE;")
+    dbConn.commit()
+    dbCursor.execute("VACUUM;")
 
-        result = dbCursor.fetchone()
+    sizeAfter, timingsAfter = measure_layout(dbConn, parameters)
 
-        if result is None:
-            return
+    print("Storage layout report ({}, {}):".format(station, year))
+    print("  database size:", f"{sizeBefore:,}", "->", f"{sizeAfter:,}", "bytes")
+
+    for name, sql in LAYOUT_QUERIES:
+        print("  {}: {:.2f} ms -> {:.2f} ms".format(name, timingsBefore[name], timingsAfter[name]))
 
 #
-# commandSix
+# Ingestion
 #
-# Takes in the user's input and if it matches exactly one station, the program will output the yearly ridership at that
-# station. The user is also prompted to plot this data, and if they press 'y', a plot will be generated and shown to
-# them.
+# --ingest loads new daily ridership from CSV files into the database in place, so a new day of data no longer means
+# rebuilding the database. The files use the columns of the city's daily ridership export (station_id, stationname,
+# date, daytype, rides), where dates may be MM/DD/YYYY or YYYY-MM-DD. Rows are read in batches, staged in a temporary
+# table keyed on (Station_ID, Ride_Date), and copied into Ridership in one transaction per batch, skipping any station
+# and day that is already in the database. The database is switched to WAL mode first, so sessions reading it keep
+# querying while a batch is written and see each batch once it commits. The rollup triggers fold the new rows into
+# the rollups as they land, and the stats and result caches notice the change through the database fingerprint.
 #
-def commandSix(dbConn):
-    dbCursor = dbConn.cursor()
-    commandSixInput = input("Enter a station name (wildcards _ and %):")
+INGEST_COLUMNS = {
+    "station_id": "Station_ID",
+    "stationname": "Station_Name",
+    "station_name": "Station_Name",
+    "date": "Ride_Date",
+    "ride_date": "Ride_Date",
+    "daytype": "Type_of_Day",
+    "type_of_day": "Type_of_Day",
+    "rides": "Num_Riders",
+    "num_riders": "Num_Riders",
+}
 
-    dbCursor.execute("""
-                    SELECT Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandSixInput))
+#
+# parse_ingest_row
+#
+# Returns (Station_ID, Ride_Date, Type_of_Day, Num_Riders, Station_Name) for a CSV row whose columns were renamed with
+# INGEST_COLUMNS, with the date stored the way Ridership stores it. Raises a ValueError if the row is not valid.
+#
+def parse_ingest_row(row):
+    rideDate = row["Ride_Date"].strip()
 
-    result = dbCursor.fetchall()
+    if "/" in rideDate:
+        rideDate = datetime.datetime.strptime(rideDate, "%m/%d/%Y").date()
+    else:
+        rideDate = datetime.date.fromisoformat(rideDate[:10])
 
-    if len(result) == 0:
-        print("**No station found...")
-        return
-    elif len(result) > 1:
-        print("**Multiple stations found...")
-        return
+    typeOfDay = row["Type_of_Day"].strip().upper()
 
-    dbCursor.execute("""
-                    SELECT Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandSixInput))
+    if typeOfDay not in DAY_TYPE_CODES:
+        raise ValueError("unknown type of day '{}'".format(typeOfDay))
 
-    result = dbCursor.fetchone()
-    stationName = result[0]
-    print("Yearly Ridership at", stationName)
+    numRiders = int(row["Num_Riders"].strip().replace(",", ""))
 
-    dbCursor.execute("""
-                    SELECT strftime('%Y', Ride_Date) as Year, sum(Num_Riders) 
-                    FROM Stations 
-                    JOIN Ridership 
-                    ON Stations.Station_ID = Ridership.Station_ID 
-                    WHERE Station_Name = "{}"
-                    GROUP BY Year;
-                    """.format(stationName))
+    if numRiders < 0:
+        raise ValueError("negative ridership")
 
-    result = dbCursor.fetchone()
+    stationName = row.get("Station_Name")
 
-    x = []
-    y = []
-    plt.xlabel("Year")
-    plt.xticks(fontsize=6)
-    plt.ylabel("Number of Riders")
-    plt.title("Yearly Ridership at " + stationName + " Station")
+    return (int(row["Station_ID"]), rideDate.isoformat() + " 00:00:00.000", typeOfDay, numRiders,
+            stationName.strip() if stationName else None)
 
-    while True:
-        print(result[0], ":", f"{result[1]:,}")
-        x.append(result[0])
-        y.append(result[1])
-        result = dbCursor.fetchone()
+#
+# read_ingest_rows
+#
+# Yields the parsed rows of a ridership CSV file. Rows that cannot be parsed are reported on standard error and counted
+# in rejected[0].
+#
+def read_ingest_rows(path, rejected):
+    with open(path, newline="") as csvFile:
+        reader = csv.DictReader(csvFile)
+        columns = {name: INGEST_COLUMNS[name.strip().lower()] for name in reader.fieldnames or []
+                   if name.strip().lower() in INGEST_COLUMNS}
 
-        if result is None:
-            break
+        missing = set(["Station_ID", "Ride_Date", "Type_of_Day", "Num_Riders"]) - set(columns.values())
 
-    plotInput = input("Plot? (y/n)")
-    plotInput = plotInput.lower()
+        if missing:
+            raise ValueError("{} has no {} column".format(path, ", ".join(sorted(missing))))
 
-    if plotInput == 'y':
-        plt.ioff()
-        plt.plot(x, y)
-        plt.show()
+        for row in reader:
+            try:
+                yield parse_ingest_row({columns[name]: value for name, value in row.items() if name in columns})
+            except (ValueError, TypeError, AttributeError) as error:
+                rejected[0] += 1
+
+                if rejected[0] <= 10:
+                    print("**Skipping line {} of {} ({})...".format(reader.line_num, path, error), file=sys.stderr)
 
 #
-# commandSeven
+# ingest_batch
 #
-# Takes in the user's input for a station if it matches exactly one station, and also takes in the user's input for
-# a year. The program then outputs the monthly ridership of that station on that given year, and also plots this data
-# if the user says that they want a plot.
+# Copies one batch of parsed rows into Ridership (and any new stations into Stations) in a single transaction, and
+# returns the number of new Ridership rows.
 #
-def commandSeven(dbConn):
+def ingest_batch(dbConn, rows, clustered):
     dbCursor = dbConn.cursor()
-    commandSevenInput = input("Enter a station name (wildcards _ and %):")
-
-    dbCursor.execute("""
-                    SELECT Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandSevenInput))
-
-    result = dbCursor.fetchall()
+    dbCursor.execute("BEGIN IMMEDIATE")
+
+    try:
+        dbCursor.executemany("""
+                        INSERT OR IGNORE INTO temp.IngestRows (Station_ID, Ride_Date, Type_of_Day, Num_Riders,
+                            Station_Name)
+                        VALUES (?, ?, ?, ?, ?);
+                        """, rows)
+
+        dbCursor.execute("""
+                        INSERT INTO Stations (Station_ID, Station_Name)
+                        SELECT Station_ID, max(Station_Name)
+                        FROM temp.IngestRows
+                        WHERE Station_Name IS NOT NULL AND Station_ID NOT IN (SELECT Station_ID FROM Stations)
+                        GROUP BY Station_ID;
+                        """)
+
+        dbCursor.execute("""
+                        INSERT INTO Ridership ({0}Station_ID, Ride_Date, Type_of_Day, Num_Riders)
+                        SELECT {1}Station_ID, Ride_Date, Type_of_Day, Num_Riders
+                        FROM temp.IngestRows AS New
+                        WHERE NOT EXISTS (
+                            SELECT 1
+                            FROM RidershipDaily
+                            WHERE RidershipDaily.Station_ID = New.Station_ID
+                                AND RidershipDaily.Ride_Date = date(New.Ride_Date)
+                        )
+                        ORDER BY Station_ID, Ride_Date;
+                        """.format("Day_Ordinal, " if clustered else "",
+                                   ORDINAL_EXPRESSION.format("Ride_Date") + ", " if clustered else ""))
+
+        inserted = dbCursor.rowcount
+        dbCursor.execute("DELETE FROM temp.IngestRows;")
+        dbConn.commit()
+    except sqlite3.Error:
+        dbConn.rollback()
+        raise
+
+    return inserted
 
-    if len(result) == 0:
-        print("**No station found...")
-        return
-    elif len(result) > 1:
-        print("**Multiple stations found...")
+#
+# ingest_files
+#
+# Loads the given ridership CSV files into the database, batchSize rows per transaction, and reports what was added.
+#
+def ingest_files(dbConn, paths, batchSize):
+    if not build_rollups(dbConn):
+        print("**Cannot ingest into a read-only database...")
         return
 
+    dbCursor = dbConn.cursor()
+    dbCursor.execute("PRAGMA journal_mode = WAL;")
+    dbCursor.execute("PRAGMA busy_timeout = 30000;")
+    # untyped like the rollup keys, so that matching a staged row against RidershipDaily can use its primary key
     dbCursor.execute("""
-                    SELECT Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandSevenInput))
+                    CREATE TEMP TABLE IF NOT EXISTS IngestRows (
+                        Station_ID,
+                        Ride_Date,
+                        Type_of_Day,
+                        Num_Riders,
+                        Station_Name,
+                        PRIMARY KEY (Station_ID, Ride_Date)
+                    );
+                    """)
 
-    result = dbCursor.fetchone()
-    stationName = result[0]
-    year = input("Enter a year:")
-    print("Monthly Ridership at " + stationName + " for " + year)
+    clustered = layout_is_clustered(dbConn)
 
-    dbCursor.execute("""
-                    SELECT strftime('%m', Ride_Date) as Month, sum(Num_Riders) 
-                    FROM Stations 
-                    JOIN Ridership 
-                    ON Stations.Station_ID = Ridership.Station_ID 
-                    WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}" 
-                    GROUP BY Month;
-                    """.format(stationName, year))
+    for path in paths:
+        start = time.perf_counter()
+        rejected = [0]
+        read = 0
+        inserted = 0
 
-    result = dbCursor.fetchone()
+        try:
+            rows = read_ingest_rows(path, rejected)
 
-    x = []
-    y = []
-    plt.xlabel("Month")
-    plt.ylabel("Number of Riders")
-    plt.yticks(fontsize=8)
-    plt.title("Monthly Ridership at " + stationName + " Station (" + year + ")")
+            while True:
+                batch = list(itertools.islice(rows, batchSize))
 
-    while True:
-        print(result[0] + "/" + year + " : " + f"{result[1]:,}")
-        x.append(result[0])
-        y.append(result[1])
-        result = dbCursor.fetchone()
+                if len(batch) == 0:
+                    break
 
-        if result is None:
-            break
+                read += len(batch)
+                inserted += ingest_batch(dbConn, batch, clustered)
+        except (OSError, ValueError, sqlite3.Error) as error:
+            print("**Unable to ingest {} ({})...".format(path, error))
 
-    plotInput = input("Plot? (y/n)")
-    plotInput = plotInput.lower()
+        print("Ingested {}: {:,} rows read, {:,} added, {:,} already present, {:,} rejected in {:.1f} s".format(
+            path, read, inserted, read - inserted, rejected[0], time.perf_counter() - start))
 
-    if plotInput == 'y':
-        plt.ioff()
-        plt.plot(x, y)
-        plt.show()
+    dbCursor.execute("PRAGMA optimize;")
 
 #
-# commandEight
+# Background queries
 #
-# Takes in a user's input for a year, and then two station names that correspond to exactly one station. The program
-# then outputs the ridership on that year for the first and last 5 days at each of those stations, and if the user wants
-# a plot, the program will plot out the ridership for that entire year at both of the stations.
+# In the interactive loop every SQL call a command makes (an execute or a fetch) runs on a worker thread while the main
+# thread waits for it, so the wait can be interrupted. Ctrl-C stops the running statement with Connection.interrupt()
+# and abandons the command, and the user is back at the command prompt with the connection intact. A progress handler
+# counts the virtual machine steps of the statements, and once a call has run for PROGRESS_DELAY seconds the main thread
+# shows its elapsed time and steps on standard error (if that is a terminal). With --timeout the SQL calls of a command
+# share a time budget, and the call running when it runs out is interrupted the same way. Outside the interactive loop
+# queryRunner is None and cursors run their calls directly.
 #
-def commandEight(dbConn):
-    dbCursor = dbConn.cursor()
-    year = input("Year to compare against?")
-    commandEightInput = input("Enter station 1 (wildcards _ and %):")
+queryRunner = None
+
+PROGRESS_STEP_INTERVAL = 10000
+PROGRESS_DELAY = 0.5
+PROGRESS_REFRESH = 0.1
+
+class QueryCancelled(Exception):
+    pass
+
+class QueryRunner:
+    def __init__(self, dbConn, timeout):
+        self.dbConn = dbConn
+        self.timeout = timeout
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="query")
+        self.interval = PROGRESS_STEP_INTERVAL if tracer is None else TRACE_STEP_INTERVAL
+        self.showProgress = sys.stderr.isatty()
+        self.steps = 0
+        self.spent = 0
+
+        # the tracer counts its steps through this handler, since a connection only has one
+        dbConn.set_progress_handler(self.count_steps, self.interval)
+
+    def count_steps(self):
+        self.steps += self.interval
+
+        if tracer is not None:
+            tracer.count_steps()
+
+        return 0
+
+    #
+    # start_command
+    #
+    # Gives the next command the full time budget.
+    #
+    def start_command(self):
+        self.spent = 0
+
+    #
+    # show_progress
+    #
+    # Rewrites the progress line of the running call on standard error, or clears it if elapsed is None.
+    #
+    def show_progress(self, elapsed, steps):
+        if elapsed is None:
+            line = ""
+        else:
+            line = "  running... {:.1f} s, {:,} steps (Ctrl-C to cancel)".format(elapsed, steps)
+
+        sys.stderr.write("\r{:<70}\r{}".format("", line))
+        sys.stderr.flush()
+
+    #
+    # run
+    #
+    # Calls function(*args) on the worker thread and returns its result. Raises QueryCancelled if the user pressed
+    # Ctrl-C or the command ran out of time while waiting for it.
+    #
+    def run(self, function, *args):
+        future = self.pool.submit(function, *args)
+        start = time.perf_counter()
+        steps = self.steps
+        shown = False
+        reason = None
+
+        try:
+            while reason is None:
+                elapsed = time.perf_counter() - start
+                wait = PROGRESS_REFRESH
+
+                if self.timeout > 0:
+                    wait = min(wait, self.timeout - self.spent - elapsed)
+
+                    if wait <= 0:
+                        reason = "**Query timed out after {:g} seconds...".format(self.timeout)
+                        break
+
+                try:
+                    return future.result(timeout=wait)
+                except concurrent.futures.TimeoutError:
+                    if self.showProgress and elapsed >= PROGRESS_DELAY:
+                        self.show_progress(elapsed, self.steps - steps)
+                        shown = True
+                except KeyboardInterrupt:
+                    reason = "**Query cancelled..."
+
+            self.dbConn.interrupt()
+            concurrent.futures.wait([future])
+            raise QueryCancelled(reason)
+        finally:
+            self.spent += time.perf_counter() - start
+
+            if shown:
+                self.show_progress(None, 0)
+
+#
+# BackgroundConnection / BackgroundCursor
+#
+# A connection whose cursors run their executes and fetches through the query runner when there is one.
+#
+class BackgroundCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return run_query(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return run_query(super().executemany, sql, parameters)
+
+    def executescript(self, script):
+        return run_query(super().executescript, script)
+
+    def fetchone(self):
+        return run_query(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return run_query(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return run_query(super().fetchall)
+
+class BackgroundConnection(sqlite3.Connection):
+    def cursor(self, factory=BackgroundCursor):
+        return super().cursor(factory)
+
+#
+# run_query
+#
+# Calls function(*args) through the query runner, or directly if there is none.
+#
+def run_query(function, *args):
+    if queryRunner is None:
+        return function(*args)
+
+    return queryRunner.run(function, *args)
+
+#
+# use_query_runner
+#
+# Starts running the SQL calls made through the given connection (opened with BackgroundConnection or
+# TracedConnection, and check_same_thread=False) in the background, with the given time budget per command in seconds
+# (0 for none).
+#
+def use_query_runner(dbConn, timeout):
+    global queryRunner
+
+    queryRunner = QueryRunner(dbConn, timeout)
+
+#
+# Tracing
+#
+# With --trace FILE every SQL statement and every command is timed. The connection is opened with TracedConnection,
+# whose cursors time each execute and the fetches that follow it, and count the rows returned. The statement text (with
+# its bound parameters) comes from the connection's trace callback, and the number of SQLite virtual machine steps from
+# a progress handler that fires every TRACE_STEP_INTERVAL steps. Each statement is recorded under the command that ran
+# it. The trace is written as a Chrome trace (open it in chrome://tracing or Perfetto) or as JSON Lines, and a summary
+# table is printed to standard error at exit.
+#
+tracer = None
+
+TRACE_STEP_INTERVAL = 100
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.command = "(startup)"
+        self.commands = []
+        self.statements = []
+        self.steps = 0
+        self.sql = None
+
+    def count_steps(self):
+        self.steps += TRACE_STEP_INTERVAL
+        return 0
+
+    def trace_sql(self, sql):
+        self.sql = sql
+
+    #
+    # start_statement
+    #
+    # Returns a new record for a statement about to be run under the current command.
+    #
+    def start_statement(self, sql):
+        start = time.perf_counter()
+        record = {"command": self.command, "sql": " ".join(sql.split()), "text": None, "start": start, "end": start,
+                  "sqlite_ms": 0, "rows": 0, "vm_steps": 0}
+
+        self.statements.append(record)
+        self.sql = None
+
+        return record
+
+    #
+    # measure
+    #
+    # Calls function(*args) on behalf of the given statement record, adding the time and VM steps it took to the record.
+    #
+    def measure(self, record, function, *args):
+        steps = self.steps
+        start = time.perf_counter()
+
+        try:
+            return function(*args)
+        finally:
+            record["end"] = time.perf_counter()
+            record["sqlite_ms"] += (record["end"] - start) * 1000
+            record["vm_steps"] += self.steps - steps
+
+            if record["text"] is None and self.sql is not None:
+                record["text"] = " ".join(self.sql.split())
+
+    #
+    # events
+    #
+    # Returns the trace as a list of events, commands and statements in the order they started, with times in
+    # milliseconds since the tracer was created.
+    #
+    def events(self):
+        events = []
+
+        for command in self.commands:
+            events.append({"type": "command", "name": command["name"],
+                           "start_ms": (command["start"] - self.origin) * 1000,
+                           "wall_ms": (command["end"] - command["start"]) * 1000})
+
+        for record in self.statements:
+            events.append({"type": "statement", "command": record["command"], "sql": record["text"] or record["sql"],
+                           "start_ms": (record["start"] - self.origin) * 1000,
+                           "wall_ms": (record["end"] - record["start"]) * 1000, "sqlite_ms": record["sqlite_ms"],
+                           "rows": record["rows"], "vm_steps": record["vm_steps"]})
+
+        return sorted(events, key=lambda event: event["start_ms"])
+
+    #
+    # write
+    #
+    # Writes the trace to the given path, as a Chrome trace or as one JSON object per line.
+    #
+    def write(self, path, traceFormat):
+        events = self.events()
+
+        with open(path, "w") as traceFile:
+            if traceFormat == "jsonl":
+                for event in events:
+                    traceFile.write(json.dumps(event) + "\n")
+                return
+
+            chromeEvents = []
+
+            for event in events:
+                chromeEvent = {"ph": "X", "pid": os.getpid(), "tid": 1, "ts": event["start_ms"] * 1000,
+                               "dur": event["wall_ms"] * 1000}
+
+                if event["type"] == "command":
+                    chromeEvent.update({"name": event["name"], "cat": "command"})
+                else:
+                    chromeEvent.update({"name": event["sql"][:60], "cat": "sql",
+                                        "args": {name: event[name] for name in
+                                                 ["command", "sql", "sqlite_ms", "rows", "vm_steps"]}})
+
+                chromeEvents.append(chromeEvent)
+
+            json.dump({"traceEvents": chromeEvents, "displayTimeUnit": "ms"}, traceFile)
+
+    #
+    # summary
+    #
+    # Prints the time, statements, rows and VM steps of every command, and the statements that took the longest in
+    # total, to standard error.
+    #
+    def summary(self):
+        commands = {}
+
+        for command in self.commands:
+            totals = commands.setdefault(command["name"], [0, 0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += (command["end"] - command["start"]) * 1000
+
+        statements = {}
+
+        for record in self.statements:
+            totals = commands.setdefault(record["command"], [0, 0, 0, 0, 0])
+            totals[2] += 1
+            totals[3] += record["rows"]
+            totals[4] += record["vm_steps"]
+
+            totals = statements.setdefault(record["sql"], [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += record["sqlite_ms"]
+            totals[2] += record["rows"]
+            totals[3] += record["vm_steps"]
+
+        print("Trace summary:", file=sys.stderr)
+        print("  {:<16}{:>7}{:>12}{:>12}{:>10}{:>14}".format("command", "calls", "wall ms", "statements", "rows",
+                                                           "VM steps"), file=sys.stderr)
+
+        for name, totals in commands.items():
+            print("  {:<16}{:>7}{:>12.2f}{:>12}{:>10}{:>14,}".format(name, *totals), file=sys.stderr)
+
+        print("Slowest statements:", file=sys.stderr)
+        print("  {:>10}{:>7}{:>10}{:>14}  {}".format("sqlite ms", "calls", "rows", "VM steps", "sql"), file=sys.stderr)
+
+        for sql, totals in sorted(statements.items(), key=lambda item: item[1][1], reverse=True)[:10]:
+            print("  {:>10.2f}{:>7}{:>10}{:>14,}  {}".format(totals[1], totals[0], totals[2], totals[3], sql[:80]),
+                  file=sys.stderr)
+
+#
+# TracedConnection / TracedCursor
+#
+# A connection whose cursors record every statement they run with the tracer. Iterating a cursor and the fetch methods
+# count toward the statement the cursor last executed. The statements still run in the background when a query runner
+# is active.
+#
+class TracedCursor(BackgroundCursor):
+    record = None
+
+    def execute(self, sql, parameters=()):
+        self.record = tracer.start_statement(sql)
+        tracer.measure(self.record, super().execute, sql, parameters)
+        return self
+
+    def executemany(self, sql, parameters):
+        self.record = tracer.start_statement(sql)
+        tracer.measure(self.record, super().executemany, sql, parameters)
+        return self
+
+    def executescript(self, script):
+        self.record = tracer.start_statement(script)
+        tracer.measure(self.record, super().executescript, script)
+        return self
+
+    def fetchone(self):
+        row = tracer.measure(self.record, super().fetchone)
+
+        if row is not None:
+            self.record["rows"] += 1
+
+        return row
+
+    def fetchmany(self, size=None):
+        rows = tracer.measure(self.record, super().fetchmany, self.arraysize if size is None else size)
+        self.record["rows"] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = tracer.measure(self.record, super().fetchall)
+        self.record["rows"] += len(rows)
+        return rows
+
+    def __next__(self):
+        row = tracer.measure(self.record, super().__next__)
+        self.record["rows"] += 1
+        return row
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+#
+# use_tracer
+#
+# Starts tracing the statements run through the given TracedConnection.
+#
+def use_tracer(dbConn):
+    global tracer
+
+    tracer = Tracer()
+    dbConn.set_trace_callback(tracer.trace_sql)
+    dbConn.set_progress_handler(tracer.count_steps, TRACE_STEP_INTERVAL)
+
+#
+# traced_command
+#
+# Context manager that records the wall time of a command and the statements it runs, when tracing.
+#
+@contextlib.contextmanager
+def traced_command(name):
+    if tracer is None:
+        yield
+        return
+
+    previousCommand = tracer.command
+    tracer.command = name
+    command = {"name": name, "start": time.perf_counter()}
+
+    try:
+        yield
+    finally:
+        command["end"] = time.perf_counter()
+        tracer.commands.append(command)
+        tracer.command = previousCommand
+
+#
+# close_tracer
+#
+# Writes the trace file and prints the trace summary, when tracing.
+#
+def close_tracer(path, traceFormat):
+    if tracer is None:
+        return
+
+    tracer.write(path, traceFormat)
+    tracer.summary()
+
+#
+# Query result cache
+#
+# Analysts tend to repeat the same commands with the same inputs, and every repeat used to run the full SQL again. The
+# data functions below are wrapped with cached_query, which keeps their results in a bounded LRU cache keyed on the
+# function name and its parameters. The cache belongs to the connection it was created for: PRAGMA data_version only
+# means something on one connection, so calls made on any other connection (pooled or service connections) bypass the
+# cache. Before every lookup the cache checks data_version (which changes when another connection commits) and the
+# database file fingerprint (which also moves when this connection commits); if either of them moved the cache is
+# emptied. Writes to TEMP tables, such as the station index, change neither. With --persist-cache the cache is saved
+# next to the database (<database>.results.json) on exit and reloaded by the next session if the database file has not
+# changed in between.
+#
+resultCache = None
+
+class ResultCache:
+    def __init__(self, dbConn, capacity, path=None):
+        self.dbConn = dbConn
+        self.capacity = capacity
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    #
+    # validate
+    #
+    # Empties the cache if the data behind its connection may have changed since the last lookup.
+    #
+    def validate(self):
+        dbCursor = self.dbConn.cursor()
+        dbCursor.execute("PRAGMA data_version;")
+        dataVersion = dbCursor.fetchone()[0]
+        dbPath, fingerprint = database_fingerprint(self.dbConn)
+        version = [dataVersion, fingerprint]
+
+        if version != self.version:
+            if len(self.entries) > 0:
+                self.invalidations += 1
+                self.entries.clear()
+
+            self.version = version
+
+    #
+    # lookup
+    #
+    # Returns the cached result of function(dbConn, *args) on the cache's connection, running the function and caching
+    # its result on a miss. The least recently used result is evicted once the cache holds more than capacity results.
+    #
+    def lookup(self, function, args):
+        self.validate()
+        key = json.dumps([function.__name__, list(args)])
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        result = materialize(function(self.dbConn, *args))
+        self.entries[key] = result
+
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+        return result
+
+    #
+    # load / save
+    #
+    # Read and write the persisted cache. Saved results are only loaded back if they were computed against the same
+    # database file fingerprint. A cache file that cannot be read or written is simply ignored.
+    #
+    def load(self):
+        self.validate()
+
+        try:
+            with open(self.path) as cacheFile:
+                cache = json.load(cacheFile)
+
+            if cache["fingerprint"] == self.version[1]:
+                for key, result in cache["entries"][-self.capacity:]:
+                    self.entries[key] = result
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        try:
+            with open(self.path, "w") as cacheFile:
+                json.dump({"fingerprint": self.version[1], "entries": list(self.entries.items())}, cacheFile)
+        except (OSError, TypeError):
+            pass
+
+    #
+    # report
+    #
+    # Returns a one-line summary of the cache hits and misses.
+    #
+    def report(self):
+        lookups = self.hits + self.misses
+        hitRate = (self.hits / lookups) * 100 if lookups > 0 else 0
+
+        return "Result cache: {} hits, {} misses ({:.2f}% hit rate), {} evictions, {} invalidations, {} cached".format(
+            self.hits, self.misses, hitRate, self.evictions, self.invalidations, len(self.entries))
+
+#
+# materialize
+#
+# Returns the given result with any streamed rows (generators, also inside a tuple) read into lists, so it can be
+# cached.
+#
+def materialize(result):
+    if isinstance(result, types.GeneratorType):
+        return list(result)
+
+    if isinstance(result, tuple):
+        return tuple([materialize(part) for part in result])
+
+    return result
+
+#
+# cached_query
+#
+# Wraps a data function taking (dbConn, *parameters) so its results go through the result cache when one is in use for
+# that connection.
+#
+def cached_query(function):
+    @functools.wraps(function)
+    def cached_function(dbConn, *args):
+        if resultCache is None or dbConn is not resultCache.dbConn:
+            return function(dbConn, *args)
+
+        return resultCache.lookup(function, args)
+
+    return cached_function
+
+#
+# cached_listing
+#
+# Like cached_query, for data functions that stream the rows of a listing and take limit and offset parameters. Only
+# windows with a limit go through the result cache, since they hold a bounded number of rows. A whole listing streams
+# straight from its query, so it starts displaying at once instead of being read into a list to be cached first.
+#
+def cached_listing(function):
+    cachedFunction = cached_query(function)
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def listing_function(dbConn, *args):
+        if signature.bind(dbConn, *args).arguments.get("limit", -1) < 0:
+            return function(dbConn, *args)
+
+        return cachedFunction(dbConn, *args)
+
+    return listing_function
+
+#
+# use_result_cache
+#
+# Turns on the result cache with room for the given number of results, loading the persisted cache if persist is set.
+#
+def use_result_cache(dbConn, capacity, persist):
+    global resultCache
+
+    dbPath, fingerprint = database_fingerprint(dbConn)
+    path = dbPath + ".results.json" if persist and dbPath is not None else None
+    resultCache = ResultCache(dbConn, capacity, path)
+
+    if path is not None:
+        resultCache.load()
+
+#
+# close_result_cache
+#
+# Saves the result cache if it is persisted, and writes the hit/miss statistics to standard error if asked to.
+#
+def close_result_cache(showStats):
+    if resultCache is None:
+        return
+
+    if resultCache.path is not None:
+        resultCache.save()
+
+    if showStats:
+        print(resultCache.report(), file=sys.stderr)
+
+#
+# Listing output
+#
+# commandOne, commandThree, commandFour and commandFive list a row per station, stop or line. The queries of commandOne
+# and commandThree are read in fetchmany batches as the listing is written (commandFour and commandFive are served from
+# the dimension cache), and the lines go to standard output a block at a time instead of one print per row, so a
+# listing uses the same memory however long it is. --limit and --offset restrict a listing to a window of rows, which
+# is pushed down into the query where there is one. With --page-size the listing pauses after every page until the user
+# presses enter, or stops if they enter q. Only --limit windows go through the result cache (as lists).
+#
+FETCH_BATCH_SIZE = 500
+
+listingLimit = -1
+listingOffset = 0
+listingPageSize = 0
+
+#
+# stream_rows
+#
+# Yields the rows of the statement last executed on the cursor, fetching them in batches.
+#
+def stream_rows(dbCursor):
+    while True:
+        rows = dbCursor.fetchmany(FETCH_BATCH_SIZE)
+
+        if len(rows) == 0:
+            return
+
+        yield from rows
+
+#
+# write_listing
+#
+# Writes the given lines (each ending in a newline) to standard output a block or a page at a time, asking before each
+# new page when paging. Returns the number of lines written.
+#
+def write_listing(lines):
+    lines = iter(lines)
+    blockSize = listingPageSize if listingPageSize > 0 else FETCH_BATCH_SIZE
+    block = list(itertools.islice(lines, blockSize))
+    count = 0
+
+    while len(block) > 0:
+        sys.stdout.write("".join(block))
+        count += len(block)
+        block = list(itertools.islice(lines, blockSize))
+
+        if len(block) > 0 and listingPageSize > 0:
+            if input("-- more (press enter to continue, q to stop) --").lower() == 'q':
+                break
+
+    return count
+
+#
+# Query registry
+#
+# The queries behind the commands live in QUERIES under a name, with every value bound as a parameter instead of being
+# formatted into the SQL, and are run with execute_query. A query's text is therefore the same on every call, so sqlite3
+# prepares it once per connection and then reuses the prepared statement from the connection's statement cache, which
+# is sized to hold every registered query (STATEMENT_CACHE_SIZE) next to the other statements a session runs. Station
+# names and patterns containing quotes are matched like any other. execute_query counts how often each query runs and
+# on how many connections (--query-stats). sqlite3 does not expose its statement cache hits, so the number of reuses
+# shown is an upper bound: executions minus connections, which assumes no statement was evicted from a cache.
+#
+STATEMENT_CACHE_SIZE = 256
+
+QUERIES = {
+    "lookup_station": """
+                    SELECT Station_ID, Station_Name
+                    FROM Stations
+                    WHERE Station_Name LIKE ?
+                    LIMIT 2;
+                    """,
+    "find_stations": """
+                    SELECT Station_ID, Station_Name
+                    FROM Stations
+                    WHERE Station_Name LIKE ?
+                    ORDER BY Station_Name
+                    LIMIT ? OFFSET ?;
+                    """,
+    "day_type_ridership": """
+                    SELECT sum(Num_Riders)
+                    FROM Ridership
+                    JOIN Stations
+                    ON Ridership.Station_ID = Stations.Station_ID
+                    WHERE Station_Name = ? AND Type_of_Day = ?;
+                    """,
+    "weekday_total": """
+                    SELECT sum(Num_Riders)
+                    FROM Ridership
+                    JOIN Stations
+                    ON Ridership.Station_ID = Stations.Station_ID
+                    WHERE Type_of_Day = 'W';
+                    """,
+    "weekday_ranking": """
+                    SELECT Station_Name, sum(Num_Riders)
+                    FROM Ridership
+                    JOIN Stations
+                    ON Ridership.Station_ID = Stations.Station_ID
+                    WHERE Type_of_Day = 'W'
+                    GROUP BY Station_Name
+                    ORDER BY sum(Num_Riders) DESC
+                    LIMIT ? OFFSET ?;
+                    """,
+    "line_colors": """
+                    SELECT Color
+                    FROM Lines;
+                    """,
+    "stop_count": """
+                    SELECT Count(*)
+                    FROM Stops;
+                    """,
+    "line_stops": """
+                    SELECT Color, Stops.Stop_ID, Stop_Name, Direction, ADA
+                    FROM Stops
+                    JOIN StopDetails
+                    ON Stops.Stop_ID = StopDetails.Stop_ID
+                    JOIN Lines
+                    ON StopDetails.Line_ID = Lines.Line_ID
+                    ORDER BY Stop_Name;
+                    """,
+    "yearly_ridership": """
+                    SELECT Year, sum(Num_Riders)
+                    FROM RidershipYearly
+                    WHERE Station_ID = ?
+                    GROUP BY Year
+                    ORDER BY Year;
+                    """,
+    "monthly_ridership": """
+                    SELECT Month, sum(Num_Riders)
+                    FROM RidershipMonthly
+                    WHERE Station_ID = ? AND Year = ?
+                    GROUP BY Month
+                    ORDER BY Month;
+                    """,
+    "daily_ridership": """
+                    SELECT Ride_Date, Num_Riders
+                    FROM RidershipDaily
+                    WHERE Station_ID = ? AND Ride_Date >= ? AND Ride_Date < ?
+                    ORDER BY Ride_Date;
+                    """,
+    "station_index_exists": """
+                    SELECT count(*)
+                    FROM sqlite_temp_master
+                    WHERE name = 'StopIndex';
+                    """,
+    "stops_in_box": """
+                    SELECT Station_Name, Latitude, Longitude
+                    FROM StopIndex
+                    JOIN StopLocations
+                    ON StopIndex.Stop_ID = StopLocations.Stop_ID
+                    WHERE Min_Latitude <= ? AND Max_Latitude >= ? AND Min_Longitude <= ? AND Max_Longitude >= ?
+                    ORDER BY Station_Name, StopLocations.Stop_ID;
+                    """,
+    "stops_within": """
+                    SELECT Station_ID, Station_Name, Latitude, Longitude
+                    FROM StopIndex
+                    JOIN StopLocations
+                    ON StopIndex.Stop_ID = StopLocations.Stop_ID
+                    WHERE Min_Latitude <= ? AND Max_Latitude >= ? AND Min_Longitude <= ? AND Max_Longitude >= ?;
+                    """,
+    "station_count": """
+                    SELECT count(DISTINCT Station_ID)
+                    FROM StopLocations;
+                    """,
+}
+
+queryExecutions = collections.Counter()
+queryConnections = collections.defaultdict(set)
+
+#
+# execute_query
+#
+# Runs the registered query with the given name and parameters on the cursor, and returns the cursor.
+#
+def execute_query(dbCursor, name, parameters=()):
+    queryExecutions[name] += 1
+    queryConnections[name].add(id(dbCursor.connection))
+
+    return dbCursor.execute(QUERIES[name], parameters)
+
+#
+# print_query_stats
+#
+# Prints how many times each registered query ran, on how many connections (so the least number of times it was
+# prepared) and the most times its prepared statement can have been reused, to standard error.
+#
+def print_query_stats():
+    print("Query registry ({} queries, {} cached statements per connection):".format(len(QUERIES),
+                                                                                    STATEMENT_CACHE_SIZE),
+          file=sys.stderr)
+    print("  {:<22}{:>12}{:>13}{:>12}".format("query", "executions", "connections", "reused <="), file=sys.stderr)
+
+    for name in QUERIES:
+        executions = queryExecutions[name]
+        connections = len(queryConnections[name])
+        print("  {:<22}{:>12}{:>13}{:>12}".format(name, executions, connections, executions - connections),
+              file=sys.stderr)
+
+    print("  (reused <= is an upper bound: executions minus connections, assuming no statement was evicted)",
+          file=sys.stderr)
+
+#
+# Station resolver
+#
+# commandSix, commandSeven and commandEight all need a station pattern to match exactly one station before they look at
+# its ridership. resolve_station does that lookup with a single query and remembers the result for each pattern, so
+# repeating a pattern in the same session costs a dictionary lookup. The remembered results are dropped whenever the
+# database fingerprint moves, so stations added by an ingest (in this process or another one) are found once it
+# commits.
+#
+stationCache = {}
+stationCacheVersion = None
+
+#
+# lookup_station
+#
+# Returns (Station_ID, Station_Name) for at most two stations whose name matches the given LIKE pattern, which is enough
+# to tell no match, exactly one match and multiple matches apart.
+#
+def lookup_station(dbConn, pattern):
+    global stationCacheVersion
+
+    dbPath, fingerprint = database_fingerprint(dbConn)
+
+    if fingerprint != stationCacheVersion:
+        stationCache.clear()
+        stationCacheVersion = fingerprint
+
+    if pattern not in stationCache:
+        dbCursor = dbConn.cursor()
+
+        execute_query(dbCursor, "lookup_station", (pattern,))
+
+        stationCache[pattern] = dbCursor.fetchall()
+
+    return stationCache[pattern]
+
+#
+# resolve_station
+#
+# Returns (Station_ID, Station_Name) for the single station whose name matches the given LIKE pattern. If no station or
+# more than one station matches, the matching error is printed and None is returned.
+#
+def resolve_station(dbConn, pattern):
+    result = lookup_station(dbConn, pattern)
+
+    if len(result) == 0:
+        print("**No station found...")
+        return None
+    elif len(result) > 1:
+        print("**Multiple stations found...")
+        return None
+
+    return result[0]
+
+#
+# find_stations
+#
+# Returns (Station_ID, Station_Name) for every station whose name matches the given LIKE pattern, ordered by name, as a
+# stream of rows. At most limit rows (all of them if negative) are returned, after skipping the first offset rows.
+#
+@cached_listing
+def find_stations(dbConn, pattern, limit=-1, offset=0):
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "find_stations", (pattern, limit, offset))
+
+    return stream_rows(dbCursor)
+
+#
+# commandOne
+#
+# Takes input from the user and then uses an SQL query to return all the station IDs and names that match the provided
+# input.
+#
+def commandOne(dbConn):
+    commandOneInput = input("Enter partial station name (wildcards _ and %):")
+    result = find_stations(dbConn, commandOneInput, listingLimit, listingOffset)
+
+    if write_listing("{} : {}\n".format(row[0], row[1]) for row in result) == 0:
+        print("**No stations found...")
+
+#
+# day_type_ridership
+#
+# Returns the weekday, Saturday and Sunday/holiday ridership at the station with the given name, or None if the station
+# has no weekday ridership.
+#
+@cached_query
+def day_type_ridership(dbConn, stationName):
+    if columnarEngine is not None:
+        return columnarEngine.day_type_ridership(stationName)
+
+    if partitionRouter is not None:
+        return partitionRouter.day_type_ridership(stationName)
+
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "day_type_ridership", (stationName, "W"))
+
+    result = dbCursor.fetchone()
+
+    if result[0] is None:
+        return None
+
+    weekdayRiders = result[0]
+
+    execute_query(dbCursor, "day_type_ridership", (stationName, "A"))
+
+    result = dbCursor.fetchone()
+
+    if result is None:
+        saturdayRiders = 0
+    else:
+        saturdayRiders = result[0]
+
+    execute_query(dbCursor, "day_type_ridership", (stationName, "U"))
+
+    result = dbCursor.fetchone()
+
+    if result is None:
+        sundayRiders = 0
+    else:
+        sundayRiders = result[0]
+
+    return weekdayRiders, saturdayRiders, sundayRiders
+
+#
+# commandTwo
+#
+# Takes in a station name provided by the user and then outputs the weekday, saturday, sunday/holiday, and total
+# ridership and percentages at that station.
+#
+def commandTwo(dbConn):
+    commandTwoInput = input("Enter the name of the station you would like to analyze:")
+    result = day_type_ridership(dbConn, commandTwoInput)
+
+    if result is None:
+        print("**No data found...")
+        return
+
+    weekdayRiders, saturdayRiders, sundayRiders = result
+    totalRiders = weekdayRiders + saturdayRiders + sundayRiders
+    weekdayPercentage = (weekdayRiders / totalRiders) * 100
+    saturdayPercentage = (saturdayRiders / totalRiders) * 100
+    sundayPercentage = (sundayRiders / totalRiders) * 100
+
+    print("Percentage of ridership for the {} station:".format(commandTwoInput))
+    print("  Weekday ridership:", f"{weekdayRiders:,}", f"({weekdayPercentage:.2f}%)")
+    print("  Saturday ridership:", f"{saturdayRiders:,}", f"({saturdayPercentage:.2f}%)")
+    print("  Sunday/holiday ridership:", f"{sundayRiders:,}", f"({sundayPercentage:.2f}%)")
+    print("  Total ridership:", f"{totalRiders:,}")
+
+#
+# weekday_ranking
+#
+# Returns the total weekday ridership and (Station_Name, weekday ridership) for every station, busiest first, as a
+# stream of rows. At most limit rows (all of them if negative) are returned, after skipping the first offset rows.
+#
+@cached_listing
+def weekday_ranking(dbConn, limit=-1, offset=0):
+    if columnarEngine is not None:
+        return columnarEngine.weekday_ranking(limit, offset)
+
+    if partitionRouter is not None:
+        return partitionRouter.weekday_ranking(limit, offset)
+
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "weekday_total")
+
+    result = dbCursor.fetchone()
+    totalWeekdayRidership = result[0]
+
+    execute_query(dbCursor, "weekday_ranking", (limit, offset))
+
+    return totalWeekdayRidership, stream_rows(dbCursor)
+
+#
+# commandThree
+#
+# Outputs the total ridership and percentages of every station on weekdays in descending order by ridership.
+#
+def commandThree(dbConn):
+    print("Ridership on Weekdays for Each Station")
+    totalWeekdayRidership, result = weekday_ranking(dbConn, listingLimit, listingOffset)
+
+    write_listing("{} : {:,} ({:.2f}%)\n".format(row[0], row[1], (row[1] / totalWeekdayRidership) * 100)
+                  for row in result)
+
+#
+# Dimension cache
+#
+# Lines, Stops and StopDetails are tiny and do not change while the program runs, so commandFour and commandFive serve
+# them from memory instead of joining the three tables on every call. The join is read once into StopRecord objects and
+# indexed by line color and then direction, with every direction's stops sorted by name. Line colors are looked up in
+# the Lines table instead of a fixed list of colors.
+#
+dimensions = None
+
+class StopRecord:
+    __slots__ = ("stopID", "stopName", "direction", "ada")
+
+    def __init__(self, stopID, stopName, direction, ada):
+        self.stopID = stopID
+        self.stopName = stopName
+        self.direction = direction
+        self.ada = ada
+
+class Dimensions:
+    __slots__ = ("colors", "lines", "lineCounts", "totalStops")
+
+    def __init__(self, dbConn):
+        dbCursor = dbConn.cursor()
+
+        execute_query(dbCursor, "line_colors")
+
+        self.colors = {row[0].lower(): row[0] for row in dbCursor.fetchall()}
+
+        execute_query(dbCursor, "stop_count")
+
+        self.totalStops = dbCursor.fetchone()[0]
+
+        execute_query(dbCursor, "line_stops")
+
+        self.lines = {}
+
+        for color, stopID, stopName, direction, ada in dbCursor.fetchall():
+            self.lines.setdefault(color, {}).setdefault(direction, []).append(
+                StopRecord(stopID, stopName, direction, ada))
+
+        self.lineCounts = sorted([(color, direction, len(stops)) for color, directions in self.lines.items()
+                                  for direction, stops in directions.items()])
+
+#
+# load_dimensions
+#
+# Returns the dimension cache, reading it from the database the first time it is needed.
+#
+def load_dimensions(dbConn):
+    global dimensions
+
+    if dimensions is None:
+        dimensions = Dimensions(dbConn)
+
+    return dimensions
+
+#
+# window
+#
+# Returns the rows of a list that a listing with the given limit (all of them if negative) and offset shows.
+#
+def window(rows, limit, offset):
+    return rows[offset:] if limit < 0 else rows[offset:offset + limit]
+
+#
+# normalize_line_color / normalize_direction
+#
+# Return the line color or direction the way it is stored in the database, or None if it is not a valid one.
+#
+def normalize_line_color(dbConn, lineColor):
+    return load_dimensions(dbConn).colors.get(lineColor.lower())
+
+def normalize_direction(direction):
+    direction = direction.upper()
+
+    if direction != "N" and direction != "S" and direction != "W" and direction != "E":
+        return None
+
+    return direction
+
+#
+# line_stops
+#
+# Returns (Stop_Name, Direction, ADA) for every stop on the given line color going in the given direction, ordered by
+# stop name. At most limit rows (all of them if negative) are returned, after skipping the first offset rows.
+#
+def line_stops(dbConn, lineColor, direction, limit=-1, offset=0):
+    stops = load_dimensions(dbConn).lines.get(lineColor, {}).get(direction, [])
+
+    return [(stop.stopName, stop.direction, stop.ada) for stop in window(stops, limit, offset)]
+
+#
+# commandFour
+#
+# Takes in a line color and direction as input from the user, and then outputs all the stops that are in the line color
+# and go in the specified direction, as well as outputting whether it is handicap accessible.
+#
+def commandFour(dbConn):
+    lineColor = input("Enter a line color (e.g. Red or Yellow):")
+    lineColor = normalize_line_color(dbConn, lineColor)
+
+    if lineColor is None:
+        print("**No such line...")
+        return
+
+    direction = input("Enter a direction (N/S/W/E):")
+    direction = normalize_direction(direction)
+
+    if direction is None:
+        print("**That line does not run in the direction chosen...")
+        return
+
+    result = line_stops(dbConn, lineColor, direction, listingLimit, listingOffset)
+    lines = ("{} : direction = {} ({}handicap accessible)\n".format(row[0], row[1], "" if row[2] == 1 else "not ")
+             for row in result)
+
+    if write_listing(lines) == 0:
+        print("**That line does not run in the direction chosen...")
+
+#
+# stops_by_line
+#
+# Returns the total number of stops and (Color, Direction, number of stops) for every line color and direction, ordered
+# by color and then direction. At most limit rows (all of them if negative) are returned, after skipping the first
+# offset rows.
+#
+def stops_by_line(dbConn, limit=-1, offset=0):
+    lineDimensions = load_dimensions(dbConn)
+
+    return lineDimensions.totalStops, window(lineDimensions.lineCounts, limit, offset)
+
+#
+# commandFive
+#
+# Outputs the number of stops of each line color and direction, both being grouped together. They are sorted in
+# ascending order by color and then direction, and it also outputs the percentages relative to the total number of
+# stops.
+#
+def commandFive(dbConn):
+    print("Number of Stops For Each Color By Direction")
+    totalStops, result = stops_by_line(dbConn, listingLimit, listingOffset)
+
+    write_listing("{} going {} : {} ({:.2f}%)\n".format(row[0], row[1], row[2], (row[2] / totalStops) * 100)
+                  for row in result)
+
+#
+# yearly_ridership
+#
+# Returns (year, ridership) for every year with ridership at the given station, in order.
+#
+@cached_query
+def yearly_ridership(dbConn, stationID):
+    if columnarEngine is not None:
+        return columnarEngine.yearly_ridership(stationID)
+
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "yearly_ridership", (stationID,))
+
+    return dbCursor.fetchall()
+
+#
+# commandSix
+#
+# Takes in the user's input and if it matches exactly one station, the program will output the yearly ridership at that
+# station. The user is also prompted to plot this data, and if they press 'y', a plot will be generated and shown to
+# them.
+#
+def commandSix(dbConn):
+    commandSixInput = input("Enter a station name (wildcards _ and %):")
+    station = resolve_station(dbConn, commandSixInput)
+
+    if station is None:
+        return
+
+    stationID, stationName = station
+    print("Yearly Ridership at", stationName)
+
+    x = []
+    y = []
+
+    for row in yearly_ridership(dbConn, stationID):
+        print(row[0], ":", f"{row[1]:,}")
+        x.append(row[0])
+        y.append(row[1])
+
+    plotInput = input("Plot? (y/n)")
+    plotInput = plotInput.lower()
+
+    if plotInput == 'y':
+        show_chart(draw_yearly_chart, stationName, x, y)
+
+#
+# monthly_ridership
+#
+# Returns (month, ridership) for every month with ridership at the given station in the given year, in order. Months
+# are two-digit strings.
+#
+@cached_query
+def monthly_ridership(dbConn, stationID, year):
+    if columnarEngine is not None:
+        return columnarEngine.monthly_ridership(stationID, year)
+
+    if partitionRouter is not None:
+        return partitionRouter.monthly_ridership(stationID, year)
+
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "monthly_ridership", (stationID, year))
+
+    return dbCursor.fetchall()
+
+#
+# commandSeven
+#
+# Takes in the user's input for a station if it matches exactly one station, and also takes in the user's input for
+# a year. The program then outputs the monthly ridership of that station on that given year, and also plots this data
+# if the user says that they want a plot.
+#
+def commandSeven(dbConn):
+    commandSevenInput = input("Enter a station name (wildcards _ and %):")
+    station = resolve_station(dbConn, commandSevenInput)
+
+    if station is None:
+        return
+
+    stationID, stationName = station
+    year = input("Enter a year:")
+    print("Monthly Ridership at " + stationName + " for " + year)
+
+    x = []
+    y = []
+
+    for row in monthly_ridership(dbConn, stationID, year):
+        print(row[0] + "/" + year + " : " + f"{row[1]:,}")
+        x.append(row[0])
+        y.append(row[1])
+
+    plotInput = input("Plot? (y/n)")
+    plotInput = plotInput.lower()
+
+    if plotInput == 'y':
+        show_chart(draw_monthly_chart, stationName, year, x, y)
+
+#
+# daily_ridership
+#
+# Returns (date, ridership) for every day with ridership at the given station in the given year, in date order.
+#
+@cached_query
+def daily_ridership(dbConn, stationID, year):
+    if columnarEngine is not None:
+        return columnarEngine.daily_ridership(stationID, year)
+
+    if partitionRouter is not None:
+        return partitionRouter.daily_ridership(stationID, year)
+
+    dbCursor = dbConn.cursor()
+    yearStart, yearEnd = year_range(year)
+
+    execute_query(dbCursor, "daily_ridership", (stationID, yearStart, yearEnd))
+
+    return dbCursor.fetchall()
+
+#
+# compare_stations
+#
+# Fetches the daily ridership of each of the given (Station_ID, Station_Name) stations in the given year once, and joins
+# the series on the actual date. Returns each station's own daily rows and the aligned table: every date that any of the
+# stations has ridership for, with one value per station (None where that station has no row for the date).
+#
+def compare_stations(dbConn, stations, year):
+    series = [daily_ridership(dbConn, stationID, year) for stationID, stationName in stations]
+    lookups = [dict(rows) for rows in series]
+    dates = sorted(set([date for lookup in lookups for date in lookup]))
+    aligned = [(date, [lookup.get(date) for lookup in lookups]) for date in dates]
+
+    return series, aligned
+
+#
+# commandEight
+#
+# Takes in a user's input for a year, and then two station names that correspond to exactly one station. The program
+# then outputs the ridership on that year for the first and last 5 days at each of those stations, and if the user wants
+# a plot, the program will plot out the ridership for that entire year at both of the stations. Each station's year is
+# fetched once, and the plotted series are lined up by date, with gaps where a station has no data for a day.
+#
+def commandEight(dbConn):
+    year = input("Year to compare against?")
+    stations = []
+
+    for number in [1, 2]:
+        commandEightInput = input("Enter station {} (wildcards _ and %):".format(number))
+        station = resolve_station(dbConn, commandEightInput)
+
+        if station is None:
+            return
+
+        stations.append(station)
+
+    series, aligned = compare_stations(dbConn, stations, year)
+
+    for number, (station, rows) in enumerate(zip(stations, series), start=1):
+        print("Station {}:".format(number), station[0], station[1])
+
+        for row in rows[:5]:
+            print(row[0], row[1])
+
+        for row in rows[-5:]:
+            print(row[0], row[1])
+
+    x = [datetime.date.fromisoformat(date).timetuple().tm_yday for date, values in aligned]
+    y = [(station[1], [math.nan if values[i] is None else values[i] for date, values in aligned])
+         for i, station in enumerate(stations)]
+
+    plotInput = input("Plot? (y/n)")
+    plotInput = plotInput.lower()
+
+    if plotInput == 'y':
+        show_chart(draw_daily_chart, year, x, y)
+
+#
+# Columnar engine
+#
+# An optional in-memory engine for analytical sessions (--engine numpy). It loads Ridership once into compact NumPy
+# arrays sorted by station and day (int32 Station_ID, int32 day ordinal, uint8 type of day, int32 riders) and answers
+# the aggregations behind commands 2, 3, 6, 7, 8, 11, 12 and 14 with vectorized group-bys instead of SQL. Because the
+# rows of a station are contiguous, a station's rows are found with a binary search and each group-by is a single
+# np.add.reduceat over sorted runs. The engine is a snapshot of the data at load time. Missing rider counts are loaded
+# as 0 and flagged in the counted column, and totals are accumulated as int64 so results are identical to the SQLite
+# path.
+#
+columnarEngine = None
+
+DAY_TYPE_CODES = {"W": 0, "A": 1, "U": 2}
+
+# date(1970, 1, 1).toordinal(), to turn day ordinals into numpy datetime64 days
+EPOCH_ORDINAL = 719163
+
+#
+# load_numpy
+#
+# Imports numpy the first time the columnar engine is used, so sessions that never use it do not pay for the import.
+#
+def load_numpy():
+    import numpy
+    return numpy
+
+#
+# runs_sum
+#
+# Given sorted keys and matching values, returns each distinct key and the sum of its values.
+#
+def runs_sum(np, keys, values):
+    if len(keys) == 0:
+        return keys, values.astype(np.int64)
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    return keys[starts], np.add.reduceat(values.astype(np.int64), starts)
+
+#
+# load_ridership_columns
+#
+# Reads Ridership into the columns of the columnar engine, sorted by station and day, and the station dictionary
+# (Station_ID, Station_Name ordered by Station_ID). Returns a dictionary of the columns and the station dictionary.
+#
+def load_ridership_columns(dbConn):
+    np = load_numpy()
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT count(*)
+                    FROM Ridership;
+                    """)
+
+    count = dbCursor.fetchone()[0]
+    columns = np.zeros((count, 5), dtype=np.int64)
+
+    dbCursor.execute("""
+                    SELECT Station_ID, {}, CASE Type_of_Day WHEN 'W' THEN 0 WHEN 'A' THEN 1 WHEN 'U' THEN 2 ELSE 3 END,
+                        coalesce(Num_Riders, 0), Num_Riders IS NOT NULL
+                    FROM Ridership;
+                    """.format(ORDINAL_EXPRESSION.format("Ride_Date")))
+
+    loaded = 0
+
+    while True:
+        rows = dbCursor.fetchmany(100000)
+
+        if len(rows) == 0:
+            break
+
+        columns[loaded:loaded + len(rows)] = rows
+        loaded = loaded + len(rows)
+
+    columns = columns[:loaded]
+    order = np.lexsort((columns[:, 1], columns[:, 0]))
+    columns = columns[order]
+
+    stations = columns[:, 0].astype(np.int32)
+    stationIDs, stationStarts = np.unique(stations, return_index=True)
+
+    dbCursor.execute("""
+                    SELECT Station_ID, Station_Name
+                    FROM Stations
+                    ORDER BY Station_ID;
+                    """)
+
+    stationNames = dbCursor.fetchall()
+
+    return {"stations": stations, "days": columns[:, 1].astype(np.int32), "dayTypes": columns[:, 2].astype(np.uint8),
+            "riders": columns[:, 3].astype(np.int32), "counted": columns[:, 4].astype(np.uint8),
+            "stationIDs": stationIDs, "stationStarts": stationStarts,
+            "stationEnds": np.append(stationStarts[1:], len(stations))}, stationNames
+
+#
+# ColumnarRidership
+#
+# The columnar engine. day_type_ridership, weekday_ranking, yearly_ridership, monthly_ridership and daily_ridership
+# return exactly what the data functions of the same name return from SQLite. The columns are either read from the
+# database or mapped from a snapshot file.
+#
+class ColumnarRidership:
+    def __init__(self, columns, stationNames):
+        self.np = load_numpy()
+        self.stations = columns["stations"]
+        self.days = columns["days"]
+        self.dayTypes = columns["dayTypes"]
+        self.riders = columns["riders"]
+        self.counted = columns["counted"]
+        self.stationIDs = columns["stationIDs"]
+        self.stationStarts = columns["stationStarts"]
+        self.stationEnds = columns["stationEnds"]
+        self.stationNames = stationNames
+
+    #
+    # station_slice
+    #
+    # Returns the range of row positions that belong to the given station (empty if it has no rows).
+    #
+    def station_slice(self, stationID):
+        i = self.np.searchsorted(self.stationIDs, stationID)
+
+        if i == len(self.stationIDs) or self.stationIDs[i] != stationID:
+            return slice(0, 0)
+
+        return slice(int(self.stationStarts[i]), int(self.stationEnds[i]))
+
+    #
+    # year_slice
+    #
+    # Returns the range of row positions of the given station in the given year ('YYYY'), or an empty range if the year
+    # is not a four digit year.
+    #
+    def year_slice(self, stationID, year):
+        rows = self.station_slice(stationID)
+
+        if len(year) != 4 or not year.isdigit() or year == "0000":
+            return slice(0, 0)
+
+        first = datetime.date(int(year), 1, 1).toordinal()
+        last = datetime.date(int(year), 12, 31).toordinal()
+        days = self.days[rows]
+
+        return slice(rows.start + int(self.np.searchsorted(days, first)),
+                     rows.start + int(self.np.searchsorted(days, last, side="right")))
+
+    def to_dates(self, days):
+        return (days.astype(self.np.int64) - EPOCH_ORDINAL).astype("datetime64[D]")
+
+    def day_type_ridership(self, stationName):
+        np = self.np
+        rows = [self.station_slice(stationID) for stationID, name in self.stationNames if name == stationName]
+        dayTypes = np.concatenate([self.dayTypes[r] for r in rows] + [np.zeros(0, dtype=np.uint8)])
+        riders = np.concatenate([self.riders[r] for r in rows] + [np.zeros(0, dtype=np.int32)]).astype(np.int64)
+
+        totals = []
+
+        for dayType in ["W", "A", "U"]:
+            matches = dayTypes == DAY_TYPE_CODES[dayType]
+            totals.append(int(riders[matches].sum()) if matches.any() else None)
+
+        if totals[0] is None:
+            return None
+
+        return tuple(totals)
+
+    def weekday_ranking(self, limit=-1, offset=0):
+        np = self.np
+        if len(self.stationNames) == 0:
+            return None, []
+
+        # rows only count if their station is in Stations, like the join in the SQL query
+        knownIDs = np.array([stationID for stationID, name in self.stationNames], dtype=np.int64)
+        names = sorted(set([name for stationID, name in self.stationNames]))
+        nameNumbers = {name: i for i, name in enumerate(names)}
+        nameIndex = np.array([nameNumbers[name] for stationID, name in self.stationNames], dtype=np.int64)
+
+        positions = np.searchsorted(knownIDs, self.stations)
+        positions[positions == len(knownIDs)] = 0
+        rows = (self.dayTypes == DAY_TYPE_CODES["W"]) & (knownIDs[positions] == self.stations)
+
+        if not rows.any():
+            return None, []
+
+        riders = self.riders[rows].astype(np.int64)
+        groups = nameIndex[positions[rows]]
+        sums = np.zeros(len(names), dtype=np.int64)
+        np.add.at(sums, groups, riders)
+        present = np.bincount(groups, minlength=len(names)) > 0
+
+        ranking = [(names[i], int(sums[i])) for i in np.flatnonzero(present)]
+        ranking.sort(key=lambda row: (-row[1], row[0]))
+
+        return int(riders.sum()), ranking[offset:] if limit < 0 else ranking[offset:offset + limit]
+
+    def yearly_ridership(self, stationID):
+        rows = self.station_slice(stationID)
+        years = self.to_dates(self.days[rows]).astype("datetime64[Y]").astype(self.np.int64) + 1970
+        keys, sums = runs_sum(self.np, years, self.riders[rows])
+
+        return [("{:04d}".format(key), total) for key, total in zip(keys.tolist(), sums.tolist())]
+
+    def monthly_ridership(self, stationID, year):
+        rows = self.year_slice(stationID, year)
+        months = self.to_dates(self.days[rows]).astype("datetime64[M]").astype(self.np.int64) % 12 + 1
+        keys, sums = runs_sum(self.np, months, self.riders[rows])
+
+        return [("{:02d}".format(key), total) for key, total in zip(keys.tolist(), sums.tolist())]
+
+    def daily_ridership(self, stationID, year):
+        rows = self.year_slice(stationID, year)
+        keys, sums = runs_sum(self.np, self.days[rows], self.riders[rows])
+        dates = self.np.datetime_as_string(self.to_dates(keys), unit="D")
+
+        return list(zip(dates.tolist(), sums.tolist()))
+
+    def prefix_sums(self, stationID):
+        np = self.np
+        rows = self.station_slice(stationID)
+        days = self.days[rows]
+
+        if len(days) == 0:
+            return 0, np.zeros((len(ALL_DAY_TYPES), 1), dtype=np.int64)
+
+        first = int(days[0])
+        daily = np.zeros((len(ALL_DAY_TYPES), int(days[-1]) - first + 1), dtype=np.int64)
+        np.add.at(daily, (self.dayTypes[rows], days - first), self.riders[rows])
+
+        return first, np.concatenate([np.zeros((len(ALL_DAY_TYPES), 1), dtype=np.int64), daily.cumsum(axis=1)], axis=1)
+
+    def daily_matrix(self, stationIDs, first, last):
+        np = self.np
+        matrix = np.full((len(stationIDs), last - first + 1), np.nan)
+
+        for row, stationID in enumerate(stationIDs):
+            rows = self.station_slice(stationID)
+            days = self.days[rows]
+            rows = slice(rows.start + int(np.searchsorted(days, first)),
+                         rows.start + int(np.searchsorted(days, last, side="right")))
+            keys, sums = runs_sum(np, self.days[rows], self.riders[rows])
+            matrix[row, keys - first] = sums
+
+        return matrix
+
+    def network_day_types(self):
+        np = self.np
+        knownIDs = np.array([stationID for stationID, name in self.stationNames], dtype=np.int64)
+
+        if len(knownIDs) == 0:
+            return []
+
+        positions = np.searchsorted(knownIDs, self.stations)
+        positions[positions == len(knownIDs)] = 0
+        rows = (knownIDs[positions] == self.stations) & (self.dayTypes < 3)
+        groups = positions[rows] * 3 + self.dayTypes[rows]
+        sums = np.zeros(len(knownIDs) * 3, dtype=np.int64)
+        np.add.at(sums, groups, self.riders[rows].astype(np.int64))
+        present = np.bincount(positions[rows], minlength=len(knownIDs)) > 0
+        sums = sums.reshape(-1, 3).tolist()
+
+        return [(self.stationNames[i][0], self.stationNames[i][1], *sums[i]) for i in np.flatnonzero(present)]
+
+#
+# Columnar snapshots
+#
+# The columns of the engine can be exported to a snapshot file (--export-snapshot) and mapped back in by any later
+# session (--snapshot) instead of being read from Ridership. The file is an 8-byte magic, a little-endian uint32 header
+# length and a JSON header (format version, data version, station dictionary and the dtype, offset and length of every
+# column), followed by the columns as fixed-width little-endian arrays aligned to 64 bytes. The reader maps the file
+# read-only and wraps the columns with np.frombuffer, so nothing is copied or parsed: a snapshot opens in milliseconds
+# whatever its size, its pages are read on first use, and processes mapping the same file share them through the page
+# cache. The data version is the change count in RidershipVersion, which the rollup triggers move on every change to
+# Ridership, so a snapshot taken before the data changed is detected and ignored.
+#
+SNAPSHOT_MAGIC = b"CTACOLS\0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ALIGNMENT = 64
+
+SNAPSHOT_COLUMNS = [
+    ("stations", "<i4"),
+    ("days", "<i4"),
+    ("dayTypes", "u1"),
+    ("riders", "<i4"),
+    ("counted", "u1"),
+    ("stationIDs", "<i4"),
+    ("stationStarts", "<i8"),
+    ("stationEnds", "<i8"),
+]
+
+#
+# ridership_data_version
+#
+# Returns the version of the ridership data that snapshots, partitions and the caches are compared against: the change
+# count kept in RidershipVersion by the rollup triggers, which moves with every insert, delete and update of Ridership.
+#
+def ridership_data_version(dbConn):
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Version
+                    FROM RidershipVersion;
+                    """)
+
+    return dbCursor.fetchone()[0]
+
+#
+# write_snapshot
+#
+# Loads the columns of the engine from the database and writes them to a snapshot file. The file is written next to
+# its final name and renamed into place, so readers never map a half-written snapshot. Returns the number of rows.
+#
+def write_snapshot(dbConn, path):
+    np = load_numpy()
+    columns, stationNames = load_ridership_columns(dbConn)
+
+    header = {"version": SNAPSHOT_VERSION, "data": ridership_data_version(dbConn), "rows": len(columns["stations"]),
+              "stations": stationNames, "columns": {}}
+
+    arrays = []
+    offset = 0
+
+    for name, dtype in SNAPSHOT_COLUMNS:
+        array = np.ascontiguousarray(columns[name], dtype=dtype)
+        header["columns"][name] = {"dtype": dtype, "offset": offset, "count": len(array)}
+        arrays.append((offset, array))
+        offset = offset + array.nbytes
+        offset = offset + (-offset) % SNAPSHOT_ALIGNMENT
+
+    # column offsets are relative to the first aligned byte after the header
+    headerBytes = json.dumps(header).encode("utf-8")
+    start = len(SNAPSHOT_MAGIC) + 4 + len(headerBytes)
+    start = start + (-start) % SNAPSHOT_ALIGNMENT
+
+    tempPath = path + ".tmp"
+
+    with open(tempPath, "wb") as snapshotFile:
+        snapshotFile.write(SNAPSHOT_MAGIC)
+        snapshotFile.write(len(headerBytes).to_bytes(4, "little"))
+        snapshotFile.write(headerBytes)
+
+        for offset, array in arrays:
+            snapshotFile.seek(start + offset)
+            snapshotFile.write(array.tobytes())
+
+        snapshotFile.truncate(start + offset + array.nbytes)
+
+    os.replace(tempPath, path)
+    return header["rows"]
+
+#
+# read_snapshot
+#
+# Maps a snapshot file and returns its header, a dictionary of read-only column views into the mapping and the
+# station dictionary. Raises ValueError if the file is not a snapshot of a version this program reads.
+#
+def read_snapshot(path):
+    np = load_numpy()
+
+    with open(path, "rb") as snapshotFile:
+        mapping = mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    prefix = len(SNAPSHOT_MAGIC) + 4
+
+    if len(mapping) < prefix or mapping[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise ValueError("not a columnar snapshot")
+
+    headerLength = int.from_bytes(mapping[len(SNAPSHOT_MAGIC):prefix], "little")
+    header = json.loads(mapping[prefix:prefix + headerLength])
+
+    if header.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("unsupported snapshot version {}".format(header.get("version")))
+
+    start = prefix + headerLength
+    start = start + (-start) % SNAPSHOT_ALIGNMENT
+
+    # the views keep the mapping open for as long as the engine uses them
+    columns = {}
+
+    for name, dtype in SNAPSHOT_COLUMNS:
+        column = header["columns"][name]
+        columns[name] = np.frombuffer(mapping, dtype=column["dtype"], count=column["count"],
+                                      offset=start + column["offset"])
+
+    return header, columns, [tuple(station) for station in header["stations"]]
+
+#
+# export_snapshot
+#
+# Writes the snapshot file for --export-snapshot and reports its size and how long the export and a reload took.
+#
+def export_snapshot(dbConn, path):
+    start = time.perf_counter()
+
+    try:
+        rows = write_snapshot(dbConn, path)
+    except ImportError:
+        print("**NumPy is not installed, unable to export a snapshot...")
+        return False
+    except OSError as error:
+        print("**Unable to write the snapshot ({})...".format(error))
+        return False
+
+    exportTime = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    ColumnarRidership(*read_snapshot(path)[1:])
+    openTime = (time.perf_counter() - start) * 1000
+
+    print("Saved {:,} ride entries to {} ({:,} bytes) in {:.1f} ms, reopens in {:.2f} ms".format(
+        rows, path, os.path.getsize(path), exportTime, openTime))
+    return True
+
+#
+# use_columnar_engine
+#
+# Loads the columnar engine for this session so the ridership aggregations are answered from memory. With a snapshot
+# path the columns are mapped from the snapshot file, unless it cannot be read or is out of date, in which case they
+# are loaded from the database. Returns False (and keeps using SQLite) if numpy is not installed.
+#
+def use_columnar_engine(dbConn, snapshotPath=None):
+    global columnarEngine
+
+    try:
+        if snapshotPath:
+            try:
+                header, columns, stationNames = read_snapshot(snapshotPath)
+
+                if header["data"] == ridership_data_version(dbConn):
+                    columnarEngine = ColumnarRidership(columns, stationNames)
+                    return True
+
+                print("**Snapshot {} is out of date, loading from the database...".format(snapshotPath))
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                print("**Unable to read snapshot {} ({}), loading from the database...".format(snapshotPath, error))
+
+        columnarEngine = ColumnarRidership(*load_ridership_columns(dbConn))
+    except ImportError:
+        print("**NumPy is not installed, using SQLite...")
+        return False
+
+    return True
+
+#
+# benchmark_engine
+#
+# Times the aggregations behind commands 2, 3, 6, 7 and 8 on the SQLite path and on the columnar engine for the busiest
+# station and its latest year, checks that both return identical results and prints the speedup of each.
+#
+def benchmark_engine(dbConn):
+    global columnarEngine
+
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Stations.Station_ID, Station_Name
+                    FROM Stations
+                    JOIN RidershipYearly
+                    ON Stations.Station_ID = RidershipYearly.Station_ID
+                    ORDER BY Num_Riders DESC LIMIT 1;
+                    """)
+
+    row = dbCursor.fetchone()
+
+    if row is None:
+        print("**No ridership data to benchmark...")
+        return
+
+    stationID, stationName = row
+
+    dbCursor.execute("""
+                    SELECT max(Year)
+                    FROM RidershipYearly
+                    WHERE Station_ID = ?;
+                    """, (stationID,))
+
+    year = dbCursor.fetchone()[0]
+
+    commands = [
+        ("commandTwo", lambda: day_type_ridership(dbConn, stationName)),
+        ("commandThree", lambda: materialize(weekday_ranking(dbConn))),
+        ("commandSix", lambda: yearly_ridership(dbConn, stationID)),
+        ("commandSeven", lambda: monthly_ridership(dbConn, stationID, year)),
+        ("commandEight", lambda: daily_ridership(dbConn, stationID, year)),
+    ]
+
+    def best_of_five(function):
+        best = None
+
+        for attempt in range(5):
+            start = time.perf_counter()
+            result = function()
+            elapsed = (time.perf_counter() - start) * 1000
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        return best, result
+
+    columnarEngine = None
+    sqliteResults = [best_of_five(function) for name, function in commands]
+
+    start = time.perf_counter()
+
+    if not use_columnar_engine(dbConn):
+        return
+
+    loadTime = (time.perf_counter() - start) * 1000
+    engineResults = [best_of_five(function) for name, function in commands]
+    columnarEngine = None
+
+    print("Columnar engine benchmark ({}, {}):".format(stationName, year))
+    print("  load: {:.1f} ms".format(loadTime))
+
+    for (name, function), (sqliteTime, sqliteResult), (engineTime, engineResult) in zip(commands, sqliteResults,
+                                                                                       engineResults):
+        print("  {}: {:.2f} ms -> {:.2f} ms ({:.1f}x){}".format(name, sqliteTime, engineTime, sqliteTime / engineTime,
+                                                                 "" if sqliteResult == engineResult else " MISMATCH"))
+
+#
+# Partitioned storage
+#
+# --partition DIR splits Ridership into one SQLite file per year (ridership-YYYY.db, holding that year's rows in a
+# Ridership table of the same shape, indexed for the station and the weekday queries) and writes PARTITION_MANIFEST
+# next to them: the data version of the database they were split from and, for every partition, its year, file, first
+# and last date, ride entries and total ridership. With --partitions DIR the data functions route their queries to the
+# partitions. Queries for one year (commands 7 and 8) read only that year's partition, full-history aggregates
+# (commands 2 and 3) run on every partition at once in worker processes and their partial sums are merged, and the ride
+# entry count, date range and total ridership of print_stats come straight from the manifest. Partitions that no longer
+# match the database are ignored, like an out of date snapshot.
+#
+partitionRouter = None
+
+PARTITION_MANIFEST = "manifest.json"
+PARTITION_VERSION = 1
+PARTITION_BATCH_SIZE = 100000
+
+PARTITION_SCHEMA = """
+                    CREATE TABLE Ridership (
+                        Station_ID INTEGER,
+                        Ride_Date TEXT,
+                        Type_of_Day TEXT,
+                        Num_Riders INTEGER
+                    );
+                    """
+
+PARTITION_INDEXES = [
+    # one station's days (commands 7 and 8)
+    "CREATE INDEX Ridership_Station ON Ridership (Station_ID, Ride_Date, Num_Riders);",
+    # sums per type of day (commands 2 and 3) read only this index
+    "CREATE INDEX Ridership_DayType ON Ridership (Type_of_Day, Station_ID, Num_Riders);",
+]
+
+PARTITION_QUERIES = {
+    "day_type_ridership": """
+                    SELECT Type_of_Day, sum(Num_Riders)
+                    FROM Ridership
+                    WHERE Type_of_Day IN ('W', 'A', 'U') AND Station_ID IN (SELECT value FROM json_each(?))
+                    GROUP BY Type_of_Day;
+                    """,
+    "weekday_ridership": """
+                    SELECT Station_ID, sum(Num_Riders)
+                    FROM Ridership
+                    WHERE Type_of_Day = 'W'
+                    GROUP BY Station_ID;
+                    """,
+    "monthly_ridership": """
+                    SELECT strftime('%m', Ride_Date), sum(Num_Riders)
+                    FROM Ridership
+                    WHERE Station_ID = ?
+                    GROUP BY strftime('%m', Ride_Date)
+                    ORDER BY strftime('%m', Ride_Date);
+                    """,
+    "daily_ridership": """
+                    SELECT date(Ride_Date), sum(Num_Riders)
+                    FROM Ridership
+                    WHERE Station_ID = ?
+                    GROUP BY date(Ride_Date)
+                    ORDER BY date(Ride_Date);
+                    """,
+}
+
+#
+# partition_query
+#
+# Runs one of PARTITION_QUERIES on a partition file, given as a (path, query name, parameters) task, and returns its
+# rows. Runs in the worker processes of the router as well as in the main process.
+#
+def partition_query(task):
+    path, name, parameters = task
+    partitionConn = sqlite3.connect(pathlib.Path(path).resolve().as_uri() + "?mode=ro", uri=True)
+
+    try:
+        dbCursor = partitionConn.cursor()
+        dbCursor.execute(PARTITION_QUERIES[name], parameters)
+        return dbCursor.fetchall()
+    finally:
+        partitionConn.close()
+
+#
+# PartitionRouter
+#
+# Answers the data functions it stands in for from the partitions described by a manifest, with exactly the results the
+# same functions return from the Ridership table. The worker processes are started when the router is created, before
+# the query runner or the service start their threads, so that they are never forked from a threaded process and every
+# thread shares the one pool.
+#
+class PartitionRouter:
+    def __init__(self, directory, manifest, stationNames, workers):
+        self.manifest = manifest
+        self.partitions = {partition["year"]: os.path.join(directory, partition["file"])
+                           for partition in manifest["partitions"]}
+        self.stationNames = stationNames
+        self.workers = workers
+        self.pool = None
+
+        if self.workers > 1 and len(self.partitions) > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            # the first task makes the pool start its worker processes now instead of on the first query
+            self.pool.submit(int).result()
+
+    #
+    # fan_out
+    #
+    # Runs the named partition query on every partition, in parallel worker processes if there is more than one
+    # worker, and returns the rows of each partition.
+    #
+    def fan_out(self, name, parameters):
+        tasks = [(path, name, parameters) for year, path in sorted(self.partitions.items())]
+
+        if self.pool is None or len(tasks) <= 1:
+            return [partition_query(task) for task in tasks]
+
+        return list(self.pool.map(partition_query, tasks))
+
+    def stats(self):
+        partitions = self.manifest["partitions"]
+
+        return {"entries": sum([partition["entries"] for partition in partitions]),
+                "riders": sum([partition["riders"] or 0 for partition in partitions]),
+                "first_date": min([partition["first_date"] for partition in partitions], default=None),
+                "last_date": max([partition["last_date"] for partition in partitions], default=None)}
+
+    def day_type_ridership(self, stationName):
+        stationIDs = [stationID for stationID, name in self.stationNames if name == stationName]
+        totals = {}
+
+        for rows in self.fan_out("day_type_ridership", (json.dumps(stationIDs),)):
+            for dayType, riders in rows:
+                if riders is not None:
+                    totals[dayType] = totals.get(dayType, 0) + riders
+
+        if "W" not in totals:
+            return None
+
+        return totals["W"], totals.get("A"), totals.get("U")
+
+    def weekday_ranking(self, limit=-1, offset=0):
+        names = dict(self.stationNames)
+        sums = {}
+
+        for rows in self.fan_out("weekday_ridership", ()):
+            for stationID, riders in rows:
+                if stationID in names and riders is not None:
+                    sums[names[stationID]] = sums.get(names[stationID], 0) + riders
+
+        if len(sums) == 0:
+            return None, []
+
+        ranking = sorted(sums.items(), key=lambda row: (-row[1], row[0]))
+        return sum(sums.values()), window(ranking, limit, offset)
+
+    def monthly_ridership(self, stationID, year):
+        if year not in self.partitions:
+            return []
+
+        return partition_query((self.partitions[year], "monthly_ridership", (stationID,)))
+
+    def daily_ridership(self, stationID, year):
+        year = "{:04d}".format(int(year)) if year.isdigit() else None
+
+        if year not in self.partitions:
+            return []
+
+        return partition_query((self.partitions[year], "daily_ridership", (stationID,)))
+
+#
+# partition_ridership
+#
+# Splits Ridership into one partition file per year in the given directory with a single pass over the table, and
+# writes the manifest. The old manifest is removed first, so partitions are never used half rewritten. Rows whose
+# Ride_Date does not start with a year are left out and counted.
+#
+def partition_ridership(dbConn, directory):
+    start = time.perf_counter()
+    manifestPath = os.path.join(directory, PARTITION_MANIFEST)
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(manifestPath):
+            os.remove(manifestPath)
+    except OSError as error:
+        print("**Unable to write the partitions ({})...".format(error))
+        return False
+
+    dataVersion = ridership_data_version(dbConn)
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Station_ID, Ride_Date, Type_of_Day, Num_Riders
+                    FROM Ridership;
+                    """)
+
+    partitions = {}
+    skipped = 0
+
+    try:
+        while True:
+            rows = dbCursor.fetchmany(PARTITION_BATCH_SIZE)
+
+            if len(rows) == 0:
+                break
+
+            batches = {}
+
+            for row in rows:
+                year = str(row[1])[:4]
+
+                if not year.isdigit():
+                    skipped += 1
+                    continue
+
+                batches.setdefault(year, []).append(row)
+
+            for year, batch in batches.items():
+                if year not in partitions:
+                    path = os.path.join(directory, "ridership-{}.db".format(year))
+
+                    if os.path.exists(path):
+                        os.remove(path)
+
+                    # the partition is rebuilt from scratch if anything goes wrong, so it needs no journal
+                    partitions[year] = sqlite3.connect(path)
+                    partitions[year].execute("PRAGMA journal_mode = OFF;")
+                    partitions[year].execute("PRAGMA synchronous = OFF;")
+                    partitions[year].execute(PARTITION_SCHEMA)
+
+                partitions[year].executemany("""
+                                            INSERT INTO Ridership (Station_ID, Ride_Date, Type_of_Day, Num_Riders)
+                                            VALUES (?, ?, ?, ?);
+                                            """, batch)
+
+        manifest = {"version": PARTITION_VERSION, "data": dataVersion, "partitions": []}
+
+        for year, partitionConn in sorted(partitions.items()):
+            for index in PARTITION_INDEXES:
+                partitionConn.execute(index)
+
+            partitionCursor = partitionConn.cursor()
+
+            partitionCursor.execute("""
+                                    SELECT min(date(Ride_Date)), max(date(Ride_Date)), count(*), sum(Num_Riders)
+                                    FROM Ridership;
+                                    """)
+
+            firstDate, lastDate, entries, riders = partitionCursor.fetchone()
+            partitionConn.commit()
+
+            manifest["partitions"].append({"year": year, "file": "ridership-{}.db".format(year),
+                                           "first_date": firstDate, "last_date": lastDate, "entries": entries,
+                                           "riders": riders})
+
+        with open(manifestPath + ".tmp", "w") as manifestFile:
+            json.dump(manifest, manifestFile, indent=1)
+
+        os.replace(manifestPath + ".tmp", manifestPath)
+    except (OSError, sqlite3.Error) as error:
+        print("**Unable to write the partitions ({})...".format(error))
+        return False
+    finally:
+        for partitionConn in partitions.values():
+            partitionConn.close()
+
+    entries = sum([partition["entries"] for partition in manifest["partitions"]])
+    print("Saved {:,} ride entries to {} partitions in {} in {:.1f} s".format(entries, len(partitions), directory,
+                                                                              time.perf_counter() - start))
+
+    if skipped > 0:
+        print("**Skipped {:,} ride entries without a ride date...".format(skipped))
+
+    return True
+
+#
+# use_partitions
+#
+# Routes the ridership queries of this session to the partitions in the given directory, using the given number of
+# worker processes for the full-history aggregates. Returns False (and keeps using the Ridership table) if the
+# partitions cannot be read or are out of date.
+#
+def use_partitions(dbConn, directory, workers):
+    global partitionRouter
+
+    try:
+        with open(os.path.join(directory, PARTITION_MANIFEST)) as manifestFile:
+            manifest = json.load(manifestFile)
+
+        if manifest.get("version") != PARTITION_VERSION:
+            raise ValueError("unsupported manifest version {}".format(manifest.get("version")))
+    except (OSError, ValueError) as error:
+        print("**Unable to read the partitions in {} ({}), using the Ridership table...".format(directory, error))
+        return False
+
+    if manifest.get("data") != ridership_data_version(dbConn):
+        print("**The partitions in {} are out of date, using the Ridership table...".format(directory))
+        return False
+
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Station_ID, Station_Name
+                    FROM Stations
+                    ORDER BY Station_ID;
+                    """)
+
+    partitionRouter = PartitionRouter(directory, manifest, dbCursor.fetchall(), workers)
+    return True
+
+#
+# Station spatial index
+#
+# A temporary R*Tree (StopIndex) over the location of every stop, built once per session on first use, together with a
+# StopLocations table holding each stop's station and exact coordinates. Box searches list every matching stop, as
+# commandNine always has. Radius and nearest-neighbour searches rank stations, so their stops are grouped by station and
+# each station is placed at its nearest stop. All of them only look at the stops whose index entries can match instead
+# of every stop in the database.
+#
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LATITUDE = EARTH_RADIUS_MILES * math.pi / 180
+
+#
+# haversine_miles
+#
+# Returns the great-circle distance in miles between two latitude/longitude points.
+#
+def haversine_miles(latitude1, longitude1, latitude2, longitude2):
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, [latitude1, longitude1, latitude2, longitude2])
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2 +
+         math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+#
+# build_station_index
+#
+# Creates and fills StopLocations and StopIndex in the temp schema if this session has not done so yet. Both live in the
+# temp schema, so this also works against a read-only database.
+#
+def build_station_index(dbConn):
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "station_index_exists")
+
+    if dbCursor.fetchone()[0] == 1:
+        return
+
+    dbCursor.execute("""
+                    CREATE TEMP TABLE StopLocations (
+                        Stop_ID INTEGER PRIMARY KEY,
+                        Station_ID INTEGER,
+                        Station_Name TEXT,
+                        Latitude REAL,
+                        Longitude REAL
+                    );
+                    """)
+    dbCursor.execute("""
+                    CREATE VIRTUAL TABLE temp.StopIndex
+                    USING rtree(Stop_ID, Min_Latitude, Max_Latitude, Min_Longitude, Max_Longitude);
+                    """)
+    dbCursor.execute("""
+                    INSERT INTO StopLocations
+                    SELECT Stop_ID, Stations.Station_ID, Station_Name, Latitude, Longitude
+                    FROM Stops
+                    JOIN Stations
+                    ON Stops.Station_ID = Stations.Station_ID;
+                    """)
+    dbCursor.execute("""
+                    INSERT INTO StopIndex
+                    SELECT Stop_ID, Latitude, Latitude, Longitude, Longitude
+                    FROM StopLocations;
+                    """)
+    dbConn.commit()
+
+#
+# stations_in_box
+#
+# Returns (station name, latitude, longitude) for every stop strictly inside the given boundaries, ordered by station
+# name. The R*Tree stores 32-bit bounds rounded outwards, so its candidates are checked again against the exact
+# coordinates.
+#
+def stations_in_box(dbConn, northBoundary, southBoundary, eastBoundary, westBoundary):
+    build_station_index(dbConn)
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "stops_in_box", (northBoundary, southBoundary, eastBoundary, westBoundary))
+
+    return [row for row in dbCursor.fetchall()
+            if northBoundary > row[1] > southBoundary and eastBoundary > row[2] > westBoundary]
+
+#
+# stations_near
+#
+# Returns (station name, latitude, longitude) for every stop inside the square mile around a point, ordered by station
+# name.
+#
+def stations_near(dbConn, latitude, longitude):
+    northBoundary = round(latitude + (1 / 69), 3)
+    southBoundary = round(latitude - (1 / 69), 3)
+    eastBoundary = round(longitude + (1 / 51), 3)
+    westBoundary = round(longitude - (1 / 51), 3)
+
+    return stations_in_box(dbConn, northBoundary, southBoundary, eastBoundary, westBoundary)
+
+#
+# stations_within
+#
+# Returns (name, latitude, longitude, miles) for every station with a stop within the given number of miles of a point,
+# nearest first, giving the location of the station's nearest stop. The R*Tree is searched with the bounding box of that
+# circle and the candidate stops are filtered by their haversine distance.
+#
+def stations_within(dbConn, latitude, longitude, miles):
+    build_station_index(dbConn)
+    dbCursor = dbConn.cursor()
+
+    latitudeDelta = miles / MILES_PER_DEGREE_LATITUDE
+    widestLatitude = min(abs(latitude) + latitudeDelta, 89.9)
+    longitudeDelta = latitudeDelta / math.cos(math.radians(widestLatitude))
+
+    execute_query(dbCursor, "stops_within", (latitude + latitudeDelta, latitude - latitudeDelta,
+                                             longitude + longitudeDelta, longitude - longitudeDelta))
+
+    nearestStops = {}
+
+    for row in dbCursor.fetchall():
+        distance = haversine_miles(latitude, longitude, row[2], row[3])
+
+        if distance <= miles and (row[0] not in nearestStops or distance < nearestStops[row[0]][3]):
+            nearestStops[row[0]] = (row[1], row[2], row[3], distance)
+
+    stations = list(nearestStops.values())
+    stations.sort(key=lambda station: (station[3], station[0]))
+    return stations
+
+#
+# nearest_stations
+#
+# Returns (name, latitude, longitude, miles) for the k stations nearest to a point, nearest first. The search radius
+# starts at half a mile and doubles until it holds k stations or covers the whole network.
+#
+def nearest_stations(dbConn, latitude, longitude, k):
+    build_station_index(dbConn)
+    dbCursor = dbConn.cursor()
+
+    execute_query(dbCursor, "station_count")
+
+    k = min(k, dbCursor.fetchone()[0])
+    miles = 0.5
+
+    while True:
+        stations = stations_within(dbConn, latitude, longitude, miles)
+
+        if len(stations) >= k or miles > 2 * math.pi * EARTH_RADIUS_MILES:
+            return stations[:k]
+
+        miles = miles * 2
+
+#
+# read_location
+#
+# Prompts the user for a latitude and longitude in the Chicago area. Returns None if either one is out of bounds.
+#
+def read_location():
+    latitude = input("Enter a latitude:")
+    latitude = float(latitude)
+
+    if latitude < 40 or latitude > 43:
+        print("**Latitude entered is out of bounds...")
+        return None
+
+    longitude = input("Enter a longitude:")
+    longitude = float(longitude)
+
+    if longitude < -88 or longitude > -87:
+        print("**Longitude entered is out of bounds...")
+        return None
+
+    return latitude, longitude
+
+#
+# commandNine
+#
+# Takes in a latitude and longitude as input from the user, and then displays a list of all the stations that are
+# within a one square mile radius of the provided latitude and longitude as well as displaying each station's location.
+# The program also allows the user to plot the locations of these stations on a map of Chicago so that they can visually
+# see where the stations are located.
+#
+def commandNine(dbConn):
+    location = read_location()
+
+    if location is None:
+        return
+
+    latitude, longitude = location
+
+    nearbyStations = []
+    x = []
+    y = []
+
+    for station in stations_near(dbConn, latitude, longitude):
+        print(station[0] + " : ({}, {})".format(station[1], station[2]))
+        nearbyStations.append(station[0])
+        x.append(station[2])
+        y.append(station[1])
+
+    plotInput = input("Plot? (y/n)")
+    plotInput = plotInput.lower()
+
+    if plotInput == 'y':
+        show_chart(draw_station_map, "Stations Near You", nearbyStations, x, y)
+
+#
+# commandTen
+#
+# Takes in a latitude and longitude as input from the user, and then either the number of nearest stations to find or a
+# radius in miles. The program outputs those stations nearest first with their location and distance in miles, and can
+# plot them on the map of Chicago.
+#
+def commandTen(dbConn):
+    location = read_location()
+
+    if location is None:
+        return
+
+    latitude, longitude = location
+    mode = input("Search for the k nearest stations or within a radius? (k/r)")
+    mode = mode.lower()
+
+    if mode == 'k':
+        k = int(input("Enter the number of stations:"))
+
+        if k < 1:
+            print("**Number of stations must be at least 1...")
+            return
+
+        stations = nearest_stations(dbConn, latitude, longitude, k)
+    elif mode == 'r':
+        miles = float(input("Enter a radius in miles:"))
+
+        if miles <= 0:
+            print("**Radius must be greater than 0...")
+            return
+
+        stations = stations_within(dbConn, latitude, longitude, miles)
+    else:
+        print("**Unknown search mode...")
+        return
+
+    if len(stations) == 0:
+        print("**No stations found...")
+        return
+
+    nearbyStations = []
+    x = []
+    y = []
+
+    for station in stations:
+        print(station[0] + " : ({}, {})".format(station[1], station[2]), f"{station[3]:.2f} miles")
+        nearbyStations.append(station[0])
+        x.append(station[2])
+        y.append(station[1])
+
+    plotInput = input("Plot? (y/n)")
+    plotInput = plotInput.lower()
+
+    if plotInput == 'y':
+        show_chart(draw_station_map, "Nearest Stations", nearbyStations, x, y)
+
+#
+# Headless chart rendering
+#
+# Writes the yearly ridership chart and the monthly ridership chart of every year for every station to files, without
+# a display. Stations are spread over a pool of worker processes, each with its own read-only connection, and charts are
+# drawn with save_chart so nothing goes through pyplot's global state. Files are named
+# <Station_ID>_<station name>_yearly.<format> and <Station_ID>_<station name>_monthly_<year>.<format>.
+#
+workerConn = None
+
+#
+# init_read_only_worker
+#
+# Opens the read-only database connection used by a worker process (chart rendering and the day type breakdown).
+#
+def init_read_only_worker(dbPath):
+    global workerConn
+
+    workerConn = sqlite3.connect(pathlib.Path(dbPath).resolve().as_uri() + "?mode=ro", uri=True)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        build_rollups(workerConn)
+
+#
+# render_station_charts
+#
+# Renders the charts of one station in a worker process and returns the number of files written.
+#
+def render_station_charts(task):
+    stationID, stationName, outputDir, chartFormat, years = task
+    prefix = os.path.join(outputDir, "{}_{}".format(stationID, re.sub("[^A-Za-z0-9]+", "_", stationName).strip("_")))
+
+    rows = yearly_ridership(workerConn, stationID)
+
+    if len(rows) == 0:
+        return 0
+
+    save_chart("{}_yearly.{}".format(prefix, chartFormat), draw_yearly_chart, stationName,
+               [row[0] for row in rows], [row[1] for row in rows])
+    count = 1
+
+    for year in [row[0] for row in rows]:
+        if years and year not in years:
+            continue
+
+        months = monthly_ridership(workerConn, stationID, year)
+        save_chart("{}_monthly_{}.{}".format(prefix, year, chartFormat), draw_monthly_chart, stationName, year,
+                   [row[0] for row in months], [row[1] for row in months])
+        count = count + 1
+
+    return count
+
+#
+# render_charts
+#
+# Renders the charts of every station into outputDir across the given number of worker processes and reports how many
+# files were written. Only the listed years get monthly charts, or every year if the list is empty.
+#
+def render_charts(dbConn, dbPath, outputDir, chartFormat, workers, years):
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Station_ID, Station_Name
+                    FROM Stations
+                    ORDER BY Station_ID;
+                    """)
+
+    tasks = [(row[0], row[1], outputDir, chartFormat, years) for row in dbCursor.fetchall()]
+    os.makedirs(outputDir, exist_ok=True)
+
+    start = time.perf_counter()
+    total = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_read_only_worker,
+                                                initargs=(dbPath,)) as pool:
+        for count in pool.map(render_station_charts, tasks, chunksize=4):
+            total = total + count
+
+    print("Rendered {:,} charts for {:,} stations into {} in {:.1f} s".format(total, len(tasks), outputDir,
+                                                                              time.perf_counter() - start))
+
+#
+# Network day type breakdown
+#
+# commandTwo answers one station with a sum per type of day. network_day_types answers every station at once with a
+# single conditional-aggregation pass over the yearly rollup, producing the weekday, Saturday and Sunday/holiday totals
+# of each station side by side. With more than one worker the stations are split into contiguous Station_ID ranges, and
+# each range is aggregated in its own process over its own read-only connection.
+#
+dayTypeWorkers = 1
+
+DAY_TYPE_SORT_COLUMNS = {"name": 1, "weekday": 2, "saturday": 3, "sunday": 4, "total": 5}
+
+DAY_TYPE_COLUMNS = ["station_id", "station_name", "weekday", "saturday", "sunday_holiday", "total", "weekday_pct",
+                    "saturday_pct", "sunday_holiday_pct"]
+
+#
+# query_day_types
+#
+# Returns (Station_ID, Station_Name, weekday, Saturday, Sunday/holiday ridership) for every station with ridership whose
+# Station_ID is between first and last, ordered by Station_ID.
+#
+def query_day_types(dbConn, first, last):
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Stations.Station_ID, Station_Name,
+                        coalesce(sum(CASE WHEN Type_of_Day = 'W' THEN Num_Riders END), 0),
+                        coalesce(sum(CASE WHEN Type_of_Day = 'A' THEN Num_Riders END), 0),
+                        coalesce(sum(CASE WHEN Type_of_Day = 'U' THEN Num_Riders END), 0)
+                    FROM Stations
+                    JOIN RidershipYearly
+                    ON Stations.Station_ID = RidershipYearly.Station_ID
+                    WHERE Stations.Station_ID BETWEEN ? AND ?
+                    GROUP BY Stations.Station_ID
+                    ORDER BY Stations.Station_ID;
+                    """, (first, last))
+
+    return dbCursor.fetchall()
+
+#
+# day_type_partition
+#
+# Aggregates one Station_ID range in a worker process.
+#
+def day_type_partition(bounds):
+    return query_day_types(workerConn, bounds[0], bounds[1])
+
+#
+# network_day_types
+#
+# Returns (Station_ID, Station_Name, weekday, Saturday, Sunday/holiday ridership) for every station with ridership,
+# ordered by Station_ID, using the given number of worker processes.
+#
+@cached_query
+def network_day_types(dbConn, workers):
+    if columnarEngine is not None:
+        return columnarEngine.network_day_types()
+
+    dbPath, fingerprint = database_fingerprint(dbConn)
+
+    if workers <= 1 or dbPath is None:
+        return query_day_types(dbConn, -2 ** 63, 2 ** 63 - 1)
+
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Station_ID
+                    FROM Stations
+                    ORDER BY Station_ID;
+                    """)
+
+    stationIDs = [row[0] for row in dbCursor.fetchall()]
+    size = max(1, math.ceil(len(stationIDs) / workers))
+    partitions = [(stationIDs[i], stationIDs[min(i + size, len(stationIDs)) - 1])
+                  for i in range(0, len(stationIDs), size)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(partitions), initializer=init_read_only_worker,
+                                                initargs=(dbPath,)) as pool:
+        return [row for rows in pool.map(day_type_partition, partitions) for row in rows]
+
+#
+# day_type_table
+#
+# Adds the total and the percentage of each type of day to the rows of network_day_types, sorted by the given column:
+# by name in ascending order, or by a ridership column busiest first.
+#
+def day_type_table(rows, sortBy):
+    table = []
+
+    for stationID, stationName, weekdayRiders, saturdayRiders, sundayRiders in rows:
+        totalRiders = weekdayRiders + saturdayRiders + sundayRiders
+        percentages = [(riders / totalRiders) * 100 if totalRiders > 0 else 0
+                       for riders in [weekdayRiders, saturdayRiders, sundayRiders]]
+        table.append([stationID, stationName, weekdayRiders, saturdayRiders, sundayRiders, totalRiders] + percentages)
+
+    column = DAY_TYPE_SORT_COLUMNS[sortBy]
+
+    if sortBy == "name":
+        table.sort(key=lambda row: (row[1], row[0]))
+    else:
+        table.sort(key=lambda row: (-row[column], row[1]))
+
+    return table
+
+#
+# write_day_types
+#
+# Writes the day type table to a CSV file.
+#
+def write_day_types(path, table):
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(DAY_TYPE_COLUMNS)
+
+        for row in table:
+            writer.writerow(row[:6] + [f"{percentage:.2f}" for percentage in row[6:]])
+
+#
+# commandEleven
+#
+# Outputs the weekday, saturday and sunday/holiday ridership and percentages of every station, sorted the way the user
+# chooses, and optionally saves the table to a CSV file.
+#
+def commandEleven(dbConn):
+    sortInput = input("Sort by (name/weekday/saturday/sunday/total):")
+    sortInput = sortInput.lower()
+
+    if sortInput not in DAY_TYPE_SORT_COLUMNS:
+        print("**Unknown sort order...")
+        return
+
+    table = day_type_table(network_day_types(dbConn, dayTypeWorkers), sortInput)
+
+    if len(table) == 0:
+        print("**No data found...")
+        return
+
+    print("Ridership by Type of Day for Each Station")
+
+    for row in table:
+        print(row[1], ":", "weekday", f"{row[2]:,}", f"({row[6]:.2f}%),", "saturday", f"{row[3]:,}",
+              f"({row[7]:.2f}%),", "sunday/holiday", f"{row[4]:,}", f"({row[8]:.2f}%),", "total", f"{row[5]:,}")
+
+    fileInput = input("Save to a CSV file? (file name, or press enter to skip)")
+
+    if fileInput != "":
+        write_day_types(fileInput, table)
+        print("Saved", len(table), "stations to", fileInput)
+
+#
+# Date range ridership
+#
+# commandTwelve answers the ridership of a station between any two dates, for any mix of types of day, in total or in
+# buckets: days, weeks (Monday to Sunday), months, quarters, years or a rolling window of N days ending on each day. It
+# is backed by prefix sums: for every type of day, the cumulative ridership of the station from its first day, one
+# entry per calendar day. The ridership of any date range is then the difference of two entries per type of day, so a
+# bucket costs the same whatever its length. The prefix sums of a station are built the first time the station is
+# asked for (from the columnar engine if it is loaded, otherwise with one query over Ridership) and kept together with
+# the ridership data version they were built at, so they are built again once the data changes (after an ingest, say).
+#
+prefixSums = {}
+
+RANGE_BUCKETS = ["total", "day", "week", "month", "quarter", "year"]
+
+# W, A, U and any other type of day, in the order of DAY_TYPE_CODES
+ALL_DAY_TYPES = [0, 1, 2, 3]
+
+class PrefixSums:
+    __slots__ = ("first", "sums")
+
+    def __init__(self, first, sums):
+        self.first = first
+        self.sums = sums
+
+    #
+    # range_total
+    #
+    # Returns the ridership between the day ordinals first and last (inclusive) on the given types of day (codes of
+    # DAY_TYPE_CODES, 3 for any other type). Days outside the station's data count as no ridership.
+    #
+    def range_total(self, first, last, dayTypes):
+        span = len(self.sums[0]) - 1
+        start = min(max(first - self.first, 0), span)
+        end = min(max(last - self.first + 1, start), span)
+
+        return sum(int(self.sums[dayType][end] - self.sums[dayType][start]) for dayType in dayTypes)
+
+#
+# load_prefix_sums
+#
+# Returns the prefix sums of the given station, building them the first time the station is asked for and again
+# whenever the ridership data version has moved since they were built.
+#
+def load_prefix_sums(dbConn, stationID):
+    dataVersion = ridership_data_version(dbConn)
+
+    if stationID in prefixSums and prefixSums[stationID][0] == dataVersion:
+        return prefixSums[stationID][1]
+
+    if columnarEngine is not None:
+        first, sums = columnarEngine.prefix_sums(stationID)
+    else:
+        dbCursor = dbConn.cursor()
+
+        dbCursor.execute("""
+                        SELECT {}, CASE Type_of_Day WHEN 'W' THEN 0 WHEN 'A' THEN 1 WHEN 'U' THEN 2 ELSE 3 END,
+                            coalesce(Num_Riders, 0)
+                        FROM Ridership
+                        WHERE Station_ID = ?;
+                        """.format(ORDINAL_EXPRESSION.format("Ride_Date")), (stationID,))
+
+        rows = [row for row in dbCursor.fetchall() if row[0] is not None]
+        first = min([row[0] for row in rows], default=0)
+        span = max([row[0] for row in rows], default=first - 1) - first + 1
+        daily = [[0] * span for dayType in ALL_DAY_TYPES]
+
+        for day, dayType, riders in rows:
+            daily[dayType][day - first] += riders
+
+        sums = [list(itertools.accumulate(riders, initial=0)) for riders in daily]
+
+    prefixSums[stationID] = (dataVersion, PrefixSums(first, sums))
+    return prefixSums[stationID][1]
+
+#
+# parse_date / parse_day_types / parse_bucket
+#
+# Parse the date range inputs: a 'YYYY-MM-DD' date into a day ordinal, a string of W, A and U into day type codes
+# (every type of day if blank) and a bucket name or 'Nd' (a rolling window of N days). Each returns None if its input is
+# not valid.
+#
+def parse_date(text):
+    try:
+        return datetime.date.fromisoformat(text.strip()).toordinal()
+    except ValueError:
+        return None
+
+def parse_day_types(text):
+    text = text.strip().upper()
+
+    if text == "":
+        return ALL_DAY_TYPES
+
+    if any(dayType not in DAY_TYPE_CODES for dayType in text):
+        return None
+
+    return sorted(set([DAY_TYPE_CODES[dayType] for dayType in text]))
+
+def parse_bucket(text):
+    text = text.strip().lower() or "total"
+
+    if text in RANGE_BUCKETS:
+        return text
+
+    if len(text) > 1 and text.endswith("d") and text[:-1].isdigit() and int(text[:-1]) > 0:
+        return int(text[:-1])
+
+    return None
+
+#
+# range_buckets
+#
+# Splits the day ordinals first to last (inclusive) into the (first, last) day ordinals of each bucket. Calendar buckets
+# are cut at the start and end of the range, and a rolling window of N days gives one N day window ending on each day.
+# A window reaching back past the first representable date starts on that date instead, and a month or quarter running
+# into December 9999 ends on the last representable date.
+#
+def range_buckets(first, last, bucket):
+    if bucket == "total":
+        return [(first, last)]
+
+    if isinstance(bucket, int):
+        minimum = datetime.date.min.toordinal()
+        return [(max(day - bucket + 1, minimum), day) for day in range(first, last + 1)]
+
+    buckets = []
+    start = first
+
+    while start <= last:
+        date = datetime.date.fromordinal(start)
+
+        if bucket == "day":
+            end = start
+        elif bucket == "week":
+            end = start + 6 - date.weekday()
+        elif bucket == "year":
+            end = datetime.date(date.year, 12, 31).toordinal()
+        else:
+            months = 1 if bucket == "month" else 3
+            month = (date.month - 1) // months * months + months
+
+            if date.year + month // 12 > datetime.MAXYEAR:
+                end = datetime.date.max.toordinal()
+            else:
+                end = datetime.date(date.year + month // 12, month % 12 + 1, 1).toordinal() - 1
+
+        buckets.append((start, min(end, last)))
+        start = end + 1
+
+    return buckets
+
+#
+# range_ridership
+#
+# Returns (first date, last date, ridership) for every bucket of the date range at the given station, counting only the
+# given types of day. Dates are 'YYYY-MM-DD' strings.
+#
+def range_ridership(dbConn, stationID, first, last, dayTypes, bucket):
+    sums = load_prefix_sums(dbConn, stationID)
+
+    return [(datetime.date.fromordinal(start).isoformat(), datetime.date.fromordinal(end).isoformat(),
+             sums.range_total(start, end, dayTypes)) for start, end in range_buckets(first, last, bucket)]
+
+#
+# commandTwelve
+#
+# Takes in a station name that matches exactly one station, a start and end date, the types of day to count and how to
+# bucket the range, and outputs the ridership of the station in each bucket of the range.
+#
+def commandTwelve(dbConn):
+    commandTwelveInput = input("Enter a station name (wildcards _ and %):")
+    station = resolve_station(dbConn, commandTwelveInput)
+
+    if station is None:
+        return
+
+    stationID, stationName = station
+    first = parse_date(input("Enter a start date (YYYY-MM-DD):"))
+    last = parse_date(input("Enter an end date (YYYY-MM-DD):"))
+
+    if first is None or last is None:
+        print("**Invalid date...")
+        return
+
+    if first > last:
+        print("**The start date is after the end date...")
+        return
+
+    dayTypes = parse_day_types(input("Types of day (any of W, A and U, or press enter for all):"))
+
+    if dayTypes is None:
+        print("**Unknown type of day...")
+        return
+
+    bucket = parse_bucket(input("Bucket (total/day/week/month/quarter/year, or Nd for a rolling N day window):"))
+
+    if bucket is None:
+        print("**Unknown bucket...")
+        return
+
+    print("Ridership at", stationName)
+    result = range_ridership(dbConn, stationID, first, last, dayTypes, bucket)
+    write_listing("{} - {} : {:,}\n".format(*row) for row in window(result, listingLimit, listingOffset))
+
+#
+# Ridership anomalies
+#
+# commandThirteen finds the days on which a station's ridership was furthest from its norm, across every station at
+# once. The norm of a day is the mean and standard deviation of the station's previous ANOMALY_WINDOW days of the same
+# type of day, so a Sunday is compared with the Sundays and holidays before it. All of Ridership is read in one pass (or
+# taken from the columnar engine if it is loaded) and reordered so that the days of each station and type of day are
+# contiguous runs in date order. Every rolling mean and variance is then the difference of two entries of a cumulative
+# sum (of riders and of squared riders), which scores every day of every station in a few vectorized NumPy operations.
+# A day is only scored once a full window precedes it, and the deviation is floored at one rider so that flat series
+# do not divide by zero. Days whose ridership is missing (NULL) are left out entirely, neither scored nor counted in the
+# window of the days after them, so a gap in the data is not reported as a day without riders.
+#
+ANOMALY_WINDOW = 20
+ANOMALY_TOP = 25
+
+ANOMALY_COLUMNS = ["station_id", "station_name", "date", "type_of_day", "riders", "baseline", "z_score"]
+
+# the Type_of_Day of each day type code, with "?" for any other type of day
+DAY_TYPE_LETTERS = ["W", "A", "U", "?"]
+
+#
+# detect_anomalies
+#
+# Scores every day of the sorted ridership columns against the rolling baseline of its station and type of day and
+# returns (Station_ID, Station_Name, date, Type_of_Day, riders, baseline, z-score) for the top days by absolute z-score.
+#
+def detect_anomalies(columns, stationNames, window, top):
+    np = load_numpy()
+    order = np.lexsort((columns["days"], columns["dayTypes"], columns["stations"]))
+    order = order[columns["counted"][order] != 0]
+    stations = columns["stations"][order]
+    dayTypes = columns["dayTypes"][order]
+    values = columns["riders"][order].astype(np.float64)
+
+    groups = stations.astype(np.int64) * len(DAY_TYPE_LETTERS) + dayTypes
+    starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+    positions = np.arange(len(values)) - np.repeat(starts, np.diff(np.append(starts, len(values))))
+
+    # sums[i] - sums[i - window] is the total of the window of days before row i
+    sums = np.concatenate([[0.0], np.cumsum(values)])
+    squares = np.concatenate([[0.0], np.cumsum(values * values)])
+    rows = np.flatnonzero(positions >= window)
+
+    baselines = (sums[rows] - sums[rows - window]) / window
+    variances = (squares[rows] - squares[rows - window]) / window - baselines * baselines
+    scores = (values[rows] - baselines) / np.maximum(np.sqrt(np.maximum(variances, 0)), 1)
+
+    best = np.argsort(-np.abs(scores), kind="stable")[:max(top, 0)]
+    rows = rows[best]
+    names = dict(stationNames)
+    days = columns["days"][order][rows].astype(np.int64) - EPOCH_ORDINAL
+    dates = np.datetime_as_string(days.astype("datetime64[D]"), unit="D")
+
+    return [(stationID, names.get(stationID), date, DAY_TYPE_LETTERS[dayType], int(riders), round(baseline, 1),
+             round(score, 2)) for stationID, date, dayType, riders, baseline, score
+            in zip(stations[rows].tolist(), dates.tolist(), dayTypes[rows].tolist(), values[rows].tolist(),
+                   baselines[best].tolist(), scores[best].tolist())]
+
+#
+# ridership_anomalies
+#
+# Returns the top anomalies of the whole network (see detect_anomalies), from the columnar engine if it is loaded and
+# otherwise from a single pass over Ridership. Raises ImportError if numpy is not installed.
+#
+@cached_query
+def ridership_anomalies(dbConn, window, top):
+    if columnarEngine is not None:
+        columns = {"stations": columnarEngine.stations, "days": columnarEngine.days,
+                   "dayTypes": columnarEngine.dayTypes, "riders": columnarEngine.riders,
+                   "counted": columnarEngine.counted}
+        return detect_anomalies(columns, columnarEngine.stationNames, window, top)
+
+    return detect_anomalies(*load_ridership_columns(dbConn), window, top)
+
+#
+# commandThirteen
+#
+# Takes in the length of the rolling baseline and the number of anomalies to show (with defaults if the user presses
+# enter), and outputs the days across all stations whose ridership deviated the most from the station's baseline.
+#
+def commandThirteen(dbConn):
+    windowInput = input("Baseline window in days of the same type (press enter for {}):".format(ANOMALY_WINDOW))
+    topInput = input("Number of anomalies to show (press enter for {}):".format(ANOMALY_TOP))
+
+    if not (windowInput.strip() or str(ANOMALY_WINDOW)).isdigit() or not (topInput.strip() or "0").isdigit():
+        print("**Please enter a whole number...")
+        return
+
+    window = max(1, int(windowInput.strip() or ANOMALY_WINDOW))
+    top = int(topInput.strip() or ANOMALY_TOP)
+
+    try:
+        result = ridership_anomalies(dbConn, window, top)
+    except ImportError:
+        print("**NumPy is not installed, unable to detect anomalies...")
+        return
+
+    if len(result) == 0:
+        print("**No data found...")
+        return
+
+    print("Ridership Anomalies (baseline of the previous {} days of the same type)".format(window))
+
+    for row in result:
+        print(row[2], row[1], "(" + row[3] + ") :", f"{row[4]:,}", "riders,", "baseline", f"{row[5]:,.1f},",
+              "z =", f"{row[6]:.2f}")
+
+#
+# Station correlations
+#
+# commandFourteen compares the daily ridership of any number of stations (every station matching a list of patterns, or
+# all of them) over a year or a date range. Their daily series are read with a single query into one stations x days
+# matrix, fed a batch of rows at a time, so memory is bounded by the size of the matrix and not by the number of rows.
+# Each series is centered and scaled to unit length in place, with the days a station has no ridership for filled with
+# its mean (zero once centered), and the full correlation matrix is then one matrix product of the scaled series with
+# themselves.
+# Stations with no ridership or a constant ridership in the period have no correlation and are left out.
+#
+CORRELATION_TOP = 10
+
+CORRELATION_COLUMNS = ["kind", "station_1", "station_2", "correlation"]
+
+#
+# parse_period
+#
+# Returns the first and last day ordinals of a year ('YYYY') or of a date range ('YYYY-MM-DD YYYY-MM-DD'), or None if
+# the input is neither or the range is empty.
+#
+def parse_period(text):
+    text = text.strip()
+
+    if len(text) == 4 and text.isdigit() and text != "0000":
+        return datetime.date(int(text), 1, 1).toordinal(), datetime.date(int(text), 12, 31).toordinal()
+
+    dates = [parse_date(date) for date in text.split()]
+
+    if len(dates) != 2 or None in dates or dates[0] > dates[1]:
+        return None
+
+    return dates[0], dates[1]
+
+#
+# station_list
+#
+# Returns (Station_ID, Station_Name) for every station matching any of the comma separated patterns, or for every
+# station if the input is 'all', ordered by name.
+#
+def station_list(dbConn, text):
+    patterns = [pattern.strip() for pattern in text.split(",") if pattern.strip()]
+
+    if [pattern.lower() for pattern in patterns] == ["all"]:
+        patterns = ["%"]
+
+    stations = {}
+
+    for pattern in patterns:
+        stations.update(find_stations(dbConn, pattern))
+
+    return sorted(stations.items(), key=lambda station: (station[1], station[0]))
+
+#
+# daily_matrix
+#
+# Returns a matrix with one row per given station and one column per day from first to last (day ordinals), holding the
+# station's ridership on that day or NaN if it has none. Raises ImportError if numpy is not installed.
+#
+def daily_matrix(dbConn, stationIDs, first, last):
+    np = load_numpy()
+
+    if columnarEngine is not None:
+        return columnarEngine.daily_matrix(stationIDs, first, last)
+
+    matrix = np.full((len(stationIDs), last - first + 1), np.nan)
+    order = np.argsort(stationIDs)
+    sortedIDs = np.array(stationIDs, dtype=np.int64)[order]
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("""
+                    SELECT Station_ID, {}, Num_Riders
+                    FROM RidershipDaily
+                    WHERE Station_ID IN ({}) AND Ride_Date >= ? AND Ride_Date <= ? AND Num_Riders IS NOT NULL;
+                    """.format(ORDINAL_EXPRESSION.format("Ride_Date"), ", ".join(["?"] * len(stationIDs))),
+                     (*stationIDs, datetime.date.fromordinal(first).isoformat(),
+                      datetime.date.fromordinal(last).isoformat()))
+
+    while True:
+        rows = dbCursor.fetchmany(FETCH_BATCH_SIZE)
+
+        if len(rows) == 0:
+            return matrix
+
+        rows = np.array(rows, dtype=np.int64)
+        matrix[order[np.searchsorted(sortedIDs, rows[:, 0])], rows[:, 1] - first] = rows[:, 2]
+
+#
+# correlation_matrix
+#
+# Centers and scales the rows of a daily matrix in place and returns which rows have a correlation (some ridership that
+# is not constant) and the correlation matrix of those rows.
+#
+def correlation_matrix(matrix):
+    np = load_numpy()
+    present = ~np.isnan(matrix)
+    counts = present.sum(axis=1)
+    keep = counts > 0
+
+    matrix[~present] = 0
+    means = matrix.sum(axis=1) / np.maximum(counts, 1)
+    matrix -= means[:, None]
+    matrix[~present] = 0
+    norms = np.sqrt((matrix * matrix).sum(axis=1))
+    keep &= norms > 0
+
+    matrix = matrix[keep]
+    matrix /= norms[keep][:, None]
+    correlations = matrix @ matrix.T
+
+    # rounding can put a station's correlation with itself just past 1
+    np.clip(correlations, -1, 1, out=correlations)
+    return keep, correlations
+
+#
+# station_correlations
+#
+# Returns the stations that have a correlation over the period (first and last day ordinals) and their correlation
+# matrix, in the order of the given (Station_ID, Station_Name) stations.
+#
+def station_correlations(dbConn, stations, first, last):
+    matrix = daily_matrix(dbConn, [stationID for stationID, stationName in stations], first, last)
+    keep, correlations = correlation_matrix(matrix)
+
+    return [station for station, kept in zip(stations, keep.tolist()) if kept], correlations
+
+#
+# correlation_pairs
+#
+# Returns the top station pairs of a correlation matrix: (Station_Name, Station_Name, correlation) for the most similar
+# pairs, most similar first, and for the most divergent pairs, most divergent first.
+#
+def correlation_pairs(stations, correlations, top):
+    np = load_numpy()
+    first, second = np.triu_indices(len(stations), 1)
+    values = correlations[first, second]
+    order = np.argsort(-values, kind="stable")
+
+    def pairs(positions):
+        return [(stations[first[i]][1], stations[second[i]][1], round(float(values[i]), 4)) for i in positions]
+
+    return pairs(order[:top]), pairs(order[::-1][:top])
+
+#
+# write_correlations
+#
+# Writes a correlation matrix to a CSV file, with the station names as the header row and the first column.
+#
+def write_correlations(path, stations, correlations):
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(["station_name"] + [stationName for stationID, stationName in stations])
+
+        for (stationID, stationName), row in zip(stations, correlations.tolist()):
+            writer.writerow([stationName] + [f"{value:.4f}" for value in row])
+
+#
+# commandFourteen
+#
+# Takes in a list of station names (or all stations) and a year or date range, and outputs the most similar and most
+# divergent pairs of stations by the correlation of their daily ridership. The user can also save the full correlation
+# matrix to a CSV file.
+#
+def commandFourteen(dbConn):
+    stations = station_list(dbConn, input("Enter station names separated by commas (wildcards _ and %), or all:"))
+    period = parse_period(input("Enter a year, or a start and end date (YYYY-MM-DD YYYY-MM-DD):"))
+
+    if period is None:
+        print("**Invalid year or date range...")
+        return
+
+    try:
+        stations, correlations = station_correlations(dbConn, stations, *period)
+    except ImportError:
+        print("**NumPy is not installed, unable to correlate stations...")
+        return
+
+    if len(stations) < 2:
+        print("**At least two stations with ridership are needed...")
+        return
+
+    similar, divergent = correlation_pairs(stations, correlations, CORRELATION_TOP)
+    print("Correlation of Daily Ridership for", len(stations), "Stations")
+    print("Most similar:")
+
+    for row in similar:
+        print(" ", row[0], "-", row[1], ":", f"{row[2]:.4f}")
+
+    print("Most divergent:")
+
+    for row in divergent:
+        print(" ", row[0], "-", row[1], ":", f"{row[2]:.4f}")
+
+    fileInput = input("Save the matrix to a CSV file? (file name, or press enter to skip)")
+
+    if fileInput != "":
+        write_correlations(fileInput, stations, correlations)
+        print("Saved", len(stations), "stations to", fileInput)
+
+#
+# Startup budget
+#
+# check_startup launches the program the way a user would (against the given database, exiting at the first prompt)
+# under "python -X importtime" and fails if the warm start takes longer than the budget or imports matplotlib. The first
+# launch is discarded since it may build the rollups and the stats cache. Run it in CI to catch startup regressions.
+#
+def import_time_ms(importTimeOutput):
+    total = 0
+
+    for line in importTimeOutput.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        parts = line.split("|")
+
+        # top-level imports are indented by a single space, their dependencies by more
+        if len(parts) == 3 and not parts[2].startswith("  "):
+            total += int(parts[1])
+
+    return total / 1000
+
+def check_startup(dbPath, budgetMs):
+    command = [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--db", dbPath]
+
+    for attempt in range(2):
+        start = time.perf_counter()
+        result = subprocess.run(command, input="x\n", capture_output=True, text=True)
+        elapsedMs = (time.perf_counter() - start) * 1000
+
+    importMs = import_time_ms(result.stderr)
+    plotting = "matplotlib" in result.stderr
+
+    print("Startup check:")
+    print("  imports: {:.1f} ms".format(importMs))
+    print("  startup to exit: {:.1f} ms (budget {:.1f} ms)".format(elapsedMs, budgetMs))
+    print("  matplotlib imported:", "yes" if plotting else "no")
+
+    if result.returncode != 0:
+        print("**Startup failed:", result.stderr.strip().splitlines()[-1:])
+        return False
+
+    if plotting:
+        print("**matplotlib must not be imported at startup...")
+        return False
+
+    if elapsedMs > budgetMs:
+        print("**Startup is over budget...")
+        return False
+
+    return True
+
+#
+# Batch mode
+#
+# Runs a list of requests over one connection without any prompts and writes the results as JSON Lines (one object per
+# request) or CSV (one line per value, with the columns request, command, row, column and value). A batch file is either
+# a JSON list of requests or a script with one JSON request per line, where blank lines and lines starting with # are
+# skipped. Each request names a command ("stats" or 1-14) plus the parameters the command would otherwise prompt for:
+#
+#   {"command": "6", "station": "Clark/Lake"}
+#   {"command": "7", "station": "Clark/Lake", "year": "2010"}
+#   {"command": "8", "year": "2010", "stations": ["Clark/Lake", "Howard", "Midway"]}
+#   {"command": "10", "latitude": 41.88, "longitude": -87.63, "k": 5}
+#   {"command": "11", "sort": "total", "workers": 4}
+#   {"command": "12", "station": "Clark/Lake", "start": "2019-01-01", "end": "2019-12-31", "day_types": "W",
+#    "bucket": "quarter"}
+#   {"command": "13", "window": 20, "top": 10}
+#   {"command": "14", "stations": "all", "start": "2019-01-01", "end": "2019-06-30", "top": 5}
+#
+class BatchError(Exception):
+    pass
+
+#
+# batch_parameter
+#
+# Returns the named parameter of a batch request, or raises a BatchError if it is missing.
+#
+def batch_parameter(request, name):
+    if name not in request:
+        raise BatchError("missing parameter '{}'".format(name))
 
-    dbCursor.execute("""
-                    SELECT Station_ID, Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandEightInput))
+    return request[name]
 
-    result = dbCursor.fetchall()
+#
+# batch_station
+#
+# Resolves a station pattern for a batch request, raising a BatchError unless exactly one station matches.
+#
+def batch_station(dbConn, pattern):
+    result = lookup_station(dbConn, str(pattern))
 
     if len(result) == 0:
-        print("**No station found...")
-        return
+        raise BatchError("No station found")
     elif len(result) > 1:
-        print("**Multiple stations found...")
-        return
+        raise BatchError("Multiple stations found")
 
-    dbCursor.execute("""
-                    SELECT Station_ID, Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandEightInput))
+    return result[0]
 
-    result = dbCursor.fetchone()
-    firstStationID = result[0]
-    firstStationName = result[1]
+#
+# batch_window
+#
+# Returns the (limit, offset) of a listing request, from its optional "limit" and "offset" parameters.
+#
+def batch_window(request):
+    return int(request.get("limit", -1)), int(request.get("offset", 0))
 
-    commandEightInput = input("Enter station 2 (wildcards _ and %):")
+#
+# batch_location
+#
+# Returns the latitude and longitude of a batch request, raising a BatchError if they are outside the Chicago area.
+#
+def batch_location(request):
+    latitude = float(batch_parameter(request, "latitude"))
+    longitude = float(batch_parameter(request, "longitude"))
 
-    dbCursor.execute("""
-                    SELECT Station_ID, Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandEightInput))
+    if latitude < 40 or latitude > 43:
+        raise BatchError("Latitude entered is out of bounds")
+
+    if longitude < -88 or longitude > -87:
+        raise BatchError("Longitude entered is out of bounds")
+
+    return latitude, longitude
+
+#
+# batch_stats ... batch_fourteen
+#
+# Run one batch request for the matching command and return its column names and result rows.
+#
+def batch_stats(dbConn, request):
+    stats = load_stats(dbConn)
+    return list(stats.keys()), [list(stats.values())]
+
+def batch_one(dbConn, request):
+    result = find_stations(dbConn, batch_parameter(request, "station"), *batch_window(request))
+
+    return ["station_id", "station_name"], result
+
+def batch_two(dbConn, request):
+    result = day_type_ridership(dbConn, batch_parameter(request, "station"))
+
+    if result is None:
+        raise BatchError("No data found")
+
+    totalRiders = sum(result)
+    percentages = [(riders / totalRiders) * 100 if totalRiders > 0 else None for riders in result]
+
+    return (["weekday", "saturday", "sunday_holiday", "total",
+             "weekday_percentage", "saturday_percentage", "sunday_holiday_percentage"],
+            [list(result) + [totalRiders] + percentages])
+
+def batch_three(dbConn, request):
+    totalWeekdayRidership, result = weekday_ranking(dbConn, *batch_window(request))
 
-    result = dbCursor.fetchall()
+    return (["station_name", "weekday_riders", "percentage"],
+            [[row[0], row[1], (row[1] / totalWeekdayRidership) * 100 if totalWeekdayRidership else None]
+             for row in result])
+
+def batch_four(dbConn, request):
+    lineColor = normalize_line_color(dbConn, str(batch_parameter(request, "color")))
+
+    if lineColor is None:
+        raise BatchError("No such line")
+
+    direction = normalize_direction(str(batch_parameter(request, "direction")))
+    result = [] if direction is None else list(line_stops(dbConn, lineColor, direction, *batch_window(request)))
 
     if len(result) == 0:
-        print("**No station found...")
-        return
-    elif len(result) > 1:
-        print("**Multiple stations found...")
-        return
+        raise BatchError("That line does not run in the direction chosen")
 
-    dbCursor.execute("""
-                    SELECT Station_ID, Station_Name 
-                    FROM Stations 
-                    WHERE Station_Name LIKE "{}";
-                    """.format(commandEightInput))
+    return ["stop_name", "direction", "ada"], result
 
-    result = dbCursor.fetchone()
-    secondStationID = result[0]
-    secondStationName = result[1]
-    print("Station 1:", firstStationID, firstStationName)
+def batch_five(dbConn, request):
+    totalStops, result = stops_by_line(dbConn, *batch_window(request))
 
-    dbCursor.execute("""
-                    SELECT date(Ride_Date), sum(Num_Riders)
-                    FROM Stations 
-                    JOIN Ridership 
-                    ON Stations.Station_ID = Ridership.Station_ID 
-                    WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                    GROUP BY date(Ride_Date) LIMIT 5;
-                    """.format(firstStationName, year))
+    return (["color", "direction", "stops", "percentage"],
+            [[row[0], row[1], row[2], (row[2] / totalStops) * 100] for row in result])
 
-    result = dbCursor.fetchone()
+def batch_six(dbConn, request):
+    stationID, stationName = batch_station(dbConn, batch_parameter(request, "station"))
 
-    while True:
-        print(result[0], result[1])
-        result = dbCursor.fetchone()
+    return (["station_id", "station_name", "year", "riders"],
+            [[stationID, stationName, row[0], row[1]] for row in yearly_ridership(dbConn, stationID)])
 
-        if result is None:
-            break
+def batch_seven(dbConn, request):
+    stationID, stationName = batch_station(dbConn, batch_parameter(request, "station"))
+    year = str(batch_parameter(request, "year"))
 
-    dbCursor.execute("""
-                    SELECT date(Ride_Date), sum(Num_Riders) 
-                    FROM Stations 
-                    JOIN Ridership 
-                    ON Stations.Station_ID = Ridership.Station_ID 
-                    WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                    GROUP BY date(Ride_Date) 
-                    ORDER BY date(Ride_Date) DESC LIMIT 5;
-                    """.format(firstStationName, year))
+    return (["station_id", "station_name", "month", "riders"],
+            [[stationID, stationName, row[0], row[1]] for row in monthly_ridership(dbConn, stationID, year)])
 
-    result = dbCursor.fetchone()
-    stationOneLastFiveDays = []
+def batch_eight(dbConn, request):
+    year = str(batch_parameter(request, "year"))
+    stations = [batch_station(dbConn, pattern) for pattern in batch_parameter(request, "stations")]
+    series, aligned = compare_stations(dbConn, stations, year)
+    rows = []
 
-    while True:
-        output = result[0], result[1]
-        stationOneLastFiveDays.append(output)
-        result = dbCursor.fetchone()
+    for i, (stationID, stationName) in enumerate(stations):
+        rows.extend([[stationID, stationName, date, values[i]] for date, values in aligned])
 
-        if result is None:
-            break
+    return ["station_id", "station_name", "date", "riders"], rows
 
-    stationOneLastFiveDays.reverse()
+def batch_nine(dbConn, request):
+    latitude, longitude = batch_location(request)
+    return ["station_name", "latitude", "longitude"], stations_near(dbConn, latitude, longitude)
 
-    for row in stationOneLastFiveDays:
-        print(row[0], row[1])
+def batch_ten(dbConn, request):
+    latitude, longitude = batch_location(request)
 
-    print("Station 2:", secondStationID, secondStationName)
+    if "k" in request:
+        k = int(request["k"])
 
-    dbCursor.execute("""
-                        SELECT date(Ride_Date), sum(Num_Riders)
-                        FROM Stations 
-                        JOIN Ridership 
-                        ON Stations.Station_ID = Ridership.Station_ID 
-                        WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                        GROUP BY date(Ride_Date) LIMIT 5;
-                        """.format(secondStationName, year))
+        if k < 1:
+            raise BatchError("Number of stations must be at least 1")
 
-    result = dbCursor.fetchone()
+        result = nearest_stations(dbConn, latitude, longitude, k)
+    else:
+        miles = float(batch_parameter(request, "miles"))
 
-    while True:
-        print(result[0], result[1])
-        result = dbCursor.fetchone()
+        if miles <= 0:
+            raise BatchError("Radius must be greater than 0")
 
-        if result is None:
-            break
+        result = stations_within(dbConn, latitude, longitude, miles)
 
-    dbCursor.execute("""
-                        SELECT date(Ride_Date), sum(Num_Riders) 
-                        FROM Stations 
-                        JOIN Ridership 
-                        ON Stations.Station_ID = Ridership.Station_ID 
-                        WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                        GROUP BY date(Ride_Date) 
-                        ORDER BY date(Ride_Date) DESC LIMIT 5;
-                        """.format(secondStationName, year))
+    return ["station_name", "latitude", "longitude", "miles"], result
 
-    result = dbCursor.fetchone()
-    stationTwoLastFiveDays = []
+def batch_eleven(dbConn, request):
+    sortBy = str(request.get("sort", "name")).lower()
 
-    while True:
-        output = result[0], result[1]
-        stationTwoLastFiveDays.append(output)
-        result = dbCursor.fetchone()
+    if sortBy not in DAY_TYPE_SORT_COLUMNS:
+        raise BatchError("Unknown sort order '{}'".format(sortBy))
 
-        if result is None:
-            break
+    workers = min(max(int(request.get("workers", 1)), 1), os.cpu_count() or 1)
 
-    stationTwoLastFiveDays.reverse()
+    return DAY_TYPE_COLUMNS, day_type_table(network_day_types(dbConn, workers), sortBy)
 
-    for row in stationTwoLastFiveDays:
-        print(row[0], row[1])
+def batch_twelve(dbConn, request):
+    stationID, stationName = batch_station(dbConn, batch_parameter(request, "station"))
+    first = parse_date(str(batch_parameter(request, "start")))
+    last = parse_date(str(batch_parameter(request, "end")))
+    dayTypes = parse_day_types(str(request.get("day_types", "")))
+    bucket = parse_bucket(str(request.get("bucket", "total")))
 
-    x = []
-    y1 = []
-    y2 = []
-    day = 1
-    plt.xlabel("Day")
-    plt.ylabel("Number of Riders")
-    plt.title("Ridership Each Day of " + year)
+    if first is None or last is None:
+        raise BatchError("Invalid date")
 
-    dbCursor.execute("""
-                        SELECT date(Ride_Date), sum(Num_Riders)
-                        FROM Stations 
-                        JOIN Ridership 
-                        ON Stations.Station_ID = Ridership.Station_ID 
-                        WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                        GROUP BY date(Ride_Date);
-                        """.format(firstStationName, year))
+    if first > last:
+        raise BatchError("The start date is after the end date")
 
-    result = dbCursor.fetchone()
+    if dayTypes is None:
+        raise BatchError("Unknown type of day '{}'".format(request.get("day_types")))
 
-    while True:
-        x.append(day)
-        y1.append(result[1])
-        day = day + 1
-        result = dbCursor.fetchone()
+    if bucket is None:
+        raise BatchError("Unknown bucket '{}'".format(request.get("bucket")))
 
-        if result is None:
-            break
+    return ["first_date", "last_date", "riders"], window(range_ridership(dbConn, stationID, first, last, dayTypes,
+                                                                         bucket), *batch_window(request))
 
-    dbCursor.execute("""
-                            SELECT date(Ride_Date), sum(Num_Riders)
-                            FROM Stations 
-                            JOIN Ridership 
-                            ON Stations.Station_ID = Ridership.Station_ID 
-                            WHERE Station_Name = "{}" AND strftime('%Y', Ride_Date) = "{}"
-                            GROUP BY date(Ride_Date);
-                            """.format(secondStationName, year))
+def batch_thirteen(dbConn, request):
+    window = int(request.get("window", ANOMALY_WINDOW))
 
-    result = dbCursor.fetchone()
+    if window < 1:
+        raise BatchError("The window must be at least one day")
 
-    while True:
-        y2.append(result[1])
-        result = dbCursor.fetchone()
+    try:
+        return ANOMALY_COLUMNS, ridership_anomalies(dbConn, window, int(request.get("top", ANOMALY_TOP)))
+    except ImportError:
+        raise BatchError("NumPy is not installed")
 
-        if result is None:
-            break
+def batch_fourteen(dbConn, request):
+    stations = batch_parameter(request, "stations")
+    stations = station_list(dbConn, stations if isinstance(stations, str) else ",".join(map(str, stations)))
 
-    plotInput = input("Plot? (y/n)")
-    plotInput = plotInput.lower()
+    if "year" in request:
+        period = parse_period(str(request["year"]))
+    else:
+        period = parse_period("{} {}".format(batch_parameter(request, "start"), batch_parameter(request, "end")))
+
+    if period is None:
+        raise BatchError("Invalid year or date range")
+
+    try:
+        stations, correlations = station_correlations(dbConn, stations, *period)
+    except ImportError:
+        raise BatchError("NumPy is not installed")
+
+    similar, divergent = correlation_pairs(stations, correlations, int(request.get("top", CORRELATION_TOP)))
+
+    return CORRELATION_COLUMNS, [["similar", *row] for row in similar] + [["divergent", *row] for row in divergent]
+
+BATCH_COMMANDS = {
+    "stats": batch_stats,
+    "1": batch_one,
+    "2": batch_two,
+    "3": batch_three,
+    "4": batch_four,
+    "5": batch_five,
+    "6": batch_six,
+    "7": batch_seven,
+    "8": batch_eight,
+    "9": batch_nine,
+    "10": batch_ten,
+    "11": batch_eleven,
+    "12": batch_twelve,
+    "13": batch_thirteen,
+    "14": batch_fourteen,
+}
 
-    if plotInput == 'y':
-        plt.ioff()
-        plt.plot(x, y1, label=firstStationName)
-        plt.plot(x, y2, label=secondStationName)
-        plt.legend()
-        plt.show()
+#
+# read_batch
+#
+# Reads the requests of a batch file ('-' for standard input), either a JSON list or one JSON object per line.
+#
+def read_batch(path):
+    if path == "-":
+        text = sys.stdin.read()
+    else:
+        with open(path) as batchFile:
+            text = batchFile.read()
+
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+
+    return [json.loads(line) for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
 
 #
-# commandNine
+# run_batch_request
 #
-# Takes in a latitude and longitude as input from the user, and then displays a list of all the stations that are
-# within a one square mile radius of the provided latitude and longitude as well as displaying each station's location.
-# The program also allows the user to plot the locations of these stations on a map of Chicago so that they can visually
-# see where the stations are located.
+# Runs a single batch request and returns its output record: the request number, command and parameters, plus either the
+# columns and rows of the result or an error message. Any exception raised by the request ends up in its error message,
+# so one bad request never stops a batch or leaves a service client without a response. Percentages of a zero total
+# are null.
 #
-def commandNine(dbConn):
-    dbCursor = dbConn.cursor()
-    latitude = input("Enter a latitude:")
-    latitude = float(latitude)
+def run_batch_request(dbConn, number, request):
+    record = {"request": number, "command": "", "params": {}}
 
-    if latitude < 40 or latitude > 43:
-        print("**Latitude entered is out of bounds...")
-        return
+    try:
+        if not isinstance(request, dict):
+            raise BatchError("request is not an object")
 
-    longitude = input("Enter a longitude:")
-    longitude = float(longitude)
+        command = str(request.get("command", ""))
+        record["command"] = command
+        record["params"] = {name: value for name, value in request.items() if name != "command"}
 
-    if longitude < -88 or longitude > -87:
-        print("**Longitude entered is out of bounds...")
+        if command not in BATCH_COMMANDS:
+            raise BatchError("unknown command '{}'".format(command))
+
+        with traced_command("batch " + command):
+            columns, rows = BATCH_COMMANDS[command](dbConn, request)
+        record["columns"] = columns
+        record["rows"] = [dict(zip(columns, row)) for row in rows]
+    except (BatchError, ValueError, TypeError, sqlite3.Error) as error:
+        record["error"] = str(error)
+    except Exception as error:
+        record["error"] = "{}: {}".format(type(error).__name__, error)
+
+    return record
+
+#
+# run_batch
+#
+# Runs every request in the batch file and writes one result per request to the output stream in the given format
+# ("jsonl" or "csv").
+#
+def run_batch(dbConn, path, outputFormat, output):
+    requests = read_batch(path)
+
+    if outputFormat == "csv":
+        writer = csv.writer(output)
+        writer.writerow(["request", "command", "row", "column", "value"])
+
+    for number, request in enumerate(requests, start=1):
+        record = run_batch_request(dbConn, number, request)
+
+        if outputFormat == "jsonl":
+            output.write(json.dumps(record) + "\n")
+        elif "error" in record:
+            writer.writerow([number, record["command"], "", "error", record["error"]])
+        else:
+            for rowNumber, row in enumerate(record["rows"], start=1):
+                for column in record["columns"]:
+                    writer.writerow([number, record["command"], rowNumber, column, row[column]])
+
+#
+# Query service
+#
+# --serve runs a local HTTP/JSON service for dashboards. Each batch command is an endpoint (/stats and /1 to /14) whose
+# query parameters are the batch request parameters, for example /7?station=Clark/Lake&year=2010 or
+# /8?year=2010&stations=Clark/Lake&stations=Howard, and the response is the batch result record. /metrics returns the
+# request count, error count and latency percentiles of every endpoint. Requests are accepted on an asyncio event loop
+# and their SQLite work runs in a bounded pool of worker threads, each with its own read-only connection. At most
+# --max-requests requests run at once; further requests wait, and once --max-pending are waiting new ones get a 503.
+# The service binds to 127.0.0.1 unless told otherwise, and the result cache and tracing are not used by it. The workers
+# parameter of /11 is refused with a 400, since worker processes must not be forked from the service's threads.
+#
+SERVICE_LATENCY_SAMPLES = 1000
+
+#
+# load_asyncio
+#
+# Imports asyncio when the service starts. It is one of the slowest standard library imports, and only --serve uses it.
+#
+def load_asyncio():
+    import asyncio
+    return asyncio
+
+class ConnectionPool:
+    def __init__(self, dbPath, size):
+        self.connections = queue.Queue()
+
+        for i in range(size):
+            dbConn = sqlite3.connect(pathlib.Path(dbPath).resolve().as_uri() + "?mode=ro", uri=True,
+                                     check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+
+            with contextlib.redirect_stdout(sys.stderr):
+                build_rollups(dbConn)
+
+            self.connections.put(dbConn)
+
+    #
+    # connection
+    #
+    # Context manager that borrows a connection from the pool for the duration of a request.
+    #
+    @contextlib.contextmanager
+    def connection(self):
+        dbConn = self.connections.get()
+
+        try:
+            yield dbConn
+        finally:
+            self.connections.put(dbConn)
+
+class ServiceMetrics:
+    def __init__(self):
+        self.endpoints = {}
+        self.rejected = 0
+
+    def record(self, endpoint, milliseconds, failed):
+        metrics = self.endpoints.setdefault(endpoint, {"requests": 0, "errors": 0,
+                                                       "latencies": collections.deque(maxlen=SERVICE_LATENCY_SAMPLES)})
+        metrics["requests"] += 1
+        metrics["errors"] += 1 if failed else 0
+        metrics["latencies"].append(milliseconds)
+
+    #
+    # report
+    #
+    # Returns the metrics of every endpoint, with latency percentiles over its most recent requests.
+    #
+    def report(self):
+        report = {"rejected": self.rejected, "endpoints": {}}
+
+        for endpoint, metrics in sorted(self.endpoints.items()):
+            latencies = list(metrics["latencies"])
+            report["endpoints"][endpoint] = {"requests": metrics["requests"], "errors": metrics["errors"],
+                                             "p50_ms": percentile(latencies, 0.5),
+                                             "p90_ms": percentile(latencies, 0.9),
+                                             "p99_ms": percentile(latencies, 0.99), "max_ms": max(latencies)}
+
+        return report
+
+class QueryService:
+    def __init__(self, dbPath, poolSize, maxRequests, maxPending):
+        self.pool = ConnectionPool(dbPath, poolSize)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=poolSize)
+        self.metrics = ServiceMetrics()
+        self.maxRequests = maxRequests
+        self.maxPending = maxPending
+        self.pending = 0
+        self.slots = None
+
+    #
+    # run_request
+    #
+    # Runs one batch request on a pooled connection, in a worker thread.
+    #
+    def run_request(self, request):
+        with self.pool.connection() as dbConn:
+            record = run_batch_request(dbConn, 0, request)
+
+        del record["request"]
+        return record
+
+    #
+    # respond
+    #
+    # Returns the HTTP status and JSON body for a GET of the given path and query string.
+    #
+    async def respond(self, path, query):
+        asyncio = load_asyncio()
+
+        if path == "/metrics":
+            return 200, self.metrics.report()
+
+        command = path.strip("/")
+
+        if command not in BATCH_COMMANDS:
+            return 404, {"error": "unknown endpoint '{}'".format(path)}
+
+        if self.pending >= self.maxRequests + self.maxPending:
+            self.metrics.rejected += 1
+            return 503, {"error": "too many requests"}
+
+        request = {name: values if name == "stations" else values[-1]
+                   for name, values in urllib.parse.parse_qs(query, keep_blank_values=True).items()}
+        request["command"] = command
+
+        if "workers" in request:
+            return 400, {"command": command, "error": "the workers parameter is not supported by the service"}
+
+        self.pending += 1
+
+        try:
+            async with self.slots:
+                start = time.perf_counter()
+
+                try:
+                    record = await asyncio.get_running_loop().run_in_executor(self.executor, self.run_request, request)
+                    status = 400 if "error" in record else 200
+                except sqlite3.Error as error:
+                    record = {"command": command, "error": str(error)}
+                    status = 500
+
+                self.metrics.record(path, (time.perf_counter() - start) * 1000, status != 200)
+        finally:
+            self.pending -= 1
+
+        return status, record
+
+    #
+    # handle_client
+    #
+    # Reads one HTTP request from a client connection, answers it and closes the connection.
+    #
+    async def handle_client(self, reader, writer):
+        asyncio = load_asyncio()
+
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), 10)
+
+            while True:
+                header = await asyncio.wait_for(reader.readline(), 10)
+
+                if header in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = requestLine.decode("latin-1").split()
+
+            if len(parts) != 3:
+                status, body = 400, {"error": "bad request"}
+            elif parts[0] != "GET":
+                status, body = 405, {"error": "only GET is supported"}
+            else:
+                target = urllib.parse.urlsplit(parts[1])
+                status, body = await self.respond(urllib.parse.unquote(target.path), target.query)
+
+            payload = json.dumps(body).encode()
+            writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                         "Connection: close\r\n\r\n".format(status, http.HTTPStatus(status).phrase, len(payload))
+                         .encode("latin-1") + payload)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    #
+    # serve
+    #
+    # Accepts clients on the given host and port until the program is interrupted.
+    #
+    async def serve(self, host, port):
+        asyncio = load_asyncio()
+        self.slots = asyncio.Semaphore(self.maxRequests)
+        server = await asyncio.start_server(self.handle_client, host, port)
+
+        print("Serving on http://{}:{} (Ctrl-C to stop)".format(host, port))
+
+        async with server:
+            await server.serve_forever()
+
+#
+# run_service
+#
+# Runs the query service until it is interrupted, then prints its metrics.
+#
+def run_service(dbPath, host, port, poolSize, maxRequests, maxPending):
+    service = QueryService(dbPath, poolSize, maxRequests, maxPending)
+
+    try:
+        load_asyncio().run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.executor.shutdown()
+
+    print(json.dumps(service.metrics.report(), indent=2))
+
+#
+# Synthetic database
+#
+# generate_database writes a database with the same tables as the CTA2 L daily ridership database (Stations, Stops,
+# Lines, StopDetails and Ridership), filled with deterministic synthetic data, so the commands can be measured at sizes
+# other than the real one. Scale 1 has the row counts of the real database: 147 stations, 302 stops and about 1.07
+# million ride entries from 2001-01-01 to 2021-07-31. Scale N has N times as many stations, stops and ride entries over
+# the same dates, so every station keeps a realistic history. The lines are the nine real line colors at every scale.
+#
+SYNTHETIC_STATIONS = 147
+SYNTHETIC_STOPS = 302
+SYNTHETIC_FIRST_DATE = datetime.date(2001, 1, 1)
+SYNTHETIC_LAST_DATE = datetime.date(2021, 7, 31)
+
+# share of station days without a ride entry in the real data
+SYNTHETIC_MISSING_DAYS = 0.031
+
+LINE_COLORS = ["Red", "Blue", "Green", "Brown", "Purple", "Purple-Express", "Yellow", "Pink", "Orange"]
+
+STREET_NAMES = ["Addison", "Armitage", "Ashland", "Belmont", "Berwyn", "Cermak", "Chicago", "Clark", "Cicero",
+                "Damen", "Davis", "Division", "Diversey", "Foster", "Fullerton", "Garfield", "Grand", "Halsted",
+                "Harlem", "Harrison", "Irving Park", "Jackson", "Kedzie", "Lake", "Lawrence", "Madison", "Monroe",
+                "Montrose", "Morse", "Pulaski", "Quincy", "Randolph", "Roosevelt", "State", "Wabash", "Washington",
+                "Wells", "Western", "Wilson"]
+
+#
+# generate_database
+#
+# Writes a synthetic database of the given scale (1 to 100) to a new file at dbPath, printing its row counts.
+#
+def generate_database(dbPath, scale):
+    if scale < 1 or scale > 100:
+        print("**Scale must be between 1 and 100...")
         return
 
-    northBoundary = round(latitude + (1 / 69), 3)
-    southBoundary = round(latitude - (1 / 69), 3)
-    eastBoundary = round(longitude + (1 / 51), 3)
-    westBoundary = round(longitude - (1 / 51), 3)
+    if os.path.exists(dbPath):
+        print("**{} already exists...".format(dbPath))
+        return
+
+    generator = random.Random(341)
+    dbConn = sqlite3.connect(dbPath)
+    dbCursor = dbConn.cursor()
+
+    dbCursor.execute("PRAGMA journal_mode = OFF;")
+    dbCursor.execute("PRAGMA synchronous = OFF;")
+
+    dbCursor.executescript("""
+                    CREATE TABLE Stations (
+                        Station_ID INTEGER PRIMARY KEY,
+                        Station_Name TEXT
+                    );
+                    CREATE TABLE Stops (
+                        Stop_ID INTEGER PRIMARY KEY,
+                        Station_ID INTEGER,
+                        Stop_Name TEXT,
+                        Direction TEXT,
+                        ADA INTEGER,
+                        Latitude REAL,
+                        Longitude REAL
+                    );
+                    CREATE TABLE Lines (
+                        Line_ID INTEGER PRIMARY KEY,
+                        Color TEXT
+                    );
+                    CREATE TABLE StopDetails (
+                        Stop_ID INTEGER,
+                        Line_ID INTEGER
+                    );
+                    CREATE TABLE Ridership (
+                        Station_ID INTEGER,
+                        Ride_Date TEXT,
+                        Type_of_Day TEXT,
+                        Num_Riders INTEGER
+                    );
+                    """)
+
+    dbCursor.executemany("INSERT INTO Lines VALUES (?, ?);", enumerate(LINE_COLORS, start=1))
+
+    streetPairs = [(first, second) for first in STREET_NAMES for second in STREET_NAMES if first != second]
+    generator.shuffle(streetPairs)
+
+    stationCount = SYNTHETIC_STATIONS * scale
+    extraStops = (SYNTHETIC_STOPS - 2 * SYNTHETIC_STATIONS) * scale
+    stations = []
+    stopID = 30000
+
+    for i in range(stationCount):
+        first, second = streetPairs[i % len(streetPairs)]
+        stationName = "{}/{}".format(first, second)
+
+        if i >= len(streetPairs):
+            stationName += " {}".format(i // len(streetPairs) + 1)
+
+        stationID = 40000 + 10 * (i + 1)
+        latitude = generator.uniform(41.72, 42.07)
+        longitude = generator.uniform(-87.90, -87.60)
+        lines = generator.sample(range(1, len(LINE_COLORS) + 1), generator.choice([1, 1, 1, 2, 3]))
+        directions = generator.choice([["N", "S", "E"], ["E", "W", "N"]])
+
+        # riders on an average weekday
+        stations.append((stationID, generator.lognormvariate(7.6, 0.8)))
+        dbCursor.execute("INSERT INTO Stations VALUES (?, ?);", (stationID, stationName))
+
+        for direction in directions[:3 if i < extraStops else 2]:
+            stopID += 1
+
+            dbCursor.execute("INSERT INTO Stops VALUES (?, ?, ?, ?, ?, ?, ?);",
+                             (stopID, stationID, "{} ({}-bound)".format(stationName, direction), direction,
+                              int(generator.random() < 0.7), round(latitude + generator.uniform(-0.0005, 0.0005), 6),
+                              round(longitude + generator.uniform(-0.0005, 0.0005), 6)))
+
+            dbCursor.executemany("INSERT INTO StopDetails VALUES (?, ?);", [(stopID, line) for line in lines])
+
+    dayFactors = {"W": 1.0, "A": 0.55, "U": 0.4}
+    holidays = [(1, 1), (5, 31), (7, 4), (9, 6), (11, 25), (12, 25)]
+    day = SYNTHETIC_FIRST_DATE
+    entries = 0
+
+    while day <= SYNTHETIC_LAST_DATE:
+        if day.weekday() == 6 or (day.month, day.day) in holidays:
+            typeOfDay = "U"
+        elif day.weekday() == 5:
+            typeOfDay = "A"
+        else:
+            typeOfDay = "W"
+
+        rideDate = day.isoformat() + " 00:00:00.000"
+        factor = dayFactors[typeOfDay]
+        rows = [(stationID, rideDate, typeOfDay, int(riders * factor * generator.uniform(0.8, 1.2)))
+                for stationID, riders in stations if generator.random() >= SYNTHETIC_MISSING_DAYS]
+
+        dbCursor.executemany("INSERT INTO Ridership VALUES (?, ?, ?, ?);", rows)
+        entries += len(rows)
+        day += datetime.timedelta(days=1)
+
+    dbConn.commit()
+    dbConn.close()
+
+    print("Generated {} (scale {}):".format(dbPath, scale))
+    print("  # of stations:", f"{stationCount:,}")
+    print("  # of stops:", f"{stopID - 30000:,}")
+    print("  # of ride entries:", f"{entries:,}")
+
+#
+# Command benchmark
+#
+# benchmark_commands drives print_stats and commandOne to commandTen the way a user would, with scripted inputs picked
+# from the database so that every command finds data, answering 'n' to every plot prompt and discarding the output. Each
+# command runs once to warm up and is then timed the given number of times. Peak memory is measured in one extra run
+# under tracemalloc, so it only covers Python allocations (not SQLite's page cache) and does not slow the timed runs.
+# The result cache is not used. Results are printed as a table and can be written as JSON to compare runs.
+#
+
+#
+# percentile
+#
+# Returns the nearest-rank percentile (fraction between 0 and 1) of the given values.
+#
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+#
+# benchmark_inputs
+#
+# Returns the scripted inputs for the benchmark: the busiest station and its latest year, the second busiest station,
+# a station name pattern, the line color and direction with the most stops, and the location of the busiest station.
+# Returns None if the database has no ridership.
+#
+def benchmark_inputs(dbConn):
+    dbCursor = dbConn.cursor()
 
     dbCursor.execute("""
-                    SELECT Station_Name, Latitude, Longitude
+                    SELECT Station_Name, max(Year)
+                    FROM Stations
+                    JOIN RidershipYearly
+                    ON Stations.Station_ID = RidershipYearly.Station_ID
+                    GROUP BY Stations.Station_ID
+                    ORDER BY sum(Num_Riders) DESC LIMIT 2;
+                    """)
+
+    busiest = dbCursor.fetchall()
+
+    if len(busiest) == 0:
+        return None
+
+    dbCursor.execute("""
+                    SELECT Color, Direction
+                    FROM Stops
+                    JOIN StopDetails
+                    ON Stops.Stop_ID = StopDetails.Stop_ID
+                    JOIN Lines
+                    ON StopDetails.Line_ID = Lines.Line_ID
+                    GROUP BY Color, Direction
+                    ORDER BY Count(*) DESC LIMIT 1;
+                    """)
+
+    lineColor, direction = dbCursor.fetchone()
+
+    dbCursor.execute("""
+                    SELECT Latitude, Longitude
                     FROM Stops
                     JOIN Stations
                     ON Stops.Station_ID = Stations.Station_ID
-                    ORDER BY Station_Name;
-                    """)
+                    WHERE Station_Name = ?
+                    LIMIT 1;
+                    """, (busiest[0][0],))
+
+    latitude, longitude = dbCursor.fetchone()
+    stationName, year = busiest[0]
+    secondStationName = busiest[-1][0]
+
+    return [
+        ("print_stats", print_stats, []),
+        ("commandOne", commandOne, [stationName[:3] + "%"]),
+        ("commandTwo", commandTwo, [stationName]),
+        ("commandThree", commandThree, []),
+        ("commandFour", commandFour, [lineColor, direction]),
+        ("commandFive", commandFive, []),
+        ("commandSix", commandSix, [stationName, "n"]),
+        ("commandSeven", commandSeven, [stationName, year, "n"]),
+        ("commandEight", commandEight, [year, stationName, secondStationName, "n"]),
+        ("commandNine", commandNine, [latitude, longitude, "n"]),
+        ("commandTen", commandTen, [latitude, longitude, "k", 5, "n"]),
+        ("commandTwelve", commandTwelve, [stationName, year + "-01-01", year + "-12-31", "W", "week"]),
+    ]
 
-    result = dbCursor.fetchone()
-    nearbyStations = []
-    x = []
-    y = []
+#
+# run_scripted
+#
+# Runs a command with the given answers to its prompts on standard input and its output thrown away. Returns the time it
+# took in milliseconds.
+#
+def run_scripted(command, dbConn, inputs, devNull):
+    stdin = sys.stdin
+    sys.stdin = io.StringIO("".join(str(value) + "\n" for value in inputs))
 
-    while True:
-        if northBoundary > result[1] > southBoundary and eastBoundary > result[2] > westBoundary:
-            print(result[0] + " : ({}, {})".format(result[1], result[2]))
-            nearbyStations.append(result[0])
-            x.append(result[2])
-            y.append(result[1])
+    try:
+        with contextlib.redirect_stdout(devNull):
+            start = time.perf_counter()
+            command(dbConn)
+            elapsed = (time.perf_counter() - start) * 1000
+    finally:
+        sys.stdin = stdin
 
-        result = dbCursor.fetchone()
-        result = dbCursor.fetchone()
+    return elapsed
 
-        if result is None:
-            break
+#
+# benchmark_commands
+#
+# Times every command repeat times, prints p50/p90/p99/max latency and peak memory for each, and writes the results to
+# outputPath as JSON if one is given.
+#
+def benchmark_commands(dbConn, repeat, outputPath):
+    commands = benchmark_inputs(dbConn)
 
-    image = plt.imread("chicago.png")
-    xydims = [-87.9277, -87.5569, 41.7012, 42.0868]  # area covered by the map:
-    plt.imshow(image, extent=xydims)
-    plt.title("Stations Near You")
-    plt.plot(x, y, 'o')
+    if commands is None:
+        print("**No ridership data to benchmark...")
+        return
 
-    for i in range(len(nearbyStations)):
-        plt.annotate(nearbyStations[i], (x[i], y[i]))
+    results = []
 
-    plotInput = input("Plot? (y/n)")
-    plotInput = plotInput.lower()
+    with open(os.devnull, "w") as devNull:
+        for name, command, inputs in commands:
+            run_scripted(command, dbConn, inputs, devNull)
+            timings = [run_scripted(command, dbConn, inputs, devNull) for attempt in range(repeat)]
 
-    if plotInput == 'y':
-        plt.xlim([-87.9277, -87.5569])
-        plt.ylim([41.7012, 42.0868])
-        plt.show()
+            tracemalloc.start()
+            run_scripted(command, dbConn, inputs, devNull)
+            peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results.append({"command": name, "runs": repeat, "p50_ms": percentile(timings, 0.5),
+                            "p90_ms": percentile(timings, 0.9), "p99_ms": percentile(timings, 0.99),
+                            "max_ms": max(timings), "peak_memory_kib": peakMemory / 1024})
+
+    print("Command benchmark ({} runs each):".format(repeat))
+    print("  {:<13}{:>10}{:>10}{:>10}{:>10}{:>14}".format("command", "p50 ms", "p90 ms", "p99 ms", "max ms",
+                                                          "peak KiB"))
+
+    for result in results:
+        print("  {:<13}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>14.1f}".format(
+            result["command"], result["p50_ms"], result["p90_ms"], result["p99_ms"], result["max_ms"],
+            result["peak_memory_kib"]))
+
+    if outputPath:
+        with open(outputPath, "w") as output:
+            json.dump(results, output, indent=2)
 
 #
 # main
 #
-print('** Welcome to CTA L analysis app **')
-print()
+# Parses the command line and then either runs a maintenance task or starts the interactive command loop.
+#
+def main():
+    global dayTypeWorkers, listingLimit, listingOffset, listingPageSize
+
+    parser = argparse.ArgumentParser(description="CTA L analysis app")
+    parser.add_argument("--db", default="CTA2_L_daily_ridership.db", help="path to the CTA L daily ridership database")
+    parser.add_argument("--migrate-layout", action="store_true",
+                        help="rewrite Ridership into the clustered storage layout and report the size and timings "
+                             "before and after")
+    parser.add_argument("--check-startup", metavar="MS", type=float,
+                        help="time a warm start against --db and exit with an error if it takes longer than MS")
+    parser.add_argument("--engine", choices=["sqlite", "numpy"], default="sqlite",
+                        help="answer the ridership aggregations with SQLite or with the in-memory NumPy engine")
+    parser.add_argument("--partition", metavar="DIR",
+                        help="split Ridership into one database file per year in DIR, with a manifest, and exit")
+    parser.add_argument("--partitions", metavar="DIR",
+                        help="answer the ridership queries from the year partitions in DIR")
+    parser.add_argument("--partition-workers", metavar="N", type=int, default=os.cpu_count(),
+                        help="number of worker processes that query the partitions of --partitions in parallel")
+    parser.add_argument("--export-snapshot", metavar="PATH",
+                        help="write the columns of the NumPy engine to a memory-mappable snapshot file and exit")
+    parser.add_argument("--snapshot", metavar="PATH",
+                        help="map the NumPy engine from this snapshot file (implies --engine numpy)")
+    parser.add_argument("--ingest", metavar="CSV", nargs="+",
+                        help="add the daily ridership in the CSV files to --db, skipping days already loaded, and exit")
+    parser.add_argument("--ingest-batch", metavar="N", type=int, default=50000,
+                        help="number of CSV rows per --ingest transaction")
+    parser.add_argument("--benchmark-engine", action="store_true",
+                        help="compare the SQLite and NumPy engines on commands 2, 3, 6, 7 and 8 and exit")
+    parser.add_argument("--render-charts", metavar="DIR",
+                        help="write yearly and monthly ridership charts for every station into DIR and exit")
+    parser.add_argument("--chart-format", choices=["png", "svg"], default="png", help="file format of --render-charts")
+    parser.add_argument("--chart-years", metavar="YEARS", default="",
+                        help="comma separated years to render monthly charts for (default: every year)")
+    parser.add_argument("--workers", metavar="N", type=int, default=os.cpu_count(),
+                        help="number of worker processes for --render-charts")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the requests in FILE ('-' for standard input) without prompting and exit")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="output format of --batch")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write --batch results (or --benchmark-commands results as JSON) to FILE")
+    parser.add_argument("--serve", metavar="PORT", type=int,
+                        help="serve stats and commands 1-14 as a local HTTP/JSON service on PORT")
+    parser.add_argument("--host", default="127.0.0.1", help="address --serve listens on")
+    parser.add_argument("--pool-size", metavar="N", type=int, default=4,
+                        help="number of read-only connections and worker threads for --serve")
+    parser.add_argument("--max-requests", metavar="N", type=int, default=8,
+                        help="number of --serve requests that run at once")
+    parser.add_argument("--max-pending", metavar="N", type=int, default=64,
+                        help="number of --serve requests that may wait before new ones are turned away")
+    parser.add_argument("--generate-db", metavar="PATH",
+                        help="write a synthetic database with the CTA schema to PATH and exit")
+    parser.add_argument("--scale", metavar="N", type=int, default=1,
+                        help="size of --generate-db as a multiple of the real row counts (1 to 100)")
+    parser.add_argument("--benchmark-commands", metavar="RUNS", type=int,
+                        help="time print_stats and every command RUNS times against --db and exit")
+    parser.add_argument("--day-types", metavar="FILE",
+                        help="write the day type breakdown of every station (command 11) to FILE as CSV and exit")
+    parser.add_argument("--day-type-sort", choices=list(DAY_TYPE_SORT_COLUMNS), default="name",
+                        help="sort order of --day-types")
+    parser.add_argument("--day-type-workers", metavar="N", type=int, default=1,
+                        help="number of worker processes for the day type breakdown (command 11 and --day-types)")
+    parser.add_argument("--limit", metavar="N", type=int, default=-1,
+                        help="list at most N rows in commands 1, 3, 4 and 5")
+    parser.add_argument("--offset", metavar="N", type=int, default=0,
+                        help="skip the first N rows of commands 1, 3, 4 and 5")
+    parser.add_argument("--page-size", metavar="N", type=int, default=0,
+                        help="pause commands 1, 3, 4 and 5 after every N rows")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=0,
+                        help="cancel a command once its queries have run this many seconds in total (0 for no limit)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="time every command and SQL statement, write the trace to FILE and summarize it on exit")
+    parser.add_argument("--trace-format", choices=["chrome", "jsonl"], default="chrome",
+                        help="write --trace as a Chrome trace or as JSON Lines")
+    parser.add_argument("--cache-size", metavar="N", type=int, default=128,
+                        help="number of query results to keep in the result cache (0 turns the cache off)")
+    parser.add_argument("--persist-cache", action="store_true",
+                        help="save the result cache next to the database on exit and reuse it in the next session")
+    parser.add_argument("--cache-stats", action="store_true",
+                        help="write the result cache hit/miss statistics to standard error on exit")
+    parser.add_argument("--query-stats", action="store_true",
+                        help="write how often each registered query ran, and on how many connections, on exit")
+    args = parser.parse_args()
+
+    if args.snapshot:
+        args.engine = "numpy"
+
+    if args.check_startup is not None:
+        sys.exit(0 if check_startup(args.db, args.check_startup) else 1)
+
+    if args.generate_db:
+        generate_database(args.generate_db, args.scale)
+        return
+
+    if args.serve is not None:
+        dbConn = sqlite3.connect(args.db)
+
+        with contextlib.redirect_stdout(sys.stderr):
+            build_rollups(dbConn)
+
+            if args.engine == "numpy":
+                use_columnar_engine(dbConn, args.snapshot)
+
+            if args.partitions:
+                use_partitions(dbConn, args.partitions, args.partition_workers)
+
+        run_service(args.db, args.host, args.serve, max(1, args.pool_size), max(1, args.max_requests),
+                    max(1, args.max_pending))
+        return
+
+    if args.trace:
+        dbConn = sqlite3.connect(args.db, factory=TracedConnection, check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+        use_tracer(dbConn)
+    else:
+        dbConn = sqlite3.connect(args.db, factory=BackgroundConnection, check_same_thread=False,
+                                 cached_statements=STATEMENT_CACHE_SIZE)
+
+    if args.migrate_layout:
+        migrate_layout(dbConn)
+        return
+
+    if args.ingest:
+        ingest_files(dbConn, args.ingest, max(1, args.ingest_batch))
+        return
+
+    if args.export_snapshot:
+        build_rollups(dbConn)
+        sys.exit(0 if export_snapshot(dbConn, args.export_snapshot) else 1)
+
+    if args.partition:
+        build_rollups(dbConn)
+        sys.exit(0 if partition_ridership(dbConn, args.partition) else 1)
+
+    if args.benchmark_engine:
+        build_rollups(dbConn)
+        benchmark_engine(dbConn)
+        return
+
+    if args.benchmark_commands is not None:
+        build_rollups(dbConn)
+
+        if args.engine == "numpy":
+            use_columnar_engine(dbConn, args.snapshot)
+
+        if args.partitions:
+            use_partitions(dbConn, args.partitions, args.partition_workers)
+
+        benchmark_commands(dbConn, max(1, args.benchmark_commands), args.output)
+        return
+
+    if args.day_types:
+        build_rollups(dbConn)
+        table = day_type_table(network_day_types(dbConn, args.day_type_workers), args.day_type_sort)
+        write_day_types(args.day_types, table)
+        print("Saved", len(table), "stations to", args.day_types)
+        return
+
+    if args.render_charts:
+        build_rollups(dbConn)
+        years = [year.strip() for year in args.chart_years.split(",") if year.strip()]
+        render_charts(dbConn, args.db, args.render_charts, args.chart_format, args.workers, years)
+        return
+
+    if args.batch:
+        with contextlib.redirect_stdout(sys.stderr):
+            build_rollups(dbConn)
+
+            if args.engine == "numpy":
+                use_columnar_engine(dbConn, args.snapshot)
+
+            if args.partitions:
+                use_partitions(dbConn, args.partitions, args.partition_workers)
+
+        if args.cache_size > 0:
+            use_result_cache(dbConn, args.cache_size, args.persist_cache)
+
+        try:
+            if args.output:
+                with open(args.output, "w", newline="") as output:
+                    run_batch(dbConn, args.batch, args.format, output)
+            else:
+                run_batch(dbConn, args.batch, args.format, sys.stdout)
+        finally:
+            close_result_cache(args.cache_stats)
+            close_tracer(args.trace, args.trace_format)
+
+            if args.query_stats:
+                print_query_stats()
+
+        return
+
+    print('** Welcome to CTA L analysis app **')
+    print()
+
+    build_rollups(dbConn)
+
+    if args.engine == "numpy":
+        print("Loading the columnar engine...")
+        use_columnar_engine(dbConn, args.snapshot)
+
+    if args.partitions:
+        use_partitions(dbConn, args.partitions, args.partition_workers)
+
+    if args.cache_size > 0:
+        use_result_cache(dbConn, args.cache_size, args.persist_cache)
+
+    dayTypeWorkers = args.day_type_workers
+    listingLimit = args.limit
+    listingOffset = args.offset
+    listingPageSize = args.page_size
+
+    with traced_command("print_stats"):
+        print_stats(dbConn)
+
+    use_query_runner(dbConn, args.timeout)
+
+    try:
+        while True:
+            userInput = input("Please enter a command (1-14, x to exit):")
+
+            with traced_command("command " + userInput):
+                queryRunner.start_command()
+
+                try:
+                    match userInput:
+                        case 'x':
+                            exit(0)
+
+                        case '1':
+                            commandOne(dbConn)
+
+                        case '2':
+                            commandTwo(dbConn)
+
+                        case '3':
+                            commandThree(dbConn)
+
+                        case '4':
+                            commandFour(dbConn)
 
-dbConn = sqlite3.connect('CTA2_L_daily_ridership.db')
-print_stats(dbConn)
+                        case '5':
+                            commandFive(dbConn)
 
-while True:
-    userInput = input("Please enter a command (1-9, x to exit):")
+                        case '6':
+                            commandSix(dbConn)
 
-    match userInput:
-        case 'x':
-            exit(0)
+                        case '7':
+                            commandSeven(dbConn)
 
-        case '1':
-            commandOne(dbConn)
+                        case '8':
+                            commandEight(dbConn)
 
-        case '2':
-            commandTwo(dbConn)
+                        case '9':
+                            commandNine(dbConn)
 
-        case '3':
-            commandThree(dbConn)
+                        case '10':
+                            commandTen(dbConn)
 
-        case '4':
-            commandFour(dbConn)
+                        case '11':
+                            commandEleven(dbConn)
 
-        case '5':
-            commandFive(dbConn)
+                        case '12':
+                            commandTwelve(dbConn)
 
-        case '6':
-            commandSix(dbConn)
+                        case '13':
+                            commandThirteen(dbConn)
 
-        case '7':
-            commandSeven(dbConn)
+                        case '14':
+                            commandFourteen(dbConn)
 
-        case '8':
-            commandEight(dbConn)
+                        case _:
+                            print("**Error, unknown command, try again... ")
+                except QueryCancelled as error:
+                    dbConn.rollback()
+                    print(error)
+                except KeyboardInterrupt:
+                    dbConn.rollback()
+                    print("**Command cancelled...")
+    finally:
+        close_result_cache(args.cache_stats)
+        close_tracer(args.trace, args.trace_format)
 
-        case '9':
-            commandNine(dbConn)
+        if args.query_stats:
+            print_query_stats()
 
-        case _:
-            print("**Error, unknown command, try again... ")
+if __name__ == "__main__":
+    main()
 
 #
 # done